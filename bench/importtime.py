@@ -0,0 +1,116 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2022 ZKM | Hertz-Lab
+# Dan Wilcox <dan.wilcox@zkm.de>
+#
+# BSD Simplified License.
+# For information on usage and redistribution, and for a DISCLAIMER OF ALL
+# WARRANTIES, see the file, "LICENSE.txt," in this distribution.
+#
+# This code has been developed at ZKM | Hertz-Lab as part of „The Intelligent
+# Museum“ generously funded by the German Federal Cultural Foundation.
+
+# import time benchmark
+#
+# runs each tool's startup import path in a fresh interpreter with
+# python -X importtime and reports the median import time attributed to thoscy
+# (everything imported after the interpreter startup), the median wall time
+# of the whole process, the heaviest top-level imports, and which heavy
+# dependencies were loaded
+#
+# example usage: python3 bench/importtime.py -n 20
+
+import subprocess
+import argparse
+import statistics
+import json
+import time
+import sys
+import os
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# target name -> code run at startup, the relays import their server client
+# when created, so these are imported explicitly
+TARGETS = {
+    "package": "import thoscy",
+    "send": "import thoscy; thoscy.SendRelay; import tb_device_mqtt",
+    "recv": "import thoscy; thoscy.RecvRelay; import websockets.asyncio.client, requests",
+    "relay": "import thoscy; thoscy.SendRelay; thoscy.RecvRelay; import thoscy.config; "
+             "import tb_device_mqtt, websockets.asyncio.client, requests",
+}
+
+# dependencies which should only be loaded by the direction using them
+HEAVY = ("websockets", "requests", "tb_device_mqtt", "tb_gateway_mqtt", "paho.mqtt.client")
+
+# run code once, returns (wall seconds, list of (module, depth, self us, cumulative us))
+def run(code):
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                          cwd=ROOT, capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+    imports = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"): continue
+        fields = line[12:].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit(): continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((name.strip(), depth, int(fields[0]), int(fields[1])))
+    return wall, imports
+
+# returns top-level imports after the thoscy package import
+def attributed(imports):
+    top = []
+    found = False
+    for name, depth, _, cumulative in imports:
+        if name == "thoscy": found = True
+        if found and depth == 0:
+            top.append((name, cumulative))
+    return top
+
+##### main
+
+parser = argparse.ArgumentParser(description="thoscy import time benchmark")
+parser.add_argument("targets", type=str, nargs="*", metavar="TARGET",
+    help=f"targets to run: {', '.join(TARGETS)} (default all)")
+parser.add_argument("-n", "--runs", type=int, dest="runs", default=10,
+    help="runs per target, default: 10")
+parser.add_argument("--top", type=int, dest="top", default=8,
+    help="number of heaviest top-level imports to list, default: 8")
+parser.add_argument("-o", "--output", type=str, dest="output", default=None,
+    help="also write JSON results to file")
+args = parser.parse_args()
+for target in args.targets:
+    if target not in TARGETS:
+        print(f"unknown target: {target}")
+        sys.exit(1)
+
+# interpreter baseline
+walls = [run("pass")[0] for _ in range(args.runs)]
+results = {"python": sys.version.split()[0], "baseline_wall_ms": statistics.median(walls) * 1000, "targets": {}}
+
+for target in args.targets or TARGETS:
+    walls, totals, modules, loaded = [], [], {}, set()
+    for _ in range(args.runs):
+        wall, imports = run(TARGETS[target])
+        walls.append(wall)
+        top = attributed(imports)
+        totals.append(sum(cumulative for _, cumulative in top))
+        for name, cumulative in top:
+            modules.setdefault(name, []).append(cumulative)
+        loaded.update(name for name, _, _, _ in imports if name in HEAVY)
+    heaviest = sorted(((statistics.median(v), k) for k, v in modules.items()), reverse=True)
+    results["targets"][target] = {
+        "import_ms": statistics.median(totals) / 1000,
+        "wall_ms": statistics.median(walls) * 1000,
+        "heavy": sorted(loaded),
+        "top": [{"module": k, "ms": v / 1000} for v, k in heaviest[:args.top]]
+    }
+
+print(json.dumps(results, indent=2))
+if args.output:
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
@@ -0,0 +1,128 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2022 ZKM | Hertz-Lab
+# Dan Wilcox <dan.wilcox@zkm.de>
+#
+# BSD Simplified License.
+# For information on usage and redistribution, and for a DISCLAIMER OF ALL
+# WARRANTIES, see the file, "LICENSE.txt," in this distribution.
+#
+# This code has been developed at ZKM | Hertz-Lab as part of „The Intelligent
+# Museum“ generously funded by the German Federal Cultural Foundation.
+
+# offline loopback using local ThingsBoard stand-ins
+#
+# starts the stand-in MQTT broker and REST/websocket server from standins.py
+# with telemetry published via MQTT pushed back to the websocket subscribers
+# of the same device, as a ThingsBoard server would, and runs thoscy-relay
+# against them until interrupted
+#
+# OSC sent to the thoscy-send port is echoed back to the thoscy-recv port,
+# ie. to run the loopback latency probe without a server:
+#
+#     python3 bench/loopback.py &
+#     ./thoscy-probe -n 1000 -r 100
+
+import asyncio
+import argparse
+import tempfile
+import signal
+import json
+import sys
+import os
+
+from standins import MQTTBroker, TBServer
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+##### parser
+
+parser = argparse.ArgumentParser(description="offline thoscy loopback via local ThingsBoard stand-ins")
+parser.add_argument("-p", "--port", action="store", dest="port",
+    default=7777, type=int, help="thoscy-send OSC receive port, default: 7777")
+parser.add_argument("--recv-port", action="store", dest="recv_port",
+    default=7788, type=int, help="thoscy-recv OSC send port, default: 7788")
+parser.add_argument("--transport", action="store", dest="transport",
+    default="udp", choices=["udp", "tcp"], help="OSC transport, tcp uses SLIP framing, default: udp")
+parser.add_argument("--base-port", action="store", dest="base_port",
+    default=17710, type=int, help="first of 2 local stand-in ports to use, default: 17710")
+parser.add_argument("-v", "--verbose", action="store_true", dest="verbose",
+    help="show relay output")
+
+##### telemetry
+
+# returns list of (device name or None, values dict) from a published
+# MQTT telemetry payload, device name is None for device (non-gateway) topics
+def published_values(topic, payload):
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        return []
+    if topic == "v1/devices/me/telemetry":
+        # device payloads may be a single dict or a list of dicts with or without ts
+        entries = data if isinstance(data, list) else [data]
+        return [(None, entry.get("values", entry)) for entry in entries]
+    elif topic == "v1/gateway/telemetry":
+        return [(name, entry["values"]) for name, entries in data.items() for entry in entries]
+    return []
+
+##### main
+
+async def main(args):
+    ports = {"mqtt": args.base_port, "http": args.base_port + 1}
+    device = {"name": "loopback", "id": "loopback-id"}
+
+    # stand-ins, published telemetry is pushed to the device subscriptions
+    server = TBServer([device], port=ports["http"])
+    def published(topic, payload, now):
+        for name, values in published_values(topic, payload):
+            if name == None or name == device["name"]:
+                server.push(device["id"], values)
+    broker = MQTTBroker(published, port=ports["mqtt"])
+    await broker.start()
+    await server.start()
+
+    # single device config, sends & receives without OSC device prefix
+    config = {
+        "host": f"127.0.0.1:{ports['http']}",
+        "user": "loopback", "password": "loopback", "secure": False,
+        "devices": {"loopback": device},
+        "send": {"address": "127.0.0.1", "port": args.port, "mqtt_port": ports["mqtt"],
+                 "transport": args.transport, "token": "loopback-token"},
+        "recv": {"address": "127.0.0.1", "port": args.recv_port,
+                 "transport": args.transport, "devices": ["loopback"]},
+        "watch": 0
+    }
+    config_file = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+    json.dump(config, config_file)
+    config_file.close()
+
+    output = None if args.verbose else asyncio.subprocess.DEVNULL
+    proc = await asyncio.create_subprocess_exec(sys.executable, os.path.join(ROOT, "thoscy-relay.py"),
+        config_file.name, cwd=ROOT, stdout=output, stderr=output)
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGINT, stop.set)
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    try:
+        ready = asyncio.ensure_future(asyncio.gather(broker.connected.wait(), server.subscribed.wait()))
+        exited = asyncio.ensure_future(proc.wait())
+        done, _ = await asyncio.wait([ready, exited], timeout=30, return_when=asyncio.FIRST_COMPLETED)
+        if ready not in done:
+            ready.cancel()
+            print("thoscy-relay exited or did not connect within 30 s")
+            return 1
+        print(f"loopback osc {args.port} -> stand-ins -> osc {args.recv_port}, CTRL+C to stop")
+        stopped = asyncio.ensure_future(stop.wait())
+        await asyncio.wait([stopped, exited], return_when=asyncio.FIRST_COMPLETED)
+        stopped.cancel()
+    finally:
+        if proc.returncode == None: proc.terminate()
+        await proc.wait()
+        await broker.stop()
+        await server.stop()
+        os.unlink(config_file.name)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,439 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2022 ZKM | Hertz-Lab
+# Dan Wilcox <dan.wilcox@zkm.de>
+#
+# BSD Simplified License.
+# For information on usage and redistribution, and for a DISCLAIMER OF ALL
+# WARRANTIES, see the file, "LICENSE.txt," in this distribution.
+#
+# This code has been developed at ZKM | Hertz-Lab as part of „The Intelligent
+# Museum“ generously funded by the German Federal Cultural Foundation.
+
+# offline relay benchmark using local ThingsBoard stand-ins
+#
+# starts the stand-in MQTT broker and REST/websocket server from standins.py,
+# runs thoscy-send and/or thoscy-recv (or thoscy-relay) as subprocesses against
+# them, and drives the relays with synthetic sequence-numbered OSC messages
+# (send) or telemetry updates (recv) at a fixed rate
+#
+# payload shapes:
+# * scalar:    /dev/seq N                            <-> {"seq": N}
+# * telemetry: /dev/telemetry seq N k0 0.5 k1 0.5... <-> {"seq": N, "k0": 0.5, ...}
+# * array:     /dev/seq N 0.5 0.5...                 <-> {"seq": [N, 0.5, ...]}
+# * blob:      /dev/seq <float32 blob N 0.5...>      <-> {"seq": [N, 0.5, ...]} or base64
+#
+# results are printed as JSON: throughput, loss, p50/p90/p99/max latency per
+# direction plus cpu & rss per relay process (cpu & rss require Linux /proc)
+#
+# example usage: python3 bench/run.py --direction both --rate 500 --devices 4
+
+import asyncio
+import argparse
+import tempfile
+import base64
+import socket
+import struct
+import json
+import time
+import sys
+import os
+import re
+
+from pythonosc.osc_packet import OscPacket, ParseError
+
+from standins import MQTTBroker, TBServer
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+from thoscy.osctcp import OSCStreamServer, slip_encode
+
+##### parser
+
+parser = argparse.ArgumentParser(description="offline thoscy relay benchmark")
+parser.add_argument("-d", "--direction", action="store", dest="direction",
+    default="both", choices=["send", "recv", "both"], help="relay direction(s), default: both")
+parser.add_argument("-m", "--mode", action="store", dest="mode",
+    default="split", choices=["split", "relay"],
+    help="run thoscy-send/thoscy-recv (split) or thoscy-relay (relay), default: split")
+parser.add_argument("-r", "--rate", action="store", dest="rate",
+    default=1000, type=float, help="messages per second per direction, default: 1000")
+parser.add_argument("-t", "--duration", action="store", dest="duration",
+    default=10, type=float, help="measurement duration in seconds, default: 10")
+parser.add_argument("-w", "--warmup", action="store", dest="warmup",
+    default=1, type=float, help="warmup duration in seconds, default: 1")
+parser.add_argument("--drain", action="store", dest="drain",
+    default=2, type=float, help="wait for late messages in seconds after sending, default: 2")
+parser.add_argument("-n", "--devices", action="store", dest="devices",
+    default=1, type=int, help="device count, 0 sends to a single non-gateway device, default: 1")
+parser.add_argument("-s", "--shape", action="store", dest="shape",
+    default="scalar", choices=["scalar", "telemetry", "array", "blob"], help="payload shape, default: scalar")
+parser.add_argument("--size", action="store", dest="size",
+    default=8, type=int, help="extra keys (telemetry) or values (array & blob) per message, default: 8")
+parser.add_argument("--array-encoding", action="store", dest="array_encoding",
+    default="list", choices=["list", "base64"], help="ThingsBoard encoding for the blob shape, default: list")
+parser.add_argument("--transport", action="store", dest="transport",
+    default="udp", choices=["udp", "tcp"], help="OSC transport, tcp uses SLIP framing, default: udp")
+parser.add_argument("--recv-rate", action="store", dest="recv_rate",
+    default=0, type=float, help="thoscy-recv output rate, only the latest values per tick are received, default: immediately")
+parser.add_argument("--base-port", action="store", dest="base_port",
+    default=17700, type=int, help="first of 4 local ports to use, default: 17700")
+parser.add_argument("--metrics", action="store_true", dest="metrics",
+    help="enable relay metrics endpoint on base port + 4 to measure instrumentation overhead")
+parser.add_argument("-o", "--output", action="store", dest="output",
+    default="", help="write JSON results to file instead of stdout")
+parser.add_argument("-v", "--verbose", action="store_true", dest="verbose",
+    help="show relay output")
+
+##### osc
+
+# encode an OSC string
+def osc_string(value):
+    data = value.encode() + b"\0"
+    return data + b"\0" * (-len(data) % 4)
+
+# encode an OSC message with int, float, str, or bytes args
+def osc_message(address, args):
+    tags = ","
+    data = b""
+    for arg in args:
+        if isinstance(arg, str):
+            tags += "s"
+            data += osc_string(arg)
+        elif isinstance(arg, bytes):
+            tags += "b"
+            data += struct.pack(">i", len(arg)) + arg + b"\0" * (-len(arg) % 4)
+        elif isinstance(arg, int):
+            tags += "i"
+            data += struct.pack(">i", arg)
+        else:
+            tags += "f"
+            data += struct.pack(">f", arg)
+    return osc_string(address) + osc_string(tags) + data
+
+# OSC receiver protocol, calls callback(address, args, receive time) per message
+class OSCReceiver(asyncio.DatagramProtocol):
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def datagram_received(self, data, addr):
+        self.received(data, addr)
+
+    # OSC stream packet callback
+    def received(self, data, addr):
+        now = time.perf_counter()
+        try:
+            for timed in OscPacket(data).messages:
+                self.callback(timed.message.address, timed.message.params, now)
+        except ParseError:
+            pass
+
+##### stats
+
+# latency & loss tracker for a single direction,
+# sent times are stored by sequence number
+class Tracker:
+
+    def __init__(self, count, measure_from):
+        self.sent = [0.0] * count
+        self.latencies = []
+        self.received = 0
+        self.sent_count = 0
+        self.measure_from = measure_from # first seq in the measurement window
+        self.duplicates = 0
+        self.seen = bytearray(count)
+
+    def mark_sent(self, seq):
+        self.sent[seq] = time.perf_counter()
+        self.sent_count += 1
+
+    def mark_received(self, seq, now):
+        if seq < 0 or seq >= len(self.sent): return
+        if self.seen[seq]:
+            self.duplicates += 1
+            return
+        self.seen[seq] = 1
+        if seq >= self.measure_from:
+            self.received += 1
+            self.latencies.append(now - self.sent[seq])
+
+    def results(self, duration):
+        measured = self.sent_count - self.measure_from
+        lat = sorted(self.latencies)
+        def pct(p):
+            if len(lat) == 0: return None
+            return round(lat[min(len(lat) - 1, int(p * len(lat)))] * 1000, 3)
+        return {
+            "sent": measured,
+            "received": self.received,
+            "lost": measured - self.received,
+            "loss_ratio": round((measured - self.received) / measured, 6) if measured else None,
+            "duplicates": self.duplicates,
+            "throughput": round(self.received / duration, 1),
+            "latency_ms": {"p50": pct(0.50), "p90": pct(0.90), "p99": pct(0.99),
+                           "max": round(lat[-1] * 1000, 3) if lat else None}
+        }
+
+##### process
+
+# per process cpu & rss sampler, Linux only
+class ProcessStats:
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+        self.cpu_start = None
+        self.wall_start = None
+        self.rss_peak = 0
+
+    # returns cpu seconds used so far or None
+    def cpu(self):
+        try:
+            with open(f"/proc/{self.pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / self.ticks
+        except (OSError, IndexError, ValueError):
+            return None
+
+    # returns current rss in kB or None
+    def rss(self):
+        try:
+            with open(f"/proc/{self.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1])
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def start(self):
+        self.cpu_start = self.cpu()
+        self.wall_start = time.perf_counter()
+
+    def sample(self):
+        rss = self.rss()
+        if rss and rss > self.rss_peak: self.rss_peak = rss
+
+    def results(self):
+        cpu = self.cpu()
+        wall = time.perf_counter() - self.wall_start
+        return {
+            "cpu_percent": round((cpu - self.cpu_start) / wall * 100, 1) \
+                           if cpu != None and self.cpu_start != None else None,
+            "rss_kb": self.rss(),
+            "rss_peak_kb": self.rss_peak or None
+        }
+
+##### payloads
+
+# returns (address suffix, OSC args) for a send message
+def send_payload(shape, size, seq):
+    if shape == "telemetry":
+        args = ["seq", seq]
+        for i in range(size):
+            args += [f"k{i}", 0.5]
+        return "/telemetry", args
+    elif shape == "array":
+        return "/seq", [seq] + [0.5] * size
+    elif shape == "blob":
+        return "/seq", [struct.pack(f">{size + 1}f", seq, *([0.5] * size))]
+    return "/seq", [seq]
+
+# returns telemetry values dict for a recv update
+def recv_payload(shape, size, seq, encoding="list"):
+    if shape == "telemetry":
+        values = {"seq": seq}
+        for i in range(size):
+            values[f"k{i}"] = 0.5
+        return values
+    elif shape == "array" or (shape == "blob" and encoding == "list"):
+        return {"seq": [seq] + [0.5] * size}
+    elif shape == "blob":
+        return {"seq": base64.b64encode(struct.pack(f">{size + 1}f", seq, *([0.5] * size))).decode()}
+    return {"seq": seq}
+
+# extract seq from a published MQTT telemetry payload, returns list of seqs
+def published_seqs(topic, payload):
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        return []
+    if topic == "v1/devices/me/telemetry":
+        # device payloads may be a single dict or a list of dicts with or without ts
+        entries = data if isinstance(data, list) else [data]
+        values = [entry.get("values", entry) for entry in entries]
+    elif topic == "v1/gateway/telemetry":
+        values = [entry["values"] for entries in data.values() for entry in entries]
+    else:
+        return []
+    seqs = []
+    for value in values:
+        seq = value.get("seq")
+        if isinstance(seq, str): # stringified array or base64 packed floats
+            try:
+                if seq.startswith("["): seq = json.loads(seq)
+                else: seq = struct.unpack_from(">f", base64.b64decode(seq))[0]
+            except (ValueError, struct.error): continue
+        if isinstance(seq, list): seq = seq[0]
+        if seq != None: seqs.append(int(seq))
+    return seqs
+
+##### main
+
+# drive count messages at rate, calling send(seq) for each,
+# calls on_measure() when the warmup count has been sent
+async def drive(rate, count, warmup_count, send, on_measure):
+    start = time.perf_counter()
+    seq = 0
+    while seq < count:
+        due = min(count, int((time.perf_counter() - start) * rate) + 1)
+        while seq < due:
+            if seq == warmup_count: on_measure()
+            send(seq)
+            seq += 1
+        await asyncio.sleep(0.001)
+
+async def main(args):
+    ports = {"osc_send": args.base_port, "osc_recv": args.base_port + 1,
+             "mqtt": args.base_port + 2, "http": args.base_port + 3}
+    do_send = args.direction in ("send", "both")
+    do_recv = args.direction in ("recv", "both")
+    warmup_count = int(args.warmup * args.rate)
+    count = warmup_count + int(args.duration * args.rate)
+    devices = [{"name": f"bench device {i}", "id": f"bench-id-{i}"} for i in range(max(1, args.devices))]
+    keys = [re.sub(r"[\W_]+", "", device["name"]).lower() for device in devices]
+
+    send_tracker = Tracker(count, warmup_count)
+    recv_tracker = Tracker(count, warmup_count)
+
+    # stand-ins
+    def published(topic, payload, now):
+        for seq in published_seqs(topic, payload):
+            send_tracker.mark_received(seq, now)
+    broker = MQTTBroker(published, port=ports["mqtt"])
+    server = TBServer(devices, port=ports["http"])
+    await broker.start()
+    await server.start()
+
+    # config
+    config = {
+        "host": f"127.0.0.1:{ports['http']}",
+        "user": "bench", "password": "bench", "secure": False,
+        "devices": {key: device for key, device in zip(keys, devices)},
+        "send": {"address": "127.0.0.1", "port": ports["osc_send"], "mqtt_port": ports["mqtt"],
+                 "transport": args.transport,
+                 "token": "bench-token" if do_send else "",
+                 "devices": keys if do_send and args.devices > 0 else []},
+        "recv": {"address": "127.0.0.1", "port": ports["osc_recv"],
+                 "transport": args.transport, "rate": args.recv_rate,
+                 "devices": keys if do_recv else []},
+        "metrics": {"port": args.base_port + 4 if args.metrics else 0},
+        "types": {"seq": "float32_array"} if args.shape == "blob" else {},
+        "array_encoding": args.array_encoding,
+        "verbose": False
+    }
+    config_file = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+    json.dump(config, config_file)
+    config_file.close()
+
+    # osc receiver for recv direction
+    loop = asyncio.get_running_loop()
+    def osc_received(address, params, now):
+        if address.endswith("/seq") and len(params) > 0:
+            seq = params[0]
+            if isinstance(seq, bytes): seq = struct.unpack_from(">f", seq)[0]
+            recv_tracker.mark_received(int(seq), now)
+    if args.transport == "tcp":
+        # thoscy-recv connects to the OSC stream server
+        transport = OSCStreamServer("127.0.0.1", ports["osc_recv"], callback=OSCReceiver(osc_received).received)
+        await transport.start()
+    else:
+        transport, _ = await loop.create_datagram_endpoint(lambda: OSCReceiver(osc_received),
+                                                           local_addr=("127.0.0.1", ports["osc_recv"]))
+
+    # relays
+    output = None if args.verbose else asyncio.subprocess.DEVNULL
+    scripts = []
+    if args.mode == "relay":
+        scripts.append(("thoscy-relay", ["thoscy-relay.py", config_file.name]))
+    else:
+        if do_send: scripts.append(("thoscy-send", ["thoscy-send.py", "-f", config_file.name]))
+        if do_recv: scripts.append(("thoscy-recv", ["thoscy-recv.py", "-f", config_file.name]))
+    procs = {}
+    for name, cmd in scripts:
+        procs[name] = await asyncio.create_subprocess_exec(sys.executable, os.path.join(ROOT, cmd[0]),
+            *cmd[1:], cwd=ROOT, stdout=output, stderr=output)
+    stats = {name: ProcessStats(proc.pid) for name, proc in procs.items()}
+
+    results = {"params": vars(args), "results": {}, "processes": {}}
+    try:
+        # wait for relays to connect
+        ready = []
+        if do_send: ready.append(broker.connected.wait())
+        if do_recv: ready.append(server.subscribed.wait())
+        ready = asyncio.ensure_future(asyncio.gather(*ready))
+        exited = [asyncio.ensure_future(proc.wait()) for proc in procs.values()]
+        done, _ = await asyncio.wait([ready] + exited, timeout=30, return_when=asyncio.FIRST_COMPLETED)
+        if ready not in done:
+            ready.cancel()
+            raise RuntimeError("relay(s) exited or did not connect within 30 s")
+        await asyncio.sleep(1)
+
+        # drivers
+        prefixes = [("/" + key if args.devices > 0 else "") for key in keys]
+        if args.transport == "tcp" and do_send:
+            _, writer = await asyncio.open_connection("127.0.0.1", ports["osc_send"])
+            def write(packet): writer.write(slip_encode(packet))
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            def write(packet): sock.sendto(packet, ("127.0.0.1", ports["osc_send"]))
+        def send_osc(seq):
+            suffix, osc_args = send_payload(args.shape, args.size, seq)
+            send_tracker.mark_sent(seq)
+            write(osc_message(prefixes[seq % len(prefixes)] + suffix, osc_args))
+        def send_telemetry(seq):
+            recv_tracker.mark_sent(seq)
+            server.push(devices[seq % len(devices)]["id"], recv_payload(args.shape, args.size, seq, args.array_encoding))
+        def on_measure():
+            for stat in stats.values():
+                if stat.cpu_start == None: stat.start()
+        async def sample():
+            while True:
+                for stat in stats.values(): stat.sample()
+                await asyncio.sleep(0.25)
+        sampler = asyncio.create_task(sample())
+        drivers = []
+        if do_send:
+            drivers.append(drive(args.rate, count, warmup_count, send_osc, on_measure))
+        if do_recv:
+            drivers.append(drive(args.rate, count, warmup_count, send_telemetry, on_measure))
+        start = time.perf_counter()
+        await asyncio.gather(*drivers)
+        duration = time.perf_counter() - start - args.warmup
+        for name, stat in stats.items():
+            results["processes"][name] = stat.results()
+        await asyncio.sleep(args.drain) # stragglers
+        sampler.cancel()
+        for name, stat in stats.items():
+            results["processes"][name]["rss_peak_kb"] = stat.rss_peak or None
+        if do_send: results["results"]["send"] = send_tracker.results(duration)
+        if do_recv: results["results"]["recv"] = recv_tracker.results(duration)
+    finally:
+        for proc in procs.values():
+            if proc.returncode == None: proc.terminate()
+            await proc.wait()
+        transport.close()
+        await broker.stop()
+        await server.stop()
+        os.unlink(config_file.name)
+    return results
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    results = asyncio.run(main(args))
+    if args.output != "":
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
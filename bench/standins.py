@@ -0,0 +1,443 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2022 ZKM | Hertz-Lab
+# Dan Wilcox <dan.wilcox@zkm.de>
+#
+# BSD Simplified License.
+# For information on usage and redistribution, and for a DISCLAIMER OF ALL
+# WARRANTIES, see the file, "LICENSE.txt," in this distribution.
+#
+# This code has been developed at ZKM | Hertz-Lab as part of „The Intelligent
+# Museum“ generously funded by the German Federal Cultural Foundation.
+#
+# References:
+# * https://docs.oasis-open.org/mqtt/mqtt/v5.0/mqtt-v5.0.html
+# * https://www.rfc-editor.org/rfc/rfc6455
+# * https://thingsboard.io/docs/reference/gateway-mqtt-api/
+
+# local ThingsBoard stand-ins for offline benchmarking:
+#
+# * MQTTBroker: minimal MQTT 3.1.1 / 5 broker which accepts device & gateway
+#   publishes, acks QoS 1 & 2, and answers the client SDK session limits RPC
+# * TBServer: minimal HTTP & websocket server which mimics the ThingsBoard
+#   /api/auth/login, /api/auth/token, /api/devices REST endpoints and the
+#   /api/ws/plugins/telemetry websocket subscription API
+#
+# both are asyncio servers without dependencies outside the standard library,
+# they implement only as much of each protocol as the thoscy relays use
+
+import asyncio
+import base64
+import hashlib
+import struct
+import json
+import time
+
+##### mqtt
+
+# MQTT packet types
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+# unlimited session limits reply for the client SDK "getSessionLimits" RPC
+SESSION_LIMITS = {
+    "rateLimits": {"messages": "0:0,", "telemetryMessages": "0:0,", "telemetryDataPoints": "0:0,"},
+    "maxInflightMessages": 10000,
+    "maxPayloadSize": 65536
+}
+
+# encode MQTT variable byte integer
+def encode_varint(value):
+    out = bytearray()
+    while True:
+        byte = value % 128
+        value //= 128
+        if value > 0: byte |= 0x80
+        out.append(byte)
+        if value == 0: return bytes(out)
+
+# decode MQTT variable byte integer at pos, returns (value, next pos)
+def decode_varint(buf, pos):
+    value = 0
+    mult = 1
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value += (byte & 0x7f) * mult
+        if byte & 0x80 == 0: return value, pos
+        mult *= 128
+
+# encode MQTT length-prefixed string
+def encode_str(value):
+    data = value.encode()
+    return struct.pack("!H", len(data)) + data
+
+# decode MQTT length-prefixed string at pos, returns (str, next pos)
+def decode_str(buf, pos):
+    length = struct.unpack_from("!H", buf, pos)[0]
+    pos += 2
+    return bytes(buf[pos:pos + length]).decode(), pos + length
+
+# minimal MQTT broker,
+# calls publish_callback(topic, payload bytes, receive time) for every client publish
+class MQTTBroker:
+
+    def __init__(self, publish_callback=None, host="127.0.0.1", port=1883):
+        self.publish_callback = publish_callback
+        self.host = host
+        self.port = port
+        self.server = None
+        self.clients = set()
+        self.connected = asyncio.Event() # set after first client connects
+        self.publishes = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+
+    async def stop(self):
+        for writer in list(self.clients):
+            writer.close()
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    # write a single packet
+    @staticmethod
+    def _packet(ptype, flags, body):
+        return bytes([(ptype << 4) | flags]) + encode_varint(len(body)) + body
+
+    async def _handle(self, reader, writer):
+        self.clients.add(writer)
+        version = 4
+        try:
+            while True:
+                header = await reader.readexactly(1)
+                ptype = header[0] >> 4
+                flags = header[0] & 0x0f
+                # remaining length
+                length = 0
+                mult = 1
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length += (byte & 0x7f) * mult
+                    if byte & 0x80 == 0: break
+                    mult *= 128
+                body = await reader.readexactly(length) if length > 0 else b""
+                if ptype == CONNECT:
+                    _, pos = decode_str(body, 0)
+                    version = body[pos]
+                    props = b"\x00" if version == 5 else b""
+                    writer.write(self._packet(CONNACK, 0, b"\x00\x00" + props))
+                    self.connected.set()
+                elif ptype == PUBLISH:
+                    self._publish(writer, version, flags, body)
+                elif ptype == PUBREL:
+                    writer.write(self._packet(PUBCOMP, 0, body[:2]))
+                elif ptype == SUBSCRIBE:
+                    pid = body[:2]
+                    pos = 2
+                    if version == 5:
+                        plen, pos = decode_varint(body, pos)
+                        pos += plen
+                    codes = bytearray()
+                    while pos < len(body):
+                        _, pos = decode_str(body, pos)
+                        codes.append(body[pos] & 0x03)
+                        pos += 1
+                    props = b"\x00" if version == 5 else b""
+                    writer.write(self._packet(SUBACK, 0, pid + props + bytes(codes)))
+                elif ptype == UNSUBSCRIBE:
+                    pid = body[:2]
+                    if version == 5:
+                        pos = 2
+                        plen, pos = decode_varint(body, pos)
+                        pos += plen
+                        count = 0
+                        while pos < len(body):
+                            _, pos = decode_str(body, pos)
+                            count += 1
+                        writer.write(self._packet(UNSUBACK, 0, pid + b"\x00" + bytes(count)))
+                    else:
+                        writer.write(self._packet(UNSUBACK, 0, pid))
+                elif ptype == PINGREQ:
+                    writer.write(self._packet(PINGRESP, 0, b""))
+                elif ptype == DISCONNECT:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+
+    # handle client publish: ack, answer session limits RPC, and report
+    def _publish(self, writer, version, flags, body):
+        now = time.perf_counter()
+        qos = (flags >> 1) & 0x03
+        topic, pos = decode_str(body, 0)
+        pid = b""
+        if qos > 0:
+            pid = body[pos:pos + 2]
+            pos += 2
+        if version == 5:
+            plen, pos = decode_varint(body, pos)
+            pos += plen
+        payload = body[pos:]
+        if qos == 1:
+            writer.write(self._packet(PUBACK, 0, pid))
+        elif qos == 2:
+            writer.write(self._packet(PUBREC, 0, pid))
+        self.publishes += 1
+        if topic.startswith("v1/devices/me/rpc/request/"):
+            try:
+                if json.loads(payload).get("method") == "getSessionLimits":
+                    reply = "v1/devices/me/rpc/response/" + topic.rsplit("/", 1)[1]
+                    props = b"\x00" if version == 5 else b""
+                    writer.write(self._packet(PUBLISH, 0, encode_str(reply) + props + \
+                                              json.dumps(SESSION_LIMITS).encode()))
+            except (ValueError, AttributeError):
+                pass
+            return
+        if self.publish_callback:
+            self.publish_callback(topic, payload, now)
+
+##### thingsboard http & websocket
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# minimal ThingsBoard REST & websocket server,
+# devices is a list of device dicts with "name" and "id" keys and optional
+# "type" and "groups" (entity group id list) keys for entity data queries
+class TBServer:
+
+    def __init__(self, devices, host="127.0.0.1", port=8080):
+        self.devices = devices
+        self.devices_by_id = {device["id"]: device for device in devices}
+        self.host = host
+        self.port = port
+        self.server = None
+        self.sockets = [] # list of (writer, {(entity id, scope): cmd id}) per websocket
+        self.queries = {} # writer -> {cmd id: (entity data query, device ids in page)}
+        self.subscribed = asyncio.Event() # set after first subscription command
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+
+    async def stop(self):
+        for writer, _ in list(self.sockets):
+            writer.close()
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    # push telemetry update to all subscriptions for a device id,
+    # values is a dict of key/value pairs, values are stringified as ThingsBoard does,
+    # scope is LATEST_TELEMETRY or an attribute scope, ie. SHARED_SCOPE,
+    # returns number of sent frames
+    def push(self, device_id, values, ts=None, scope="LATEST_TELEMETRY"):
+        if ts == None: ts = int(time.time() * 1000)
+        data = {}
+        latest = {}
+        for key, value in values.items():
+            if isinstance(value, (list, dict)):
+                value = json.dumps(value, separators=(',', ':'))
+            data[key] = [[ts, str(value)]]
+            latest[key] = ts
+        sent = 0
+        for writer, subs in self.sockets:
+            cmd_id = subs.get((device_id, scope))
+            if cmd_id == None: continue
+            frame = json.dumps({"subscriptionId": cmd_id, "errorCode": 0, "errorMsg": None,
+                                "data": data, "latestValues": latest})
+            writer.write(TBServer._ws_frame(frame.encode()))
+            sent += 1
+        if scope != "LATEST_TELEMETRY": return sent
+        for writer, queries in self.queries.items():
+            for cmd_id, (query, page) in queries.items():
+                if device_id not in page: continue
+                series = {key: {"ts": ts, "value": data[key][0][1]} for key in values
+                          if key in query["keys"]}
+                if len(series) == 0: continue
+                entity = {"entityId": {"entityType": "DEVICE", "id": device_id},
+                          "latest": {"TIME_SERIES": series}}
+                frame = json.dumps({"cmdId": cmd_id, "data": None, "update": [entity],
+                                    "errorCode": 0, "errorMsg": None, "cmdUpdateType": "ENTITY_DATA"})
+                writer.write(TBServer._ws_frame(frame.encode()))
+                sent += 1
+        return sent
+
+    # add device dict or remove device by id and send the changed page data
+    # to entity data query subscribers, as ThingsBoard does when refreshing
+    # dynamic queries
+    def add_device(self, device):
+        self.devices.append(device)
+        self.devices_by_id[device["id"]] = device
+        self._refresh_queries()
+
+    def remove_device(self, device_id):
+        device = self.devices_by_id.pop(device_id, None)
+        if device: self.devices.remove(device)
+        self._refresh_queries()
+
+    # wait until all websocket writers have flushed
+    async def drain(self):
+        for writer, _ in self.sockets:
+            await writer.drain()
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            lines = request.decode("latin-1").split("\r\n")
+            method, path, _ = lines[0].split(" ", 2)
+            headers = {}
+            for line in lines[1:]:
+                if ":" in line:
+                    key, value = line.split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+            if path.startswith("/api/ws/plugins/telemetry"):
+                await self._websocket(reader, writer, headers)
+                return
+            body = b""
+            if "content-length" in headers:
+                body = await reader.readexactly(int(headers["content-length"]))
+            status, reply = self._rest(method, path, body)
+            data = json.dumps(reply).encode()
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+                         f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    # REST API, returns (status line, reply object)
+    def _rest(self, method, path, body):
+        if method == "POST" and path == "/api/auth/login":
+            return "200 OK", {"token": "login-token", "refreshToken": "login-refresh"}
+        if method == "POST" and path == "/api/auth/token":
+            return "200 OK", {"token": "bench-token", "refreshToken": "bench-refresh"}
+        if method == "GET" and path.startswith("/api/devices?deviceIds="):
+            ids = path.split("=", 1)[1].split(",")
+            devices = []
+            for device_id in ids:
+                device = self.devices_by_id.get(device_id)
+                if device == None: continue
+                devices.append({"id": {"entityType": "DEVICE", "id": device_id},
+                                "name": device["name"], "type": "default"})
+            return "200 OK", devices
+        return "404 Not Found", {"status": 404, "message": f"unknown path: {path}"}
+
+    # websocket handshake & subscription handling
+    async def _websocket(self, reader, writer, headers):
+        accept = base64.b64encode(hashlib.sha1((headers["sec-websocket-key"] + WS_GUID).encode()).digest())
+        writer.write(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n"
+                     b"Connection: Upgrade\r\nSec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+        subs = {}
+        entry = (writer, subs)
+        self.sockets.append(entry)
+        queries = self.queries[writer] = {}
+        try:
+            while True:
+                opcode, payload = await TBServer._ws_read(reader)
+                if opcode == 0x8: # close
+                    writer.write(TBServer._ws_frame(payload[:2], 0x8))
+                    break
+                elif opcode == 0x9: # ping
+                    writer.write(TBServer._ws_frame(payload, 0xA))
+                elif opcode == 0x1: # text: subscription command
+                    cmd = json.loads(payload)
+                    for sub in cmd.get("tsSubCmds", []) + cmd.get("attrSubCmds", []):
+                        key = (sub.get("entityId"), sub.get("scope", "LATEST_TELEMETRY"))
+                        if sub.get("unsubscribe"):
+                            subs.pop(key, None)
+                        else:
+                            subs[key] = sub["cmdId"]
+                    for sub in cmd.get("entityDataUnsubscribeCmds", []):
+                        queries.pop(sub["cmdId"], None)
+                    for sub in cmd.get("entityDataCmds", []):
+                        query = sub["query"]
+                        query["keys"] = [key["key"] for key in sub["latestCmd"]["keys"]]
+                        queries[sub["cmdId"]] = (query, set())
+                        self._send_page(writer, sub["cmdId"], query)
+                    self.subscribed.set()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.sockets.remove(entry)
+            del self.queries[writer]
+
+    # send entity data query page data, changed pages only if refreshing
+    def _send_page(self, writer, cmd_id, query, refresh=False):
+        matches = [device for device in self.devices if TBServer._matches(device, query["entityFilter"])]
+        size = query["pageLink"]["pageSize"]
+        start = query["pageLink"]["page"] * size
+        page = matches[start:start + size]
+        ids = set(device["id"] for device in page)
+        if refresh and ids == self.queries[writer][cmd_id][1]: return
+        self.queries[writer][cmd_id] = (query, ids)
+        entities = [{"entityId": {"entityType": "DEVICE", "id": device["id"]},
+                     "latest": {"ENTITY_FIELD": {"name": {"ts": 0, "value": device["name"]}}}}
+                    for device in page]
+        pages = (len(matches) + size - 1) // size
+        data = {"data": entities, "totalPages": pages, "totalElements": len(matches),
+                "hasNext": start + size < len(matches)}
+        frame = json.dumps({"cmdId": cmd_id, "data": data, "update": None,
+                            "errorCode": 0, "errorMsg": None, "cmdUpdateType": "ENTITY_DATA"})
+        writer.write(TBServer._ws_frame(frame.encode()))
+
+    def _refresh_queries(self):
+        for writer, queries in self.queries.items():
+            for cmd_id, (query, _) in list(queries.items()):
+                self._send_page(writer, cmd_id, query, refresh=True)
+
+    # returns True if device matches an entity data query filter
+    @staticmethod
+    def _matches(device, entity_filter):
+        kind = entity_filter.get("type")
+        if kind == "deviceType":
+            return device.get("type", "default") == entity_filter["deviceType"] and \
+                   device["name"].startswith(entity_filter.get("deviceNameFilter") or "")
+        elif kind == "entityName":
+            return device["name"].startswith(entity_filter["entityNameFilter"])
+        elif kind == "entityGroup":
+            return entity_filter["entityGroup"] in device.get("groups", [])
+        return False
+
+    # read a single client websocket frame, returns (opcode, payload)
+    @staticmethod
+    async def _ws_read(reader):
+        header = await reader.readexactly(2)
+        opcode = header[0] & 0x0f
+        length = header[1] & 0x7f
+        if length == 126:
+            length = struct.unpack("!H", await reader.readexactly(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", await reader.readexactly(8))[0]
+        mask = await reader.readexactly(4) if header[1] & 0x80 else None
+        payload = await reader.readexactly(length)
+        if mask:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        return opcode, payload
+
+    # build a single unmasked server websocket frame
+    @staticmethod
+    def _ws_frame(payload, opcode=0x1):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack("!BB", 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+        return header + payload
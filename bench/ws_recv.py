@@ -0,0 +1,136 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2022 ZKM | Hertz-Lab
+# Dan Wilcox <dan.wilcox@zkm.de>
+#
+# BSD Simplified License.
+# For information on usage and redistribution, and for a DISCLAIMER OF ALL
+# WARRANTIES, see the file, "LICENSE.txt," in this distribution.
+#
+# This code has been developed at ZKM | Hertz-Lab as part of „The Intelligent
+# Museum“ generously funded by the German Federal Cultural Foundation.
+
+# websocket receive loop microbenchmark
+#
+# compares the previous per-frame asyncio.wait_for(ws.recv()) loop with the
+# current TBReceiver receive loop, passing updates to a callback via
+# listen_forever() and iterating over update batches, against a local
+# websocket stand-in server which streams telemetry frames as fast as
+# possible, the server runs in a separate process so the reported rate is
+# per client core
+#
+# example usage: python3 bench/ws_recv.py -n 200000
+
+import asyncio
+import argparse
+import multiprocessing
+import json
+import time
+import sys
+import os
+
+import websockets
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from thoscy.TBReceiver import TBReceiver
+
+FRAME = json.dumps({
+    "subscriptionId": 0, "errorCode": 0, "errorMsg": None,
+    "data": {"temperature": [[1650000000000, "21.5"]], "humidity": [[1650000000000, "40"]]},
+    "latestValues": {"temperature": 1650000000000, "humidity": 1650000000000}
+})
+
+##### server
+
+# stream count frames to each client after the subscription command is received
+def run_server(port, count, ready):
+    async def handler(ws):
+        await ws.recv() # subscription command
+        for _ in range(count):
+            await ws.send(FRAME)
+        await ws.close()
+    async def main():
+        async with websockets.serve(handler, "127.0.0.1", port, compression=None):
+            ready.set()
+            await asyncio.Future()
+    asyncio.run(main())
+
+##### clients
+
+# previous receive loop: one wait_for timeout task per frame
+async def recv_wait_for(ws, callback, reply_timeout=10):
+    while True:
+        try:
+            reply = await asyncio.wait_for(ws.recv(), timeout=reply_timeout)
+        except websockets.exceptions.ConnectionClosed:
+            break
+        data = json.loads(reply)
+        data["data"] = TBReceiver.parse_values(data["data"])
+        callback(data)
+
+# TBReceiver receiving from an already open websocket
+class BenchReceiver(TBReceiver):
+
+    def __init__(self, ws, callback, **kwargs):
+        super().__init__({}, callback, "", "", "", **kwargs)
+        self.bench_ws = ws
+
+    async def _connect_forever(self):
+        await self.receive(self.bench_ws)
+
+# current receive loop via callback
+async def recv_async_for(ws, callback):
+    await BenchReceiver(ws, callback).listen_forever()
+
+# current receive loop via batch iterator
+async def recv_batch(ws, callback):
+    async with BenchReceiver(ws, None, batch=True) as receiver:
+        async for updates in receiver:
+            for data in updates:
+                callback(data)
+
+# run a single client, returns (frames, wall seconds, cpu seconds)
+async def run_client(port, loop_func):
+    count = 0
+    def callback(data):
+        nonlocal count
+        count += 1
+    url = f"ws://127.0.0.1:{port}"
+    async with websockets.connect(url, compression=None) as ws:
+        await ws.send("{}")
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        await loop_func(ws, callback)
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+    return count, wall, cpu
+
+##### main
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="websocket receive loop microbenchmark")
+    parser.add_argument("-n", "--count", action="store", dest="count",
+        default=100000, type=int, help="frames per run, default: 100000")
+    parser.add_argument("-p", "--port", action="store", dest="port",
+        default=8765, type=int, help="local server port, default: 8765")
+    args = parser.parse_args()
+
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=run_server, args=(args.port, args.count, ready), daemon=True)
+    server.start()
+    ready.wait()
+    results = {}
+    try:
+        for name, func in (("before", recv_wait_for), ("after", recv_async_for), ("batch", recv_batch)):
+            count, wall, cpu = asyncio.run(run_client(args.port, func))
+            results[name] = {
+                "frames": count,
+                "seconds": round(wall, 3),
+                "msgs_per_sec": round(count / wall),
+                "msgs_per_cpu_sec": round(count / cpu) if cpu > 0 else None
+            }
+            print(f"{name}: {count} frames in {wall:.3f} s, "
+                  f"{count / wall:.0f} msg/s, {results[name]['msgs_per_cpu_sec']} msg/cpu s")
+    finally:
+        server.terminate()
+    print(json.dumps(results))
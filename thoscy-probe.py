@@ -0,0 +1,357 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2022 ZKM | Hertz-Lab
+# Dan Wilcox <dan.wilcox@zkm.de>
+#
+# BSD Simplified License.
+# For information on usage and redistribution, and for a DISCLAIMER OF ALL
+# WARRANTIES, see the file, "LICENSE.txt," in this distribution.
+#
+# This code has been developed at ZKM | Hertz-Lab as part of „The Intelligent
+# Museum“ generously funded by the German Federal Cultural Foundation.
+#
+# References:
+# * https://github.com/attwad/python-osc
+
+# end-to-end loopback latency probe
+#
+# sends sequence-numbered, timestamped probe messages to thoscy-send and
+# listens for them to come back from thoscy-recv (or both from thoscy-relay),
+# then reports round-trip latency percentiles, loss, and reordering per
+# report interval and in total
+#
+# probe message: /[prefix]/probe RUN SEQ MS
+# * RUN: random run id, probes from other or earlier runs are ignored
+# * SEQ: sequence number, starting at 0
+# * MS: send time in ms since the start of the run
+#
+# the send and receive device must be the same ThingsBoard device, so the
+# probe telemetry is echoed back, ie. thoscy-send with the device's access
+# token and thoscy-recv with its device id
+
+from array import array
+import asyncio
+import argparse
+import signal
+import random
+import json
+import time
+import sys
+
+from pythonosc.osc_message_builder import OscMessageBuilder
+from pythonosc.osc_packet import OscPacket, ParseError
+
+from thoscy.config import Config
+from thoscy.registry import normalize
+from thoscy.osctcp import OSCStreamServer, OSCStreamClient
+
+##### parser
+
+parser = argparse.ArgumentParser(description="OSC -> ThingsBoard -> OSC loopback latency probe")
+parser.add_argument(
+    "-a", "--address", action="store", dest="address",
+    default="", help="thoscy-send OSC address, default: 127.0.0.1")
+parser.add_argument(
+    "-p", "--port", action="store", dest="port",
+    default=-1, type=int, help="thoscy-send OSC port, default: 7777")
+parser.add_argument(
+    "--recv-address", action="store", dest="recv_address",
+    default="", help="OSC listen address for thoscy-recv messages, default: 127.0.0.1")
+parser.add_argument(
+    "--recv-port", action="store", dest="recv_port",
+    default=-1, type=int, help="OSC listen port for thoscy-recv messages, default: 7788")
+parser.add_argument(
+    "--tcp", action="store_true", dest="tcp",
+    help="send & receive SLIP framed OSC over TCP instead of UDP")
+parser.add_argument(
+    "--prefix", action="store", dest="prefix",
+    default=None, help="OSC address device prefix when sending via a gateway, ie. /device1")
+parser.add_argument(
+    "-k", "--key", action="store", dest="key",
+    default="probe", help="probe telemetry key, default: probe")
+parser.add_argument(
+    "-r", "--rate", action="store", dest="rate",
+    default=10, type=float, help="probes per second, default: 10")
+parser.add_argument(
+    "-n", "--count", action="store", dest="count",
+    default=100, type=int, help="number of probes to send, default: 100")
+parser.add_argument(
+    "-c", "--continuous", action="store_true", dest="continuous",
+    help="send probes until interrupted with CTRL+C, ignores COUNT")
+parser.add_argument(
+    "-i", "--interval", action="store", dest="interval",
+    default=1, type=float, help="report interval in seconds, 0 disables, default: 1")
+parser.add_argument(
+    "--timeout", action="store", dest="timeout",
+    default=5, type=float, help="seconds after which a probe is counted as lost, default: 5")
+parser.add_argument(
+    "-f", "--file", action="store", dest="file",
+    default="", help="JSON configuration file, probe uses the send & recv OSC settings")
+parser.add_argument(
+    "-o", "--output", action="store", dest="output",
+    default="", help="write JSON results to file")
+parser.add_argument("-v", "--verbose", action="store_true", dest="verbose",
+    help="print every received probe")
+
+##### config
+
+# load config from optional file and commandline arguments,
+# returns True on success
+def load_config(config, args):
+    if args.file != "":
+        if not config.load_file(args.file):
+            return False
+    if args.address != "": config.set("send.address", args.address)
+    if args.port != -1: config.set("send.port", args.port)
+    if args.recv_address != "": config.set("recv.address", args.recv_address)
+    if args.recv_port != -1: config.set("recv.port", args.recv_port)
+    if args.tcp:
+        config.set("send.transport", "tcp")
+        config.set("recv.transport", "tcp")
+    if args.rate <= 0:
+        print("rate must be > 0")
+        return False
+    return True
+
+# returns OSC address prefix for the send device: the given prefix or the
+# first send device name if using a gateway, otherwise none
+def send_prefix(config, prefix):
+    if prefix != None:
+        prefix = prefix.strip("/")
+        return "/" + prefix if prefix != "" else ""
+    names = config.send_names()
+    if len(names) > 0:
+        return "/" + normalize(names[0])
+    return ""
+
+##### stats
+
+# returns percentile p of sorted values in ms or None if empty
+def percentile(values, p):
+    if len(values) == 0: return None
+    return round(values[min(len(values) - 1, int(p * len(values)))] * 1000, 3)
+
+# round-trip stats for a set of probes
+class Stats:
+
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.lost = 0 # not received within timeout
+        self.reordered = 0 # received after a later probe
+        self.late = 0 # received after timeout or duplicate
+        self.rtts = array("d") # seconds
+
+    # returns results dict
+    def results(self):
+        rtts = sorted(self.rtts)
+        resolved = self.received + self.lost
+        return {
+            "sent": self.sent,
+            "received": self.received,
+            "lost": self.lost,
+            "loss_ratio": round(self.lost / resolved, 6) if resolved else None,
+            "reordered": self.reordered,
+            "late": self.late,
+            "rtt_ms": {"p50": percentile(rtts, 0.50), "p90": percentile(rtts, 0.90),
+                       "p99": percentile(rtts, 0.99), "max": percentile(rtts, 1)}
+        }
+
+# probe sequencer & matcher: sent times are kept by sequence number until
+# the probe is received or times out
+class Probe:
+
+    def __init__(self, key, timeout):
+        self.suffix = "/" + key
+        self.timeout = timeout
+        self.run = random.randint(1, 2**31 - 1)
+        self.start = time.perf_counter()
+        self.seq = 0 # next seq to send
+        self.highest = -1 # highest received seq
+        self.pending = {} # seq -> sent time, ordered by seq
+        self.total = Stats()
+        self.interval = Stats()
+        self.verbose = False
+
+    # returns args for the next probe and marks it as sent
+    def next(self):
+        now = time.perf_counter()
+        args = [self.run, self.seq, int((now - self.start) * 1000)]
+        self.pending[self.seq] = now
+        self.seq += 1
+        self.total.sent += 1
+        self.interval.sent += 1
+        return args
+
+    # match received OSC message
+    def received(self, address, args, now):
+        if not address.endswith(self.suffix) or len(args) < 2: return
+        try:
+            run = int(args[0])
+            seq = int(args[1])
+        except (ValueError, TypeError):
+            return
+        if run != self.run: return
+        sent = self.pending.pop(seq, None)
+        for stats in (self.total, self.interval):
+            if sent == None:
+                stats.late += 1
+                continue
+            stats.received += 1
+            stats.rtts.append(now - sent)
+            if seq < self.highest: stats.reordered += 1
+        if sent != None:
+            if seq > self.highest: self.highest = seq
+            if self.verbose:
+                print(f"{address} {seq}: {(now - sent) * 1000:.3f} ms")
+
+    # count probes older than the timeout as lost, all if now is None
+    def expire(self, now=None):
+        deadline = None if now == None else now - self.timeout
+        while len(self.pending) > 0:
+            seq, sent = next(iter(self.pending.items()))
+            if deadline != None and sent > deadline: break
+            del self.pending[seq]
+            self.total.lost += 1
+            self.interval.lost += 1
+
+    # forget probes still in flight, ie. when interrupted
+    def discard(self):
+        self.total.sent -= len(self.pending)
+        self.pending = {}
+
+    # returns stats for the current interval and starts a new one
+    def report(self):
+        self.expire(time.perf_counter())
+        stats = self.interval
+        self.interval = Stats()
+        return stats
+
+##### osc
+
+# OSC receiver protocol, calls callback(address, args, receive time) per message
+class OSCReceiver(asyncio.DatagramProtocol):
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def datagram_received(self, data, addr):
+        self.received(data, addr)
+
+    # OSC stream packet callback
+    def received(self, data, addr):
+        now = time.perf_counter()
+        try:
+            for timed in OscPacket(data).messages:
+                self.callback(timed.message.address, timed.message.params, now)
+        except ParseError:
+            pass
+
+# returns OSC message packet
+def build_message(address, args):
+    builder = OscMessageBuilder(address=address)
+    for arg in args:
+        builder.add_arg(arg)
+    return builder.build().dgram
+
+##### main
+
+# print interval or summary line
+def print_stats(label, results):
+    rtt = results["rtt_ms"]
+    line = f"{label} sent {results['sent']} recv {results['received']} lost {results['lost']}"
+    line += f" reordered {results['reordered']} late {results['late']}"
+    if rtt["p50"] != None:
+        line += f" rtt ms p50 {rtt['p50']} p90 {rtt['p90']} p99 {rtt['p99']} max {rtt['max']}"
+    print(line)
+
+async def main(args, config):
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGINT, stop.set)
+    probe = Probe(args.key, args.timeout)
+    probe.verbose = args.verbose
+    address = send_prefix(config, args.prefix) + "/" + args.key
+    receiver = OSCReceiver(probe.received)
+
+    # receive from thoscy-recv, a tcp thoscy-recv connects to the probe
+    # unless it is listening itself
+    send = config.send
+    recv = config.recv
+    if recv["transport"] == "tcp":
+        if recv["listen"]:
+            listener = OSCStreamClient(recv["address"], recv["port"], callback=receiver.received)
+        else:
+            listener = OSCStreamServer(recv["address"], recv["port"], callback=receiver.received)
+        await listener.start()
+        deadline = time.perf_counter() + args.timeout
+        while not recv["listen"] and len(listener.connections) == 0 and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01) # wait for thoscy-recv to (re)connect
+    else:
+        listener, _ = await loop.create_datagram_endpoint(lambda: receiver,
+                                                          local_addr=(recv["address"], recv["port"]))
+
+    # send to thoscy-send
+    if send["transport"] == "tcp":
+        sender = OSCStreamClient(send["address"], send["port"])
+        await sender.start()
+        write = sender.send
+        deadline = time.perf_counter() + args.timeout
+        while sender.connection == None and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+    else:
+        sender, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol,
+                                                        remote_addr=(send["address"], send["port"]))
+        write = sender.sendto
+
+    print(f"probe {address} -> osc {send['address']}:{send['port']}, "
+          f"osc {recv['address']}:{recv['port']} -> probe")
+
+    # report per interval
+    async def report():
+        elapsed = 0
+        while True:
+            await asyncio.sleep(args.interval)
+            elapsed += args.interval
+            print_stats(f"{elapsed:7.1f} s", probe.report().results())
+    reporter = asyncio.create_task(report()) if args.interval > 0 else None
+
+    try:
+        # send probes at rate without drift
+        count = None if args.continuous else args.count
+        start = time.perf_counter()
+        while not stop.is_set() and (count == None or probe.seq < count):
+            delay = start + probe.seq / args.rate - time.perf_counter()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(stop.wait(), delay)
+                    break
+                except asyncio.TimeoutError:
+                    pass
+            write(build_message(address, probe.next()))
+
+        # wait for outstanding probes
+        deadline = time.perf_counter() + args.timeout
+        while not stop.is_set() and len(probe.pending) > 0 and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+    finally:
+        if reporter: reporter.cancel()
+        listener.close()
+        sender.close()
+    if stop.is_set(): # interrupted
+        probe.expire(time.perf_counter())
+        probe.discard()
+    else:
+        probe.expire()
+    return probe.total.results()
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    config = Config()
+    if not load_config(config, args):
+        sys.exit(1)
+    results = asyncio.run(main(args, config))
+    print_stats("total", results)
+    if args.output != "":
+        with open(args.output, "w") as f:
+            json.dump({"params": vars(args), "results": results}, f, indent=2)
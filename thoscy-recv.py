@@ -14,19 +14,11 @@
 # * https://github.com/attwad/python-osc
 
 import asyncio
-import signal
 import argparse
 import sys
-import os
-import re
-
-from pythonosc.udp_client import SimpleUDPClient
-from pythonosc import osc_bundle_builder
-from pythonosc import osc_message_builder
-from threading import Thread
 
 import thoscy
-import json
+from thoscy.config import Config, ConfigWatcher
 
 ##### parser
 
@@ -49,223 +41,82 @@ parser.add_argument(
 parser.add_argument(
     "-p", "--port", action="store", dest="port",
     default=-1, type=int, help="OSC send port, default: 7788")
+parser.add_argument(
+    "--tcp", action="store_true", dest="tcp",
+    help="send SLIP framed OSC over TCP instead of UDP, connects to ADDRESS:PORT")
 parser.add_argument(
     "-t", "--telemetry", action="store_true", dest="telemetry",
     help="send all key/value pairs in a single /telemetry message")
 parser.add_argument(
     "--prefix", action="store_true", dest="prefix",
     help="force OSC address device name prefix for single device")
+parser.add_argument(
+    "--rate", action="store", dest="rate",
+    default=-1, type=float, help="send changed values at RATE per second, ie. 60, default: immediately")
+parser.add_argument(
+    "--table", action="store", dest="table",
+    default="", help="also write latest values to shared memory table NAME for local readers")
 parser.add_argument(
     "-f", "--file", action="store", dest="file",
     default="", help="JSON configuration file")
+parser.add_argument(
+    "--metrics", action="store", dest="metrics",
+    default=-1, type=int, help="Prometheus metrics HTTP port, default: disabled")
+parser.add_argument(
+    "--profile", action="store", dest="profile",
+    default="", help="enable on-demand profiling, writing output to DIR")
 parser.add_argument("-v", "--verbose", action='count', dest="verbose",
     default=0, help="enable verbose printing, use -vv for debug verbosity")
 
 ##### config
 
-# configuration values
-class Config:
-
-    def __init__(self):
-        self.host = ""
-        self.user = ""
-        self.password = ""
-        self.ids = [] # device ids to subscribe to
-        self.address = "127.0.0.1"
-        self.port = 7788
-        self.telemetry = False
-        self.prefix = False # force OSC address device name prefix?
-        self.verbose = False
-
-        # subscribed device array of dicts, keys are:
-        # * name: device name as shown in ThingsBoard UI
-        # * key: device name as OSC address key prefix
-        self.devices = []
-
-    # load config from env vars, optional file, and commandline arguments
-    def load(self, args):
-        self._load_env()
-        if args.file != "":
-            if not self._load_file(args.file):
-                return False
-        self._load_args(args)
-        return self._validate()
-
-    # add device name to known devices by OSC address key prefix,
-    # key will be stripped on non alphanumeric chars and made lowercase
-    def add_device(self, key, name):
-        key = re.sub("[\W_]+", "", key).lower()
-        for device in self.devices:
-            if key == device["key"]:
-                print(f"ignoring duplicate device: {key} {name}")
-                return
-        self.devices.append({"key": key, "name": name})
-        if len(self.devices) > 1: self.prefix = True
-
-    # print current values
-    def print(self):
-        print(f"host: {self.host}")
-        print(f"user: {self.user}")
-        print(f"device id(s):")
-        for device_id in self.ids:
-            print(f"{device_id}")
-        print(f"address: {self.address}")
-        print(f"port: {self.port}")
-        print(f"telemetry: {self.telemetry}")
-        print(f"prefix: {self.prefix}")
-        print(f"verbose: {self.verbose}")
-
-    # print device OSC address key to name mappings
-    def print_devices(self):
-        if len(self.devices) > 0:
-            print("device(s)")
-            for device in self.devices:
-                print(f"/{device['key']} <- {device['name']}")
-
-    # load env vars
-    def _load_env(self):
-        # user credentials
-        if "THOSCY_USER" in os.environ: self.user = os.environ.get("THOSCY_USER")
-        if "THOSCY_PASS" in os.environ: self.password = os.environ.get("THOSCY_PASS")
-
-    # load JSON file, returns True on success
-    # TODO: check if key exists without throwing exception
-    def _load_file(self, path):
-        try:
-            f = open(args.file)
-            config = json.load(f)
-            f.close()        
-            if "host" in config.keys(): self.host = config["host"]
-            if "user" in config.keys(): self.user = config["user"]
-            if "password" in config.keys(): self.password = config["password"]
-            if "verbose" in config.keys(): self.verbose = config["verbose"]
-            if "recv" in config.keys():
-                recv = config["recv"]
-                if "address" in recv.keys(): self.address = recv["address"]
-                if "port" in recv.keys(): self.port = recv["port"]
-                if "telemetry" in recv.keys(): self.telemetry = recv["telemetry"]
-                if "prefix" in recv.keys(): self.prefix = recv["prefix"]
-                if "devices" in recv.keys() and len(recv["devices"]) > 0 and \
-                   "devices" in config.keys() and len(config["devices"]) > 0:
-                    for key in recv["devices"]:
-                        if key not in config["devices"].keys():
-                            print(f"ignoring unknown recv device: {key}")
-                            continue
-                        device = config["devices"][key]
-                        if "id" not in device.keys() or device["id"] == "":
-                           print(f"ignoring recv device without name: {key}")
-                           continue
-                        self.ids.append(device["id"])
-        except Exception as exc:
-            print(f"could not open or read {args.file}: {type(exc).__name__} {exc}")
-            return False
-        return True
-
-    # load commandline args
-    def _load_args(self, args):
-        # override
-        if args.host != "": self.host = args.host
-        if args.user != "": self.user = args.user
-        if args.password != "": self.password = args.password
-        if args.address != "": self.address = args.address
-        if args.port != -1: self.port = args.port
-        if not self.telemetry and args.telemetry: self.telemetry = True
-        if not self.prefix and args.prefix: self.prefix = True
-        if not self.verbose and args.verbose: self.verbose = True
-        # append
-        for device in args.ids: self.ids.append(device)
-
-    # validate current values, returns True on success
-    def _validate(self):
-        if self.host == "":
-            print("host required")
-            return False
-        if len(self.ids) == 0:
-            print("device id(s) required")
-            return False
-        # prompt for user and/or password?
-        try:
-            if self.user == "":
-                self.user = input("user: ")
-            if self.password == "":
-                import getpass
-                self.password = getpass.getpass("password: ")
-        except:
+# load config from env vars, optional file, and commandline arguments,
+# prompts for missing user credentials, returns True on success
+def load_config(config, args):
+    config.load_env()
+    if args.file != "":
+        if not config.load_file(args.file):
             return False
-        if self.user == "" or self.password == "":
-            print("user & password required")
-            return False
-        return True
-
-##### thingsboard
-
-# device info callback, ignore if not using device name prefix
-# FIXME: what to do if # devices does not match up with # config.devices?
-#        in this case, the cmdId/subscriptionId indices could be wrong
-def received_devices(devices):
-    if len(devices) < 2 and not config.prefix: return
-    for device in devices:
-        name = device['name']
-        config.add_device(name, name)
-    if config.verbose: config.print_devices()
-
-# telemetry callback, sends key/value pairs as osc messages
-# note: tries to convert values to float, ignores json keys for now,
-#       see jsonparser.py for details
-def received_telemetry(data):
-    data_entry = data["data"]
-    if data_entry == None:
-        if data["errorCode"] != 0:
-            print(f"telemetry error {data['errorCode']}: {data['errorMsg']}")
-        else:
-            print("telemetry error: data empty, did connection fail?")
-        return
-    prefix = ""
-    if config.prefix:
-        # device name prefix?
-        data_id = data["subscriptionId"]
-        device = config.devices[data_id]
-        if device == None or "key" not in device.keys() or device["key"] == "":
-            print(f"telemetry warning: received update from unknown device: {data_entry.keys()}")
-            return
-        prefix = "/" + device["key"]
-    if config.telemetry:
-        # send multiple key/value pairs
-        address = prefix + "/telemetry"
-        message = osc_message_builder.OscMessageBuilder(address=address)
-        if config.verbose: print(address, end="")
-        for key in data_entry.keys():
-            if key == "" or key == "json": continue
-            value = data_entry[key][0][1]
-            _,args = thoscy.json_to_osc({key: value})
-            message.add_arg(key)
-            message.add_arg(args[0])
-            if config.verbose: print(f" {key}: {value}", end="")
-        sender.send(message.build())
-        if config.verbose: print("")
-    else:
-        # send single values or arrays
-        bundle = osc_bundle_builder.OscBundleBuilder(osc_bundle_builder.IMMEDIATELY)
-        for key in data_entry.keys():
-            if key == "" or key == "json": continue
-            value = data_entry[key][0][1]
-            address,args = thoscy.json_to_osc({key: value})
-            if prefix != "":
-                address = prefix + address
-            message = osc_message_builder.OscMessageBuilder(address=address)
-            for arg in args:
-                message.add_arg(arg)
-            bundle.add_content(message.build())
-            if config.verbose:
-                print(f"{address} {args}")
-        sender.send(bundle.build())
+    if args.host != "": config.set("host", args.host)
+    if args.user != "": config.set("user", args.user)
+    if args.password != "": config.set("password", args.password)
+    if args.address != "": config.set("recv.address", args.address)
+    if args.port != -1: config.set("recv.port", args.port)
+    if args.tcp: config.set("recv.transport", "tcp")
+    if args.metrics != -1: config.set("metrics.port", args.metrics)
+    if args.profile != "": config.set("profile.directory", args.profile)
+    if args.table != "": config.set("table.name", args.table)
+    if not config.recv["telemetry"] and args.telemetry: config.set("recv.telemetry", True)
+    if not config.recv["prefix"] and args.prefix: config.set("recv.prefix", True)
+    if args.rate != -1: config.set("recv.rate", args.rate)
+    if not config.verbose and args.verbose: config.set("verbose", True)
+    if len(args.ids) > 0: config.set("extra_ids", args.ids)
+    if config.host == "":
+        print("host required")
+        return False
+    if len(config.recv_ids()) == 0 and len(config.recv["groups"]) == 0:
+        print("device id(s) or groups required")
+        return False
+    # prompt for user and/or password?
+    try:
+        if config.user == "":
+            config.set("user", input("user: "))
+        if config.password == "":
+            import getpass
+            config.set("password", getpass.getpass("password: "))
+    except:
+        return False
+    if config.user == "" or config.password == "":
+        print("user & password required")
+        return False
+    return True
 
 ##### main
 
 # parse config
 args = parser.parse_args()
 config = Config()
-if not config.load(args):
+if not load_config(config, args):
     sys.exit(1)
 if args.verbose > 1:
     thoscy.TBReceiver.set_verbose(True)
@@ -273,33 +124,43 @@ args = None
 parser = None
 if config.verbose: config.print()
 
-# osc sender
-sender = SimpleUDPClient(config.address, config.port)
-
 # connect & subscribe to device telemetry
-# the cmdId key is returned as the subscriptionId key when receiving telemetry,
-# in this case we use it as an index in the config.devices array
-subscription_cmd = {"tsSubCmds": []}
-cmd_id = 0
-for device_id in config.ids:
-    subscription_cmd["tsSubCmds"].append(
-        {
-            "entityType": "DEVICE",
-            "entityId": device_id,
-            "scope": "LATEST_TELEMETRY",
-            "cmdId": cmd_id
-        }
-    )
-    cmd_id = cmd_id + 1
-receiver = thoscy.TBReceiver(subscription_cmd=subscription_cmd, \
-                             telemetry_callback=received_telemetry, \
-                             device_callback=received_devices, **vars(config))
-thread = Thread(target=thoscy.TBReceiver.run_receiver, args=(0, receiver), daemon=False)
-thread.start()
-
-# wait for receiver to exit
-print(f"osc {config.address}:{config.port} <- ws {config.host}")
+metrics = None
+if thoscy.Metrics.enabled(config.metrics):
+    metrics = thoscy.Metrics(**config.metrics)
+tracer = thoscy.Tracer.create(config.trace, config.verbose)
+relay = thoscy.RecvRelay.from_config(config, metrics=metrics, tracer=tracer)
+profiler = None
+if thoscy.Profiler.enabled(config.profile):
+    profiler = thoscy.Profiler(name="thoscy-recv", tracer=tracer, **config.profile)
+
+# run receiver (and metrics & profiler) until exit
+async def main():
+    watcher = None
+    try:
+        if metrics:
+            await metrics.start()
+        if profiler:
+            await profiler.start()
+        if config.path != "":
+            # apply config file changes to the running relay
+            async def reconfigure(config, changes):
+                await relay.reconfigure(config)
+            watcher = ConfigWatcher(config, reconfigure)
+            await watcher.start()
+        await relay.run()
+    finally:
+        if watcher:
+            watcher.stop()
+        if profiler:
+            profiler.stop()
+        if metrics:
+            metrics.stop()
+
+print(f"osc {relay.address}:{relay.port} <- ws {relay.host}")
 try:
-    thread.join()
+    asyncio.run(main())
 except KeyboardInterrupt:
     pass
+finally:
+    if tracer: tracer.stop()
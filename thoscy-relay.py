@@ -0,0 +1,161 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2022 ZKM | Hertz-Lab
+# Dan Wilcox <dan.wilcox@zkm.de>
+#
+# BSD Simplified License.
+# For information on usage and redistribution, and for a DISCLAIMER OF ALL
+# WARRANTIES, see the file, "LICENSE.txt," in this distribution.
+#
+# This code has been developed at ZKM | Hertz-Lab as part of „The Intelligent
+# Museum“ generously funded by the German Federal Cultural Foundation.
+#
+# References:
+# * https://github.com/attwad/python-osc
+
+import asyncio
+import signal
+import argparse
+import sys
+
+import thoscy
+from thoscy.config import Config, ConfigWatcher
+
+##### parser
+
+parser = argparse.ArgumentParser(description="OSC <-> ThingsBoard bidirectional relay server")
+parser.add_argument(
+    "file", type=str, metavar="FILE",
+    help="JSON configuration file")
+parser.add_argument(
+    "--host", action="store", dest="host",
+    default="", help="ThingsBoard server host name, ie. thingsboard.mydomain.com")
+parser.add_argument(
+    "--user", action="store", dest="user",
+    default="", help="ThingsBoard user name")
+parser.add_argument(
+    "--password", action="store", dest="password",
+    default="", help="ThingsBoard user password")
+parser.add_argument(
+    "--token", action="store", dest="token",
+    default="", help="ThingsBoard device access token")
+parser.add_argument(
+    "--uvloop", action="store_true", dest="uvloop",
+    help="use uvloop event loop, if available")
+parser.add_argument(
+    "--metrics", action="store", dest="metrics",
+    default=-1, type=int, help="Prometheus metrics HTTP port, default: disabled")
+parser.add_argument(
+    "--profile", action="store", dest="profile",
+    default="", help="enable on-demand profiling, writing output to DIR")
+parser.add_argument("-v", "--verbose", action='count', dest="verbose",
+    default=0, help="enable verbose printing, use -vv for debug verbosity")
+
+##### config
+
+# load config from env vars, file, and commandline arguments,
+# returns True on success
+def load_config(config, args):
+    config.load_env()
+    if not config.load_file(args.file):
+        return False
+    if args.host != "": config.set("host", args.host)
+    if args.user != "": config.set("user", args.user)
+    if args.password != "": config.set("password", args.password)
+    if args.token != "": config.set("send.token", args.token)
+    if args.metrics != -1: config.set("metrics.port", args.metrics)
+    if args.profile != "": config.set("profile.directory", args.profile)
+    if not config.verbose and args.verbose: config.set("verbose", True)
+    if config.host == "":
+        print("host required")
+        return False
+    return True
+
+##### main
+
+# run both directions on the current loop until signalled or the receiver exits,
+# shuts down both directions together
+async def main(config, send_relay, recv_relay, metrics, profiler):
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    tasks = [asyncio.create_task(stop.wait())]
+
+    # apply config file changes to the running relays
+    async def reconfigure(config, changes):
+        if send_relay: await send_relay.reconfigure(config)
+        if recv_relay: await recv_relay.reconfigure(config)
+    watcher = ConfigWatcher(config, reconfigure)
+    try:
+        await watcher.start()
+        if metrics:
+            await metrics.start()
+        if profiler:
+            await profiler.start()
+        if send_relay:
+            await send_relay.start()
+            print(f"osc {send_relay.address}:{send_relay.port} -> mqtt {send_relay.host}")
+        if recv_relay:
+            tasks.append(asyncio.create_task(recv_relay.run()))
+            print(f"osc {recv_relay.address}:{recv_relay.port} <- ws {recv_relay.host}")
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        watcher.stop()
+        if send_relay:
+            send_relay.stop()
+        if metrics:
+            metrics.stop()
+        if profiler:
+            profiler.stop()
+
+# parse config
+args = parser.parse_args()
+config = Config()
+if not load_config(config, args):
+    sys.exit(1)
+if args.verbose > 1:
+    thoscy.TBSender.set_verbose(True)
+if args.uvloop:
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        print("uvloop not available, using default event loop")
+if config.verbose:
+    config.print()
+
+# create relays, sharing config, credentials, and metrics
+metrics = None
+if thoscy.Metrics.enabled(config.metrics):
+    metrics = thoscy.Metrics(**config.metrics)
+tracer = thoscy.Tracer.create(config.trace, config.verbose)
+profiler = None
+if thoscy.Profiler.enabled(config.profile):
+    profiler = thoscy.Profiler(name="thoscy-relay", tracer=tracer, **config.profile)
+send_relay = thoscy.SendRelay.from_config(config, tracer=tracer, metrics=metrics)
+recv_relay = None
+if len(config.recv_ids()) > 0 or len(config.recv["groups"]) > 0:
+    if config.user == "" or config.password == "":
+        print("recv: user & password required")
+    else:
+        recv_relay = thoscy.RecvRelay.from_config(config, tracer=tracer, metrics=metrics)
+if not send_relay and not recv_relay:
+    print("nothing to relay, send token and/or recv devices required")
+    sys.exit(1)
+if send_relay:
+    if not send_relay.connect():
+        sys.exit(1)
+    if config.verbose: send_relay.print_devices()
+args = None
+parser = None
+
+try:
+    asyncio.run(main(config, send_relay, recv_relay, metrics, profiler))
+except KeyboardInterrupt:
+    pass
+finally:
+    if tracer: tracer.stop()
@@ -0,0 +1,186 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2022 ZKM | Hertz-Lab
+# Dan Wilcox <dan.wilcox@zkm.de>
+#
+# BSD Simplified License.
+# For information on usage and redistribution, and for a DISCLAIMER OF ALL
+# WARRANTIES, see the file, "LICENSE.txt," in this distribution.
+#
+# This code has been developed at ZKM | Hertz-Lab as part of „The Intelligent
+# Museum“ generously funded by the German Federal Cultural Foundation.
+
+# OSC traffic replayer for load testing
+#
+# streams a capture log recorded by thoscy-send --capture back to an OSC port
+# at the original timing, N times faster, or as fast as possible
+#
+# packets are sent as recorded without parsing from a plain blocking socket,
+# the clock is only read when the next packet is due after the last reading,
+# so bursts and speeds beyond real time cost a socket send per packet
+
+import argparse
+import socket
+import time
+import sys
+
+from thoscy.capture import CaptureReader
+from thoscy.osctcp import slip_encode
+
+##### parser
+
+parser = argparse.ArgumentParser(description="OSC capture log replayer")
+parser.add_argument(
+    "path", action="store", nargs=1, metavar="PATH",
+    help="capture directory or segment file")
+parser.add_argument(
+    "-a", "--address", action="store", dest="address",
+    default="127.0.0.1", help="destination OSC address, default: 127.0.0.1")
+parser.add_argument(
+    "-p", "--port", action="store", dest="port",
+    default=7777, type=int, help="destination OSC port, default: 7777")
+parser.add_argument(
+    "--tcp", action="store_true", dest="tcp",
+    help="send SLIP framed OSC over TCP instead of UDP")
+parser.add_argument(
+    "-s", "--speed", action="store", dest="speed",
+    default=1, type=float, help="playback speed factor, 0 sends as fast as possible, default: 1")
+parser.add_argument(
+    "--max-gap", action="store", dest="max_gap",
+    default=0, type=float, help="clamp idle gaps between packets to seconds, 0 disables, default: 0")
+parser.add_argument(
+    "-l", "--loop", action="store", dest="loop",
+    default=1, type=int, help="number of times to play the log, 0 loops until interrupted, default: 1")
+
+##### output
+
+# UDP datagram output
+class UDPOutput:
+
+    def __init__(self, address, port):
+        family,_,_,_,destination = socket.getaddrinfo(address, port, type=socket.SOCK_DGRAM)[0]
+        self.socket = socket.socket(family, socket.SOCK_DGRAM)
+        self.socket.connect(destination)
+        self.errors = 0
+
+    def send(self, packet):
+        try:
+            self.socket.send(packet)
+        except OSError:
+            self.errors += 1 # ie. ECONNREFUSED while nobody is listening
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.socket.close()
+
+# TCP SLIP stream output, frames are batched into larger writes which are
+# flushed when full or before waiting
+class TCPOutput:
+
+    BATCH_SIZE = 65536
+
+    def __init__(self, address, port):
+        self.socket = socket.create_connection((address, port))
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = bytearray()
+        self.errors = 0
+
+    def send(self, packet):
+        self.buffer += slip_encode(packet)
+        if len(self.buffer) >= TCPOutput.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0: return
+        self.socket.sendall(self.buffer)
+        self.buffer.clear()
+
+    def close(self):
+        self.flush()
+        self.socket.close()
+
+##### replay
+
+# play capture records to output, returns (packets sent, max lag in s)
+#
+# record times are mapped to a playback schedule: gaps are divided by speed,
+# gaps going backwards (separate captures) are skipped, and gaps are clamped
+# to max_gap seconds if set
+def replay(records, output, speed, max_gap):
+    send = output.send
+    clock = time.monotonic_ns
+    max_gap = int(max_gap * 1e9) if max_gap > 0 else 0
+    packets = 0
+    lag = 0
+    if speed <= 0:
+        for _, packet in records:
+            send(packet)
+            packets += 1
+        return packets, 0
+    start = clock()
+    now = start
+    elapsed = 0 # playback time in ns of record time since start
+    prev = None
+    for ts, packet in records:
+        if prev != None:
+            gap = ts - prev
+            if gap > 0:
+                elapsed += max_gap if max_gap and gap > max_gap else gap
+        prev = ts
+        due = start + int(elapsed / speed)
+        if due > now:
+            now = clock()
+            if due - now > 1000000: # > 1 ms ahead, wait
+                output.flush()
+                time.sleep((due - now) / 1e9)
+                now = clock()
+            elif now - due > lag:
+                lag = now - due
+        send(packet)
+        packets += 1
+    return packets, lag / 1e9
+
+##### main
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    path = args.path[0]
+    try:
+        output = TCPOutput(args.address, args.port) if args.tcp else UDPOutput(args.address, args.port)
+    except OSError as exc:
+        print(f"could not connect to {args.address}:{args.port}: {exc}")
+        sys.exit(1)
+    transport = "tcp" if args.tcp else "udp"
+    speed = f"{args.speed:g}x" if args.speed > 0 else "max"
+    print(f"replay {path} -> osc {transport} {args.address}:{args.port}, speed {speed}")
+    total = 0
+    start = time.perf_counter()
+    count = 0
+    try:
+        while args.loop == 0 or count < args.loop:
+            packets, lag = replay(CaptureReader(path), output, args.speed, args.max_gap)
+            if packets == 0:
+                print("no packets in capture log")
+                break
+            total += packets
+            count += 1
+            line = f"loop {count}: {packets} packets" if args.loop != 1 else ""
+            if args.speed > 0:
+                line += (", " if line else "") + f"max lag {lag * 1000:.3f} ms"
+            if line: print(line)
+    except (ValueError, OSError) as exc:
+        print(f"replay failed: {exc}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        try:
+            output.close()
+        except OSError:
+            pass
+    duration = time.perf_counter() - start
+    rate = total / duration if duration > 0 else 0
+    print(f"sent {total} packets in {duration:.3f} s, {rate:.0f} packets/s")
+    if output.errors > 0:
+        print(f"{output.errors} send errors")
@@ -16,15 +16,10 @@
 import asyncio
 import signal
 import argparse
-import time
 import sys
-import re
-
-from pythonosc.dispatcher import Dispatcher
-from pythonosc.osc_server import AsyncIOOSCUDPServer
 
 import thoscy
-import json
+from thoscy.config import Config, ConfigWatcher
 
 ##### parser
 
@@ -44,137 +39,49 @@ parser.add_argument(
 parser.add_argument(
     "-p", "--port", action="store", dest="port",
     default=-1, type=int, help="OSC receive port, default: 7777")
+parser.add_argument(
+    "--tcp", action="store_true", dest="tcp",
+    help="receive SLIP framed OSC over TCP instead of UDP")
+parser.add_argument(
+    "--capture", action="store", dest="capture",
+    default="", help="record received OSC packets to capture log DIR, see thoscy-replay")
 parser.add_argument(
     "-f", "--file", action="store", dest="file",
     default="", help="JSON configuration file")
+parser.add_argument(
+    "--metrics", action="store", dest="metrics",
+    default=-1, type=int, help="Prometheus metrics HTTP port, default: disabled")
+parser.add_argument(
+    "--profile", action="store", dest="profile",
+    default="", help="enable on-demand profiling, writing output to DIR")
 parser.add_argument("-v", "--verbose", action='count', dest="verbose",
     default=0, help="enable verbose printing, use -vv for debug verbosity")
 
 ##### config
 
-# configuration values
-class Config:
-
-    def __init__(self):
-        self.host = ""
-        self.token = ""
-        self.address = "127.0.0.1"
-        self.port = 7777
-        self.verbose = False
-
-        # device names by OSC address key
-        self.devices = {}
-
-    # load config from env vars, optional file, and commandline arguments
-    def load(self, args):
-        if args.file != "":
-            if not self._load_file(args.file):
-                return False
-        self._load_args(args)
-        return self._validate()
-
-    # add device name to known devices by OSC address key prefix,
-    # key will be stripped on non alphanumeric chars and made lowercase
-    def add_device(self, key, name):
-        key = re.sub("[\W_]+", "", key).lower()
-        if key in self.devices:
-            print(f"ignoring duplicate device: {key} {name}")
-        else:
-            self.devices[key] = name
-
-    # print current values
-    def print(self):
-        print(f"host: {self.host}")
-        print(f"device token: {self.token}")
-        print(f"address: {self.address}")
-        print(f"port: {self.port}")
-        print(f"verbose: {self.verbose}")
-
-    # print device OSC address key to name mappings
-    def print_devices(self):
-        if len(self.devices) > 0:
-            print("device(s)")
-            for key in self.devices:
-                print(f"  /{key} -> {self.devices[key]}")
-
-    # load JSON file, returns True on success
-    # TODO: check if key exists without throwing exception
-    def _load_file(self, path):
-        try:
-            f = open(args.file)
-            config = json.load(f)
-            f.close()        
-            if "host" in config.keys(): self.host = config["host"]
-            if "verbose" in config.keys(): self.verbose = config["verbose"]
-            if "send" in config.keys():
-                send = config["send"]
-                if "token" in send.keys(): self.token = send["token"]
-                if "address" in send.keys(): self.address = send["address"]
-                if "port" in send.keys(): self.port = send["port"]
-                if "devices" in send.keys() and len(send["devices"]) > 0 and \
-                    "devices" in config.keys() and len(config["devices"]) > 0:
-                    for key in send["devices"]:
-                        if key not in config["devices"].keys():
-                            print(f"ignoring unknown send device: {key}")
-                            continue
-                        device = config["devices"][key]
-                        if "name" not in device.keys() or device["name"] == "":
-                            print(f"ignoring send device without name: {key}")
-                            continue
-                        name = device["name"]
-                        self.add_device(name, name)
-        except Exception as exc:
-            print(f"could not open or read {args.file}: {type(exc).__name__} {exc}")
+# load config from optional file and commandline arguments,
+# returns True on success
+def load_config(config, args):
+    if args.file != "":
+        if not config.load_file(args.file):
             return False
-        return True
-
-    # load commandline args
-    def _load_args(self, args):
-        # override
-        if args.host != "": self.host = args.host
-        if args.token != "": self.token = args.token
-        if args.address != "": self.address = args.address
-        if args.port != -1: self.port = args.port
-        if not self.verbose and args.verbose: self.verbose = True
-        # append
-        for name in args.names: self.add_device(name, name)
-
-    # validate current values, returns True on success
-    def _validate(self):
-        if self.host == "":
-            print("host required")
-            return False
-        if self.token == "":
-            print("device access token required")
-            return False
-        return True
-
-##### osc
-
-# osc message callback, send osc messages as json
-# see oscparser.py for conversion details
-def received_osc(address, *args):
-    if config.verbose:
-        print(f"{address} {list(args)}")
-    if sender.gateway:
-        # using gateway: filter first address component as device name prefix
-        components = address.split("/")
-        if len(components) < 3: # need min of: / prefix / key
-            print(f"invalid osc address: {address}")
-            return
-        prefix = components[1]
-        try:
-            name = config.devices[prefix]
-        except:
-            print(f"unknown device: {prefix}")
-            return
-        address = "/" + "/".join(components[2:])
-        data = thoscy.osc_to_json(address, list(args))
-        sender.send_telemetry(data, device_name=name)
-    else:
-        # single device
-        data = thoscy.osc_to_json(address, list(args))
-        sender.send_telemetry(data)
+    if args.host != "": config.set("host", args.host)
+    if args.token != "": config.set("send.token", args.token)
+    if args.address != "": config.set("send.address", args.address)
+    if args.port != -1: config.set("send.port", args.port)
+    if args.tcp: config.set("send.transport", "tcp")
+    if args.capture != "": config.set("capture.path", args.capture)
+    if args.metrics != -1: config.set("metrics.port", args.metrics)
+    if args.profile != "": config.set("profile.directory", args.profile)
+    if not config.verbose and args.verbose: config.set("verbose", True)
+    if len(args.names) > 0: config.set("extra_names", args.names)
+    if config.host == "":
+        print("host required")
+        return False
+    if config.send["token"] == "":
+        print("device access token required")
+        return False
+    return True
 
 ##### signal
 
@@ -191,7 +98,7 @@ loop.add_signal_handler(signal.SIGINT, sigint_handler)
 # parse config
 args = parser.parse_args()
 config = Config()
-if not config.load(args):
+if not load_config(config, args):
     sys.exit(1)
 if args.verbose > 1:
     thoscy.TBSender.set_verbose(True)
@@ -201,26 +108,42 @@ if config.verbose:
     config.print()
 
 # connect to thingsboard
-sender = thoscy.TBSender(config.host, config.token, \
-                         values_stringified=False,
-                         gateway=(len(config.devices) > 0), \
-                         gateway_devices=list(config.devices.values()))
-if not sender.connect():
+metrics = None
+if thoscy.Metrics.enabled(config.metrics):
+    metrics = thoscy.Metrics(**config.metrics)
+tracer = thoscy.Tracer.create(config.trace, config.verbose)
+relay = thoscy.SendRelay.from_config(config, metrics=metrics, tracer=tracer)
+if not relay.connect():
     sys.exit(1)
 
 # start osc receiver
-dispatcher = Dispatcher()
-dispatcher.set_default_handler(received_osc)
-receiver = AsyncIOOSCUDPServer((config.address, config.port), dispatcher, loop)
-loop.run_until_complete(receiver.create_serve_endpoint())
+loop.run_until_complete(relay.start())
+if metrics:
+    loop.run_until_complete(metrics.start())
+profiler = None
+if thoscy.Profiler.enabled(config.profile):
+    profiler = thoscy.Profiler(name="thoscy-send", tracer=tracer, **config.profile)
+    loop.run_until_complete(profiler.start())
+
+# apply config file changes to the running relay
+watcher = None
+if config.path != "":
+    async def reconfigure(config, changes):
+        await relay.reconfigure(config)
+    watcher = ConfigWatcher(config, reconfigure)
+    loop.run_until_complete(watcher.start())
 
 # wait for osc receiver to exit
-print(f"osc {config.address}:{config.port} -> mqtt {config.host}")
+print(f"osc {relay.address}:{relay.port} -> mqtt {relay.host}")
 if config.verbose:
-    config.print_devices()
+    relay.print_devices()
 try:
     loop.run_forever()
 except KeyboardInterrupt:
     pass
 finally:
-    sender.disconnect()
+    if watcher: watcher.stop()
+    if profiler: profiler.stop()
+    if metrics: metrics.stop()
+    relay.stop()
+    if tracer: tracer.stop()
@@ -0,0 +1,483 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2022 ZKM | Hertz-Lab
+# Dan Wilcox <dan.wilcox@zkm.de>
+#
+# BSD Simplified License.
+# For information on usage and redistribution, and for a DISCLAIMER OF ALL
+# WARRANTIES, see the file, "LICENSE.txt," in this distribution.
+#
+# This code has been developed at ZKM | Hertz-Lab as part of „The Intelligent
+# Museum“ generously funded by the German Federal Cultural Foundation.
+#
+# References:
+# * https://github.com/attwad/python-osc
+
+import asyncio
+import socket
+import time
+
+from .TBReceiver import TBReceiver, QUERY_CMDS, PAGE_SIZE
+from .osctcp import OSCStreamServer, OSCStreamClient
+from .scheduler import OutputScheduler
+from .jsonparser import telemetry_to_osc, encode_osc
+from .shmtable import TableWriter
+from .schema import Schema
+from .registry import Registry, normalize
+from .metrics import RelayStats
+from .trace import Tracer
+
+# ThingsBoard websocket -> OSC relay
+class RecvRelay:
+
+    # init with
+    # * host: str, ThingsBoard server hostname, ie. thingsboard.mydomain.com
+    # * user credentials: str, username & password
+    # * ids: str list, device id(s) to subscribe to
+    # additional options:
+    # * address: str, OSC send address, default: 127.0.0.1
+    # * port: int, OSC send port, default: 7788
+    # * transport: str, OSC transport: udp or tcp (SLIP framed), default: udp
+    # * listen: bool, tcp: accept OSC connections on address & port instead
+    #   of connecting to it?
+    # * telemetry: bool, send all key/value pairs in a single /telemetry message?
+    # * prefix: bool, force OSC address device name prefix for single device?
+    # * groups: dict, device group queries by name, subscribes to the
+    #   telemetry of all devices matching each query, devices are followed as
+    #   they are added or removed, query keys are:
+    #   - type: str, device type
+    #   - group: str, entity group id (ThingsBoard PE)
+    #   - name: str, device name prefix, combined with type if both are given
+    #   - keys: str list, telemetry keys
+    #   - page_size: int, devices per query page, default: 100
+    # * attributes: str list, also subscribe to device attribute scopes,
+    #   see config.ATTRIBUTE_SCOPES, attribute updates are sent like telemetry
+    # * rate: float, send changed values at a fixed rate per second, ie. 60,
+    #   instead of immediately, 0 disables (default)
+    # * interpolate: bool, interpolate numeric values when using a rate?
+    # * secure: bool, connect to ThingsBoard using https & wss (default)?
+    # * hosts: dict list, additional ThingsBoard hosts to also receive from,
+    #   keys are: name, host, user, password, secure, ids
+    # * table: dict, also write the latest value per OSC address to a shared
+    #   memory table for local readers, see shmtable.py, keys are: name,
+    #   slots, address_size, value_size
+    # * types: dict, value types by key, see schema.py
+    # * array_encoding: str, ThingsBoard packed array encoding, see schema.py
+    # * verbose: bool, print sent messages?
+    # * tracer: Tracer, message tracer, default: stdout tracer if verbose
+    # * metrics: Metrics, metrics registry, None disables instrumentation
+    def __init__(self, host, user, password, ids, **kwargs):
+        self.host = host
+        self.ids = []
+        self.attributes = list(kwargs.get("attributes") or [])
+        self.address = kwargs.get("address") or "127.0.0.1"
+        self.port = kwargs.get("port") or 7788
+        self.transport = kwargs.get("transport") or "udp"
+        self.listen = kwargs.get("listen") or False
+        self.telemetry = kwargs.get("telemetry") or False
+        self.force_prefix = kwargs.get("prefix") or False
+        self.prefix = self.force_prefix
+        self.rate = kwargs.get("rate") or 0
+        self.interpolate = kwargs.get("interpolate") or False
+        self.scheduler = None
+        self.verbose = kwargs.get("verbose") or False
+        self.tracer = kwargs.get("tracer") or Tracer.create(None, self.verbose)
+        self.schema = Schema(kwargs.get("types"), kwargs.get("array_encoding"))
+        self.table = None
+        table = kwargs.get("table") or {}
+        if table.get("name", "") != "":
+            self.table = TableWriter(table["name"], slots=table.get("slots"),
+                                     address_size=table.get("address_size"),
+                                     value_size=table.get("value_size"))
+
+        # subscribed devices by id & subscription cmdId, the name and OSC
+        # address key prefix are set once the device info has been fetched
+        self.devices = Registry()
+
+        # osc sender, packets are encoded by encode_osc and sent as is,
+        # either as UDP datagrams or via the OSC stream client or server for tcp
+        self.sock = None
+        self.destination = None
+        self.stream = None
+        self._open_sender()
+
+        # metrics
+        self.stats = None
+        metrics = kwargs.get("metrics")
+        if metrics:
+            self.stats = RelayStats(metrics, "recv", ("decode", "convert", "encode", "send"))
+            self.stats.queue_bytes("tcp", self.queued)
+
+        # connect & subscribe to device telemetry
+        # the cmdId key is returned as the subscriptionId key when receiving
+        # telemetry, in this case we use it to look up the device
+        self.next_cmd_id = 0
+        self.hosts = [] # additional hosts: (name, TBReceiver, subscribed ids)
+
+        # device group queries, devices matching a query are routed by device
+        # id and relayed by the first query they match unless also subscribed
+        # to by id, their cmdId is the query cmdId
+        self.groups = {} # name -> (query cmdId, group dict)
+        self.group_names = {} # query cmdId -> name
+        self.members = {} # query cmdId -> matching device ids
+        self.owners = {} # device id -> query cmdId relaying it
+        subscription_cmd = self._subscribe(ids, self.ids)
+        subscription_cmd[QUERY_CMDS] = self._subscribe_groups(kwargs.get("groups") or {})
+        self.receiver = TBReceiver(subscription_cmd=subscription_cmd, \
+                                   telemetry_callback=self.received_telemetry, \
+                                   device_callback=self.received_devices, \
+                                   query_callback=self.received_query, \
+                                   next_cmd_id=self._next_cmd_id, \
+                                   host=host, user=user, password=password, \
+                                   secure=kwargs.get("secure", True), \
+                                   stats=self.stats)
+
+        # additional hosts, each with its own websocket connection, cmdIds
+        # are unique over all hosts so they share the device registry
+        for info in kwargs.get("hosts") or []:
+            host_ids = []
+            subscription_cmd = self._subscribe(info["ids"], host_ids)
+            receiver = TBReceiver(subscription_cmd=subscription_cmd, \
+                                  telemetry_callback=self.received_telemetry, \
+                                  device_callback=self.received_devices, \
+                                  host=info["host"], user=info["user"], password=info["password"], \
+                                  secure=info.get("secure", True), \
+                                  stats=self.stats)
+            self.hosts.append((info["name"], receiver, host_ids))
+
+    # create relay from shared config, returns None if receive is not configured
+    @staticmethod
+    def from_config(config, **kwargs):
+        ids = config.recv_ids()
+        if len(ids) == 0 and len(config.recv["groups"]) == 0:
+            return None
+        return RecvRelay(config.host, config.user, config.password, ids,
+                         address=config.recv["address"],
+                         port=config.recv["port"],
+                         transport=config.recv["transport"],
+                         listen=config.recv["listen"],
+                         telemetry=config.recv["telemetry"],
+                         prefix=config.recv["prefix"],
+                         attributes=config.recv["attributes"],
+                         groups=config.recv["groups"],
+                         rate=config.recv["rate"],
+                         interpolate=config.recv["interpolate"],
+                         secure=config.secure,
+                         types=config.types,
+                         array_encoding=config.array_encoding,
+                         hosts=config.recv_hosts(),
+                         table=config.table,
+                         verbose=config.verbose,
+                         **kwargs)
+
+    # connect to ThingsBoard and relay telemetry until cancelled or all
+    # receivers exit, hosts are received from and fail independently
+    async def run(self):
+        try:
+            if self.stream: await self.stream.start()
+            await self._start_scheduler()
+            receivers = [self.receiver] + [receiver for _,receiver,_ in self.hosts]
+            results = await asyncio.gather(*[receiver.listen_forever() for receiver in receivers],
+                                           return_exceptions=True)
+            for receiver,result in zip(receivers, results):
+                if isinstance(result, Exception):
+                    print(f"ws {receiver.host} failed: {type(result).__name__} {result}")
+        finally:
+            if self.scheduler:
+                self.scheduler.stop(flush=True)
+                self.scheduler = None
+            if self.stream: self.stream.close()
+            if self.table:
+                self.table.close()
+                self.table = None
+
+    # returns pending OSC stream bytes, 0 for udp
+    def queued(self):
+        return self.stream.queued() if self.stream else 0
+
+    # apply reloaded shared config to the running relay: OSC destination,
+    # message format, and subscribed devices are changed without reconnecting
+    async def reconfigure(self, config):
+        address = config.recv["address"]
+        port = config.recv["port"]
+        transport = config.recv["transport"]
+        listen = config.recv["listen"]
+        if address != self.address or port != self.port or \
+           transport != self.transport or listen != self.listen:
+            self.address = address
+            self.port = port
+            self.transport = transport
+            self.listen = listen
+            self._open_sender()
+            if self.stream: await self.stream.start()
+            print(f"osc {self.address}:{self.port} <- ws {self.host}")
+        self.telemetry = config.recv["telemetry"]
+        rate = config.recv["rate"]
+        interpolate = config.recv["interpolate"]
+        if rate != self.rate or interpolate != self.interpolate:
+            self.rate = rate
+            self.interpolate = interpolate
+            if self.scheduler:
+                self.scheduler.stop(flush=True)
+                self.scheduler = None
+            await self._start_scheduler()
+        if config.types != self.schema.types or config.array_encoding != self.schema.encoding:
+            self.schema = Schema(config.types, config.array_encoding)
+        self.force_prefix = config.recv["prefix"]
+        ids = config.recv_ids()
+        attributes = config.recv["attributes"]
+        groups = config.recv["groups"]
+        if ids != self.ids or attributes != self.attributes or \
+           groups != {name: group for name, (_, group) in self.groups.items()}:
+            queries = self._subscribe_groups(groups)
+            keep = set(ids)
+            for _,_,host_ids in self.hosts: keep.update(host_ids)
+            for members in self.members.values(): keep.update(members)
+            for device in list(self.devices):
+                if device.id not in keep:
+                    self.devices.remove(device)
+                    continue
+                for scope in list(device.scopes or []):
+                    if scope not in attributes:
+                        self.devices.remove_scope(device, scope)
+            self.attributes = list(attributes)
+            self.ids = []
+            subscription_cmd = self._subscribe(ids, self.ids)
+            subscription_cmd[QUERY_CMDS] = queries
+            self._update_owners()
+            await self.receiver.update_subscription(subscription_cmd)
+        self._update_prefix()
+
+    # print device OSC address key to name mappings
+    def print_devices(self):
+        if len(self.devices) > 0:
+            print("device(s)")
+            for device in self.devices:
+                if device.key != None:
+                    print(f"  /{device.key} <- {device.name}")
+
+    # device info callback, matches devices to subscriptions by device id and
+    # sets their names & OSC address keys, names are kept even if not using
+    # device name prefix in case more devices are added later
+    def received_devices(self, devices):
+        for info in devices:
+            device = self.devices.by_id(info["id"]["id"])
+            if device == None: continue
+            name = info["name"]
+            if not self.devices.set_name(device, name):
+                print(f"ignoring duplicate device: {normalize(name)} {name}")
+        if self.verbose: self.print_devices()
+
+    # device group query callback, registers new matching devices by id with
+    # their names and releases devices which no longer match
+    def received_query(self, cmd_id, devices):
+        name = self.group_names.get(cmd_id)
+        if name == None: return
+        members = set()
+        for info in devices:
+            device_id = info["id"]["id"]
+            members.add(device_id)
+            if self.devices.by_id(device_id) != None: continue
+            device = self.devices.add(device_id=device_id)
+            if info["name"] != None and not self.devices.set_name(device, info["name"]):
+                print(f"ignoring duplicate device: {normalize(info['name'])} {info['name']}")
+        previous = self.members.get(cmd_id, set())
+        self.members[cmd_id] = members
+        if members != previous:
+            print(f"group {name}: {len(members)} device(s), "
+                  f"{len(members - previous)} added, {len(previous - members)} removed")
+        self._update_owners()
+        if self.verbose: self.print_devices()
+
+    # telemetry callback, sends key/value pairs as osc messages immediately
+    # or on the next scheduler tick when using a rate
+    # note: converts values using the schema, ignores json keys for now,
+    #       see jsonparser.py & schema.py for details
+    def received_telemetry(self, data):
+        data_entry = data["data"]
+        if data_entry == None:
+            if data["errorCode"] != 0:
+                print(f"telemetry error {data['errorCode']}: {data['errorMsg']}")
+            else:
+                print("telemetry error: data empty, did connection fail?")
+            return
+        stats = self.stats
+        if stats: start = time.perf_counter()
+        device_id = data.get("entityId") # group query update
+        if device_id != None and self.owners.get(device_id) != data["subscriptionId"]:
+            return # relayed by its own subscription or another query
+        prefix = ""
+        if self.prefix:
+            # device name prefix?
+            if device_id != None:
+                device = self.devices.by_id(device_id)
+            else:
+                device = self.devices.by_cmd_id(data["subscriptionId"])
+            if device == None or not device.key:
+                print(f"telemetry warning: received update from unknown device: {data_entry.keys()}")
+                if stats: stats.drops["unknown_device"].inc()
+                return
+            prefix = "/" + device.key
+
+        # convert to list of (address, args)
+        messages = telemetry_to_osc(data_entry, self.schema, prefix, self.telemetry)
+        if self.table:
+            # latest value per key address, also in telemetry mode
+            self.table.update(messages if not self.telemetry else \
+                              telemetry_to_osc(data_entry, self.schema, prefix))
+        if len(messages) == 0: return
+        if stats:
+            now = time.perf_counter()
+            stats.stages["convert"].observe(now - start)
+        if self.scheduler:
+            self.scheduler.update(messages)
+        else:
+            self.send_messages(messages)
+
+    # encode list of (address,args) tuples as a single message or bundle
+    # and send
+    def send_messages(self, messages):
+        stats = self.stats
+        if stats: start = time.perf_counter()
+        if self.tracer:
+            for address,args in messages:
+                self.tracer.trace(address, args, "recv")
+
+        # encode single message or bundle
+        packet = encode_osc(messages, self.schema)
+        if stats:
+            now = time.perf_counter()
+            stats.stages["encode"].observe(now - start)
+            start = now
+
+        # send
+        if self.stream:
+            # not connected or a peer's write buffer is full
+            if not self.stream.send(packet):
+                if stats: stats.drops["backpressure"].inc()
+                return
+        else:
+            try:
+                self.sock.sendto(packet, self.destination)
+            except OSError as exc:
+                print(f"osc send failed: {exc}")
+                if stats: stats.drops["send_failed"].inc()
+                return
+        if stats:
+            stats.stages["send"].observe(time.perf_counter() - start)
+            stats.messages_out.inc(len(messages))
+
+    # (re)open OSC sender for the current address, port, and transport,
+    # streams are started by run() or reconfigure()
+    def _open_sender(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        if self.transport == "tcp":
+            if self.listen:
+                self.stream = OSCStreamServer(self.address, self.port)
+            else:
+                self.stream = OSCStreamClient(self.address, self.port)
+            return
+        family,_,_,_,destination = socket.getaddrinfo(self.address, self.port, type=socket.SOCK_DGRAM)[0]
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.destination = destination
+
+    # start output scheduler on the running loop if using a rate
+    async def _start_scheduler(self):
+        if self.rate > 0:
+            self.scheduler = OutputScheduler(self.rate, self.send_messages, interpolate=self.interpolate)
+            await self.scheduler.start()
+
+    # add device ids to subscribed ids list, assigning new cmdIds to new devices
+    # and attribute scopes, returns subscription command for all devices
+    def _subscribe(self, ids, subscribed_ids):
+        subscription_cmd = {"tsSubCmds": [], "attrSubCmds": []}
+        subscribed = set(subscribed_ids)
+        for device_id in ids:
+            if device_id in subscribed: continue
+            device = self.devices.by_id(device_id)
+            if device == None:
+                device = self.devices.add(device_id=device_id, cmd_id=self.next_cmd_id)
+                self.next_cmd_id += 1
+            subscribed.add(device_id)
+            subscribed_ids.append(device_id)
+            subscription_cmd["tsSubCmds"].append(
+                {
+                    "entityType": "DEVICE",
+                    "entityId": device_id,
+                    "scope": "LATEST_TELEMETRY",
+                    "cmdId": device.cmd_id
+                }
+            )
+            for scope in self.attributes:
+                attr_id = device.scopes.get(scope) if device.scopes else None
+                if attr_id == None:
+                    attr_id = self.next_cmd_id
+                    self.devices.add_scope(device, scope, attr_id)
+                    self.next_cmd_id += 1
+                subscription_cmd["attrSubCmds"].append(
+                    {
+                        "entityType": "DEVICE",
+                        "entityId": device_id,
+                        "scope": scope,
+                        "cmdId": attr_id
+                    }
+                )
+        self._update_prefix()
+        return subscription_cmd
+
+    # returns group query subscription commands, queries of unchanged groups
+    # keep their cmdId, devices of removed or changed groups are released
+    def _subscribe_groups(self, groups):
+        queries = []
+        current = self.groups
+        self.groups = {}
+        self.group_names = {}
+        for name, group in groups.items():
+            if name in current and current[name][1] == group:
+                cmd_id = current[name][0]
+            else:
+                cmd_id = self._next_cmd_id()
+            self.groups[name] = (cmd_id, group)
+            self.group_names[cmd_id] = name
+            entity_filter = TBReceiver.device_filter(group.get("type"), group.get("group"), group.get("name"))
+            queries.append(TBReceiver.entity_query(cmd_id, entity_filter, group["keys"],
+                                                   group.get("page_size", PAGE_SIZE)))
+        for cmd_id in list(self.members):
+            if cmd_id not in self.group_names:
+                del self.members[cmd_id]
+        self._update_prefix()
+        return queries
+
+    # assign each group device to the first query matching it unless it is
+    # subscribed to by id, removes devices which are no longer matched
+    def _update_owners(self):
+        explicit = set(self.ids)
+        for _,_,host_ids in self.hosts: explicit.update(host_ids)
+        owners = {}
+        for cmd_id, members in self.members.items():
+            for device_id in members:
+                if device_id not in explicit and device_id not in owners:
+                    owners[device_id] = cmd_id
+        for device_id in self.owners:
+            if device_id in owners or device_id in explicit: continue
+            device = self.devices.by_id(device_id)
+            if device != None: self.devices.remove(device)
+        self.owners = owners
+
+    # returns a new subscription cmdId
+    def _next_cmd_id(self):
+        cmd_id = self.next_cmd_id
+        self.next_cmd_id += 1
+        return cmd_id
+
+    # use device name prefix if forced or receiving from multiple devices
+    # or device groups
+    def _update_prefix(self):
+        count = len(self.ids) + sum(len(host_ids) for _,_,host_ids in self.hosts)
+        self.prefix = self.force_prefix or count > 1 or len(self.groups) > 0
@@ -0,0 +1,430 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2022 ZKM | Hertz-Lab
+# Dan Wilcox <dan.wilcox@zkm.de>
+#
+# BSD Simplified License.
+# For information on usage and redistribution, and for a DISCLAIMER OF ALL
+# WARRANTIES, see the file, "LICENSE.txt," in this distribution.
+#
+# This code has been developed at ZKM | Hertz-Lab as part of „The Intelligent
+# Museum“ generously funded by the German Federal Cultural Foundation.
+#
+# References:
+# * https://github.com/attwad/python-osc
+
+import asyncio
+import fnmatch
+import time
+
+from pythonosc.dispatcher import Dispatcher
+from pythonosc.osc_server import AsyncIOOSCUDPServer
+
+from .TBSender import TBSender
+from .osctcp import OSCStreamServer
+from .aggregate import Aggregator
+from .capture import CaptureWriter
+from .registry import Registry, normalize
+from .config import DEFAULT_HOST
+from .oscparser import osc_to_json
+from .schema import Schema
+from .metrics import RelayStats
+from .trace import Tracer
+
+# OSC -> ThingsBoard MQTT relay
+class SendRelay:
+
+    # init with
+    # * host: str, ThingsBoard server hostname, ie. thingsboard.mydomain.com
+    # * token: str, device access token, must be a gateway device if using devices
+    # additional options:
+    # * names: str list, device names as shown in ThingsBoard UI, requires gateway
+    # * address: str, OSC receive address, default: 127.0.0.1
+    # * port: int, OSC receive port, default: 7777
+    # * transport: str, OSC transport: udp or tcp (SLIP framed), default: udp
+    # * mqtt_port: int, ThingsBoard MQTT port, default: 1883
+    # * types: dict, value types by key, see schema.py
+    # * array_encoding: str, ThingsBoard packed array encoding, see schema.py
+    # * attributes: str list, OSC addresses or patterns without the device
+    #   prefix, ie. "/mode" or "/config/*", sent as client-side attributes
+    #   instead of telemetry
+    # * aggregate: dict, send statistics per window for keys instead of
+    #   every value, see aggregate.py, keys are: keys, window, stats, size
+    # * hosts: dict list, additional ThingsBoard hosts to also send to, keys
+    #   are: name, host, token, mqtt_port, names (gateway device names),
+    #   all hosts must either use gateway devices or not
+    # * capture: dict, record received OSC packets to a capture log, see
+    #   capture.py, keys are: path, segment_size, segments
+    # * routes: dict, host names by OSC address device prefix, ie. "/dev1",
+    #   or "*" for all other prefixes, default: all hosts, the main host is
+    #   named "default"
+    # * verbose: bool, print received messages?
+    # * tracer: Tracer, message tracer, default: stdout tracer if verbose
+    # * metrics: Metrics, metrics registry, None disables instrumentation
+    def __init__(self, host, token, **kwargs):
+        self.host = host
+        self.address = kwargs.get("address") or "127.0.0.1"
+        self.port = kwargs.get("port") or 7777
+        self.transport = kwargs.get("transport") or "udp"
+        self.verbose = kwargs.get("verbose") or False
+        self.tracer = kwargs.get("tracer") or Tracer.create(None, self.verbose)
+        self.schema = Schema(kwargs.get("types"), kwargs.get("array_encoding"))
+        self.attributes = list(kwargs.get("attributes") or [])
+        self.attribute_cache = {} # address -> send as attributes?
+
+        # gateway devices by OSC address key & name
+        self.devices = Registry()
+        for name in kwargs.get("names") or []:
+            self.add_device(name, name)
+
+        self.sender = TBSender(SendRelay.mqtt_host(host), token, \
+                               port=kwargs.get("mqtt_port"), \
+                               values_stringified=False, \
+                               gateway=(len(self.devices) > 0), \
+                               gateway_devices=[device.name for device in self.devices], \
+                               connect_callback=self._connected)
+        self.server = None # UDP transport or OSCStreamServer
+        self.aggregate = kwargs.get("aggregate") or {}
+        self.aggregator = self._create_aggregator()
+        self.capture = None
+        capture = kwargs.get("capture") or {}
+        if capture.get("path", "") != "":
+            self.capture = CaptureWriter(capture["path"], segment_size=capture.get("segment_size"),
+                                         segments=capture.get("segments"))
+
+        # send hosts, the main host first, each with its own MQTT connection
+        self.targets = [_Target(DEFAULT_HOST, host, self.sender, self.devices)]
+        self.targets[0].connected = True # connected by connect()
+        for info in kwargs.get("hosts") or []:
+            self._add_target(info)
+        self.host_routes = {} # OSC address device prefix -> targets
+        self.default_targets = self.targets # targets for unrouted prefixes
+        self._set_routes(kwargs.get("routes") or {})
+        self.connector = None # extra host (re)connection task
+
+        # metrics
+        self.stats = None
+        self.connects = 0
+        metrics = kwargs.get("metrics")
+        if metrics:
+            self.stats = RelayStats(metrics, "send", ("decode", "convert", "publish"))
+            self.stats.queue("mqtt", lambda: SendRelay._queued(self.sender))
+            for target in self.targets[1:]:
+                self.stats.queue(f"mqtt_{target.name}", lambda target=target: SendRelay._queued(target.sender))
+
+    # create relay from shared config, returns None if send is not configured
+    @staticmethod
+    def from_config(config, **kwargs):
+        if config.send["token"] == "":
+            return None
+        return SendRelay(config.host, config.send["token"],
+                         names=config.send_names(),
+                         address=config.send["address"],
+                         port=config.send["port"],
+                         transport=config.send["transport"],
+                         attributes=config.send["attributes"],
+                         mqtt_port=config.send["mqtt_port"],
+                         types=config.types,
+                         array_encoding=config.array_encoding,
+                         aggregate=config.aggregate,
+                         capture=config.capture,
+                         hosts=config.send_hosts(),
+                         routes=config.routes,
+                         verbose=config.verbose,
+                         **kwargs)
+
+    # connect to the main ThingsBoard host, returns True on success,
+    # additional hosts are connected in the background by start()
+    def connect(self):
+        return self.sender.connect()
+
+    # start OSC receiver and aggregator on the running event loop
+    async def start(self):
+        if self.aggregator and not self.aggregator.task:
+            await self.aggregator.start()
+        if len(self.targets) > 1 and not self.connector:
+            self.connector = asyncio.create_task(self._connect_hosts())
+        dispatcher = _CaptureDispatcher(self.capture) if self.capture else Dispatcher()
+        dispatcher.set_default_handler(self.received_osc)
+        if self.transport == "tcp":
+            self.server = OSCStreamServer(self.address, self.port, callback=dispatcher.call_handlers_for_packet)
+            await self.server.start()
+        else:
+            server = AsyncIOOSCUDPServer((self.address, self.port), dispatcher, asyncio.get_running_loop())
+            self.server, _ = await server.create_serve_endpoint()
+
+    # apply reloaded shared config to the running relay: the OSC receiver is
+    # restarted if the address, port, or transport changed and gateway devices are
+    # connected or disconnected, the MQTT connection is kept
+    async def reconfigure(self, config):
+        if config.types != self.schema.types or config.array_encoding != self.schema.encoding:
+            self.schema = Schema(config.types, config.array_encoding)
+        if config.send["attributes"] != self.attributes:
+            self.attributes = list(config.send["attributes"])
+            self.attribute_cache = {}
+        if config.routes != self.routes_config:
+            self._set_routes(config.routes)
+        if config.aggregate != self.aggregate:
+            self.aggregate = config.aggregate
+            if self.aggregator: self.aggregator.stop() # flush
+            self.aggregator = self._create_aggregator()
+            if self.aggregator: await self.aggregator.start()
+        address = config.send["address"]
+        port = config.send["port"]
+        transport = config.send["transport"]
+        if address != self.address or port != self.port or transport != self.transport:
+            self.address = address
+            self.port = port
+            self.transport = transport
+            if self.server:
+                self.server.close()
+                self.server = None
+                await self.start()
+                print(f"osc {self.address}:{self.port} -> mqtt {self.host}")
+        devices = {}
+        for name in config.send_names():
+            key = normalize(name)
+            if key not in devices: devices[key] = name
+        if devices == {device.key: device.name for device in self.devices}: return
+        if not self.sender.gateway:
+            print("changing send devices requires a restart when not using a gateway")
+            return
+        if len(devices) == 0:
+            print("removing all send devices requires a restart when using a gateway")
+            return
+        for device in list(self.devices):
+            if devices.get(device.key) != device.name:
+                self.devices.remove(device)
+                self.sender.remove_device(device.name)
+        for key, name in devices.items():
+            if self.devices.by_key(key) == None:
+                self.add_device(key, name)
+                self.sender.add_device(name)
+        if self.verbose: self.print_devices()
+
+    # stop OSC receiver, flush aggregated values, and disconnect from ThingsBoard
+    def stop(self):
+        if self.server:
+            self.server.close()
+            self.server = None
+        if self.connector:
+            self.connector.cancel()
+            self.connector = None
+        if self.aggregator:
+            self.aggregator.stop()
+            self.aggregator = None
+        if self.capture:
+            self.capture.close()
+            print(f"captured {self.capture.packets} packets to {self.capture.path}")
+            self.capture = None
+        for target in self.targets:
+            if target.connected: target.sender.disconnect()
+
+    # osc message callback, send osc messages as json telemetry or attributes
+    # see oscparser.py for conversion details
+    def received_osc(self, address, *args):
+        stats = self.stats
+        if stats:
+            stats.messages_in.inc()
+            start = time.perf_counter()
+        if self.tracer:
+            self.tracer.trace(address, args, "send")
+        key = None # device prefix, used for routing
+        if self.sender.gateway:
+            # using gateway: filter first address component as device name prefix
+            components = address.split("/")
+            if len(components) < 3: # need min of: / prefix / key
+                print(f"invalid osc address: {address}")
+                if stats: stats.drops["invalid_address"].inc()
+                return
+            key = components[1]
+            if not any(target.devices.by_key(key) for target in self._route(key)):
+                print(f"unknown device: {key}")
+                if stats: stats.drops["unknown_device"].inc()
+                return
+            address = "/" + "/".join(components[2:])
+        elif len(self.host_routes) > 0:
+            # routing without gateway: first address component is kept
+            key = address.split("/", 2)[1]
+        if stats:
+            now = time.perf_counter()
+            stats.stages["decode"].observe(now - start)
+            start = now
+        data = osc_to_json(address, list(args), self.schema)
+        if data == None:
+            if stats: stats.drops["invalid_address"].inc()
+            return
+        attribute = self.attributes and self._is_attribute(address)
+        if self.aggregator and not attribute:
+            data = self.aggregator.add(data, key)
+            if data == None: # all values aggregated
+                if stats: stats.stages["convert"].observe(time.perf_counter() - start)
+                return
+        if stats:
+            now = time.perf_counter()
+            stats.stages["convert"].observe(now - start)
+            start = now
+        sent = self._publish(data, key, attribute)
+        if stats:
+            stats.stages["publish"].observe(time.perf_counter() - start)
+            if sent: stats.messages_out.inc()
+
+    # send telemetry or attributes data to the hosts routed for device prefix
+    # key, decoded data is shared by all hosts, returns True if sent to any
+    # host, failures are counted per host
+    def _publish(self, data, key, attribute=False):
+        sent = False
+        for target in self._route(key):
+            name = None
+            if target.sender.gateway:
+                device = target.devices.by_key(key)
+                if device == None: continue # not sent to this host
+                name = device.name
+            if not target.connected:
+                ok = False
+            elif attribute:
+                ok = target.sender.send_attributes(data, device_name=name)
+            else:
+                ok = target.sender.send_telemetry(data, device_name=name)
+            if ok:
+                sent = True
+            elif self.stats:
+                self.stats.drops["send_failed"].inc()
+        return sent
+
+    # returns list of send hosts for device prefix key
+    def _route(self, key):
+        if key == None or len(self.host_routes) == 0:
+            return self.default_targets
+        return self.host_routes.get(key, self.default_targets)
+
+    # returns True if address (without device prefix) is sent as attributes,
+    # cached per address
+    def _is_attribute(self, address):
+        attribute = self.attribute_cache.get(address)
+        if attribute == None:
+            attribute = any(fnmatch.fnmatchcase(address, p) for p in self.attributes)
+            if len(self.attribute_cache) >= 4096: self.attribute_cache.clear()
+            self.attribute_cache[address] = attribute
+        return attribute
+
+    # aggregated statistics callback, aggregated per device prefix key
+    def _send_aggregated(self, data, key):
+        if self._publish(data, key) and self.stats:
+            self.stats.messages_out.inc()
+
+    # set routes from host names by OSC address device prefix or "*",
+    # routes to unknown hosts or hosts without a token are ignored
+    def _set_routes(self, routes):
+        self.routes_config = dict(routes)
+        targets = {target.name: target for target in self.targets}
+        self.host_routes = {}
+        self.default_targets = self.targets
+        for prefix, names in routes.items():
+            routed = [targets[name] for name in names if name in targets]
+            if len(routed) < len(names):
+                print(f"route {prefix}: ignoring unknown send host(s)")
+            if prefix == "*":
+                self.default_targets = routed
+            else:
+                self.host_routes[prefix.strip("/")] = routed
+
+    # add additional send host from host info dict, see init
+    def _add_target(self, info):
+        names = info.get("names") or []
+        if (len(names) > 0) != self.sender.gateway:
+            print(f"ignoring send host {info['name']}: hosts must either all use gateway device names or none")
+            return
+        devices = Registry()
+        for name in names:
+            if devices.add(name) == None:
+                print(f"ignoring duplicate device: {normalize(name)} {name}")
+        sender = TBSender(SendRelay.mqtt_host(info["host"]), info["token"], \
+                          port=info.get("mqtt_port"), \
+                          values_stringified=False, \
+                          gateway=(len(devices) > 0), \
+                          gateway_devices=[device.name for device in devices])
+        self.targets.append(_Target(info["name"], info["host"], sender, devices))
+
+    # connect additional hosts outside of the event loop, retrying failed
+    # connections, each host has its own MQTT client which reconnects by
+    # itself once connected, so a failing host does not affect the others
+    async def _connect_hosts(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [target for target in self.targets if not target.connected]
+            if len(pending) == 0: break
+            for target in pending:
+                if await loop.run_in_executor(None, target.sender.connect):
+                    target.connected = True
+                    print(f"mqtt {target.name} {target.host} connected")
+            await asyncio.sleep(5)
+
+    # returns aggregator for the aggregate config or None if no keys are set
+    def _create_aggregator(self):
+        if len(self.aggregate.get("keys", [])) == 0:
+            return None
+        return Aggregator(self.aggregate["keys"], self._send_aggregated,
+                          window=self.aggregate.get("window"),
+                          stats=self.aggregate.get("stats"),
+                          size=self.aggregate.get("size"))
+
+    # MQTT (re)connect callback, called from the MQTT client thread
+    def _connected(self):
+        self.connects += 1
+        if self.connects > 1 and self.stats:
+            self.stats.reconnects.inc()
+
+    # add device name to known devices by OSC address key prefix,
+    # key will be stripped on non alphanumeric chars and made lowercase
+    def add_device(self, key, name):
+        key = normalize(key)
+        if self.devices.add(name, key=key) == None:
+            print(f"ignoring duplicate device: {key} {name}")
+
+    # print device OSC address key to name mappings
+    def print_devices(self):
+        if len(self.devices) > 0:
+            print("device(s)")
+            for device in self.devices:
+                print(f"  /{device.key} -> {device.name}")
+        for target in self.targets[1:]:
+            print(f"host {target.name}: {target.host}")
+            for device in target.devices:
+                print(f"  /{device.key} -> {device.name}")
+        for key, targets in self.host_routes.items():
+            print(f"route /{key} -> {' '.join(target.name for target in targets)}")
+
+    # returns MQTT host name for host, host may include an HTTP port suffix
+    # when shared with the receive side, MQTT uses its own port
+    @staticmethod
+    def mqtt_host(host):
+        return host.split(":")[0] if host.count(":") == 1 else host
+
+    # returns number of MQTT messages queued by sender, for the queue metrics
+    # note: reads the paho client outgoing queue, not part of the public API
+    @staticmethod
+    def _queued(sender):
+        return len(sender.thingsboard._client._out_messages)
+
+# send host with its own MQTT sender and gateway devices
+class _Target:
+    __slots__ = ("name", "host", "sender", "devices", "connected")
+
+    def __init__(self, name, host, sender, devices):
+        self.name = name # host name in routes
+        self.host = host
+        self.sender = sender
+        self.devices = devices # gateway devices by OSC address key
+        self.connected = False
+
+# OSC dispatcher which records each received packet before dispatching
+class _CaptureDispatcher(Dispatcher):
+
+    def __init__(self, capture):
+        super().__init__()
+        self.capture = capture
+
+    def call_handlers_for_packet(self, data, client_address):
+        self.capture.write(data)
+        return super().call_handlers_for_packet(data, client_address)
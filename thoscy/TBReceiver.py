@@ -14,39 +14,83 @@
 # * https://thingsboard.io/docs/user-guide/telemetry/
 # * https://thingsboard.io/docs/reference/rest-api/
 
+from collections import deque
 import asyncio
+import itertools
+import time
 
 # websocket comm
-import websockets
+# note: websockets & requests are imported when first used to keep startup fast
 import socket
 import json
 
-# REST API comm
-import requests
-
 import logging
 logger = logging.getLogger(__name__)
 
+# subscription command lists: telemetry & attributes
+SUB_CMDS = ("tsSubCmds", "attrSubCmds")
+
+# entity data query subscription commands & unsubscribe commands
+QUERY_CMDS = "entityDataCmds"
+QUERY_UNSUB_CMDS = "entityDataUnsubscribeCmds"
+
+# default entity data query page size
+PAGE_SIZE = 100
+
+# default max buffered updates
+BUFFER_SIZE = 1024
+
 # ThingsBoard WebSocket receiver
 # based on WSClient by Pietro Grandinetti:
 # https://gist.github.com/pgrandinetti/964747a9f2464e576b8c6725da12c1eb
+#
+# updates are received on the running loop as an async iterator:
+#
+#   async with TBReceiver(subscription_cmd, None, host, user, password) as rx:
+#       async for update in rx:
+#           print(update["data"])
+#
+# or passed to the telemetry callback by listen_forever(), which iterates
+# the same way
+#
+# received updates are buffered until the iterator takes them, when the
+# buffer is full, the websocket is not read until there is space again
 class TBReceiver: 
 
     # init with
     # * host: str, ThingsBoard server hostname, ie. thingsboard.mydomain.com
     # * user credentials: str, username & password
     # * subscription command: dict, subscription command JSON payload to receive
-    #   specific telemetry updates, see WebSocket API section at
+    #   specific telemetry updates (tsSubCmds) and/or attribute updates
+    #   (attrSubCmds, see config.ATTRIBUTE_SCOPES), and/or telemetry of all devices
+    #   matching an entity data query (entityDataCmds, see entity_query()),
+    #   see WebSocket API section at
     #   https://thingsboard.io/docs/user-guide/telemetry/
-    # * telemetry_callback: function, called when a subscription update is received,
-    #   format: function(data) where data is a dictionary containing the message payload
+    # * telemetry_callback: function, called by listen_forever() when a
+    #   telemetry or attribute subscription update is received, format:
+    #   function(data) where data is a dictionary containing the message
+    #   payload, query updates are passed per device in the same format with
+    #   an additional "entityId" key, may be None when iterating
     # additional options:
+    # * buffer_size: int, max updates buffered for the iterator, default: 1024
+    # * batch: bool, iterate over lists of all updates buffered per wakeup
+    #   instead of single updates?
     # * device_callback: function, called after initial connect,
     #   format: function(info) where info is a list of device dicts, one for each subscription 
+    # * query_callback: function, called when the devices matching an entity
+    #   data query change, format: function(cmd_id, devices) where cmd_id is
+    #   the query's cmdId and devices is a list of all matching device dicts
+    #   with "id" and "name" keys as returned by fetch_devices()
+    # * next_cmd_id: function, returns a new unique cmdId for additional query
+    #   pages, default: counting up from 100000
     # * values_stringified: bool, are complex JSON values as stored as strings?
-    # * reply_timeout: int seconds, subscription reply timeout
-    # * ping_timeout: int seconds, length between keep alive pings
+    # * secure: bool, use https & wss (default) or http & ws?
+    # * reply_timeout: int seconds, interval between keep alive pings
+    # * ping_timeout: int seconds, keep alive pong timeout before reconnecting
+    # * idle_timeout: int seconds, reconnect if no updates are received within
+    #   this time, 0 disables (default)
     # * sleep_time: int seconds, sleep between retrying connection on error
+    # * stats: RelayStats, metrics handles, None disables instrumentation
     def __init__(self, subscription_cmd, telemetry_callback, host, user, password, **kwargs):
         # required
         self.host = host
@@ -56,54 +100,140 @@ class TBReceiver:
         self.telemetry_callback = telemetry_callback
         # optional
         self.device_callback = kwargs.get("device_callback") or None
+        self.query_callback = kwargs.get("query_callback") or None
+        self.next_cmd_id = kwargs.get("next_cmd_id") or itertools.count(100000).__next__
         self.values_stringified = kwargs.get("values_stringified") or True
+        self.secure = kwargs.get("secure", True)
         self.reply_timeout = kwargs.get("reply_timeout") or 10
         self.ping_timeout = kwargs.get("ping_timeout") or 5
+        self.idle_timeout = kwargs.get("idle_timeout") or 0
         self.sleep_time = kwargs.get("sleep_time") or 5
+        self.received = 0 # number of received frames, checked by idle watchdog
+        self.ws = None # open websocket
+        self.token = None # current access token
+        self.stats = kwargs.get("stats") or None
+        self.queries = {} # query cmdId -> _Query
+        self.pages = {} # query page cmdId -> (_Query, page index)
+        self.buffer_size = kwargs.get("buffer_size") or BUFFER_SIZE
+        self.batch = kwargs.get("batch") or False
+        self.buffer = deque() # received updates
+        self.ready = None # set when updates are buffered or the receiver stopped
+        self.space = None # set when the buffer has space
+        self.stopped = True # no more updates until restarted
+        self.task = None # connection task
+
+    # connect and receive on the running loop, returns self
+    async def __aenter__(self):
+        self.buffer.clear()
+        self.ready = asyncio.Event()
+        self.space = asyncio.Event()
+        self.stopped = False
+        self.task = asyncio.create_task(self._listen())
+        return self
+
+    # disconnect, buffered updates are discarded
+    async def __aexit__(self, *exc):
+        task = self.task
+        self.task = None
+        if task:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self.buffer.clear()
+        return False
+
+    def __aiter__(self):
+        return self
+
+    # returns next update or list of updates if batching, stops when the
+    # connection failed permanently
+    async def __anext__(self):
+        return await self._next(self.batch)
+
+    # connect to server and pass received updates to the telemetry callback
+    # until cancelled or the connection failed permanently, attempts
+    # reconnection on failure
+    async def listen_forever(self):
+        callback = self.telemetry_callback
+        async with self:
+            while True:
+                try:
+                    updates = await self._next(True)
+                except StopAsyncIteration:
+                    return
+                for data in updates:
+                    callback(data)
+
+    # returns next update or list of all buffered updates,
+    # raises StopAsyncIteration when stopped and the buffer is empty
+    async def _next(self, batch):
+        buffer = self.buffer
+        while len(buffer) == 0:
+            if self.stopped: raise StopAsyncIteration
+            self.ready.clear()
+            await self.ready.wait()
+        if batch:
+            updates = list(buffer)
+            buffer.clear()
+        else:
+            updates = buffer.popleft()
+        self.space.set()
+        return updates
+
+    # buffer received update, waits for space if the buffer is full
+    async def _put(self, data):
+        buffer = self.buffer
+        while len(buffer) >= self.buffer_size:
+            self.space.clear()
+            await self.space.wait()
+        buffer.append(data)
+        self.ready.set()
+
+    # connection task, wakes the iterator when done
+    async def _listen(self):
+        try:
+            await self._connect_forever()
+        finally:
+            self.stopped = True
+            self.ready.set()
 
     # connect to server and receive telemetry events,
     # attempts reconnection on failure
-    async def listen_forever(self):
+    # note: keep alive pings are handled by the websockets library
+    async def _connect_forever(self):
+        import websockets
+        connects = 0
         while True:
             # outer loop restarted every time the connection fails
             logger.debug("creating new connection...")
+            if connects > 0 and self.stats: self.stats.reconnects.inc()
+            connects += 1
+            loop = asyncio.get_running_loop()
             try:
-               token, _ = TBReceiver.fetch_tokens(self.host, self.user, self.password)
-               url = "wss://" + self.host + "/api/ws/plugins/telemetry?token=" + token
-               async with websockets.connect(url) as ws:
-                    # send the subscription
+               # REST requests are blocking, run outside of the event loop
+               token, _ = await loop.run_in_executor(None, TBReceiver.fetch_tokens,
+                   self.host, self.user, self.password, self.secure)
+               self.token = token
+               url = ("wss://" if self.secure else "ws://") + self.host + \
+                     "/api/ws/plugins/telemetry?token=" + token
+               async with websockets.connect(url, ping_interval=self.reply_timeout,
+                                             ping_timeout=self.ping_timeout) as ws:
+                    # send the subscription, query pages after the
+                    # first are subscribed again as they are reported
+                    self._reset_queries()
                     await ws.send(json.dumps(self.subscription_cmd))
+                    self.ws = ws
                     # fetch device info?
-                    if self.device_callback:
-                        try:
-                            device_ids = []
-                            for sub in self.subscription_cmd["tsSubCmds"]:
-                                if sub["entityType"] == "DEVICE":
-                                    device_ids.append(sub["entityId"])
-                            devices = TBReceiver.fetch_devices(self.host, token, device_ids)
-                            if devices: self.device_callback(devices)
-                        except Exception as exc:
-                            logger.warning(f"fetching devices failed: {exc}")
-                            pass
+                    await self._fetch_devices(TBReceiver.subscriptions(self.subscription_cmd))
                     # listener loop
-                    while True:
-                        try:
-                            reply = await asyncio.wait_for(ws.recv(), timeout=self.reply_timeout)
-                        except (asyncio.TimeoutError, websockets.exceptions.ConnectionClosed):
-                            try:
-                                pong = await ws.ping()
-                                await asyncio.wait_for(pong, timeout=self.ping_timeout)
-                                logger.debug("ping ok, keeping connection alive...")
-                                continue
-                            except:
-                                logger.error(f"ping error, retrying connection in {self.sleep_time} s")
-                                await asyncio.sleep(self.sleep_time)
-                                break
-                        logger.debug(f"server said: {reply}")
-                        data = json.loads(reply)
-                        if self.values_stringified:
-                            data["data"] = TBReceiver.parse_values(data["data"])
-                        self.telemetry_callback(data)
+                    try:
+                        await self.receive(ws)
+                    finally:
+                        self.ws = None
+                    logger.error(f"connection lost, retrying connection in {self.sleep_time} s")
+                    await asyncio.sleep(self.sleep_time)
             except socket.gaierror:
                 logger.error(f"socket error, retrying connection in {self.sleep_time} s")
                 await asyncio.sleep(self.sleep_time)
@@ -118,7 +248,245 @@ class TBReceiver:
                 logger.error(exc)
                 break
 
-    # async thread run helper
+    # replace the subscription command, changes are sent on the open
+    # connection by subscribing added and unsubscribing removed tsSubCmds,
+    # attrSubCmds, & entityDataCmds entries by cmdId, otherwise they are used
+    # on the next connect
+    async def update_subscription(self, subscription_cmd):
+        previous = self.subscription_cmd
+        self.subscription_cmd = subscription_cmd
+        ws = self.ws
+        if not ws:
+            self._reset_queries()
+            return
+        cmd = {}
+        added = []
+        for name in SUB_CMDS:
+            current = {sub["cmdId"]: sub for sub in previous.get(name, [])}
+            updated = {sub["cmdId"]: sub for sub in subscription_cmd.get(name, [])}
+            new = [sub for cmd_id, sub in updated.items() if cmd_id not in current]
+            removed = [dict(sub, unsubscribe=True) for cmd_id, sub in current.items() if cmd_id not in updated]
+            if len(new) > 0 or len(removed) > 0:
+                cmd[name] = removed + new
+                added += new
+        updated = {sub["cmdId"]: sub for sub in subscription_cmd.get(QUERY_CMDS, [])}
+        new = [sub for cmd_id, sub in updated.items() if cmd_id not in self.queries]
+        removed = [cmd_id for cmd_id in self.queries if cmd_id not in updated]
+        if len(removed) > 0:
+            cmd[QUERY_UNSUB_CMDS] = [{"cmdId": page} for cmd_id in removed for page in self._remove_query(cmd_id)]
+        if len(new) > 0:
+            for sub in new:
+                self._add_query(sub)
+            cmd[QUERY_CMDS] = new
+        if len(cmd) == 0: return
+        try:
+            await ws.send(json.dumps(cmd))
+        except Exception as exc:
+            # connection lost, the new subscription is sent when reconnecting
+            logger.warning(f"updating subscription failed: {exc}")
+            return
+        await self._fetch_devices(added)
+
+    # fetch device info for the DEVICE entries in subscription list and
+    # pass to device callback, if set
+    async def _fetch_devices(self, subs):
+        if not self.device_callback: return
+        device_ids = []
+        for sub in subs:
+            if sub["entityType"] == "DEVICE" and sub["entityId"] not in device_ids:
+                device_ids.append(sub["entityId"])
+        if len(device_ids) == 0: return
+        try:
+            devices = await asyncio.get_running_loop().run_in_executor(None,
+                TBReceiver.fetch_devices, self.host, self.token, device_ids, self.secure)
+            if devices: self.device_callback(devices)
+        except Exception as exc:
+            logger.warning(f"fetching devices failed: {exc}")
+
+    # receive telemetry frames from an open websocket into the buffer until it
+    # is closed, the idle watchdog (if enabled) runs on its own timer so the per-frame
+    # cost is only a counter increment
+    async def receive(self, ws):
+        import websockets
+        watchdog = None
+        if self.idle_timeout > 0:
+            watchdog = asyncio.create_task(self._watch_idle(ws))
+        try:
+            stats = self.stats
+            buffer = self.buffer
+            ready = self.ready
+            async for reply in ws:
+                self.received += 1
+                if stats:
+                    stats.messages_in.inc()
+                    start = time.perf_counter()
+                logger.debug(f"server said: {reply}")
+                data = json.loads(reply)
+                if "subscriptionId" not in data:
+                    # entity data query reply, ignore unsubscribed pages
+                    page = self.pages.get(data.get("cmdId"))
+                    if page: await self._received_query(ws, data, page[0], page[1])
+                    if stats: stats.stages["decode"].observe(time.perf_counter() - start)
+                    continue
+                if self.values_stringified and data.get("data"):
+                    data["data"] = TBReceiver.parse_values(data["data"])
+                if stats: stats.stages["decode"].observe(time.perf_counter() - start)
+                if len(buffer) >= self.buffer_size:
+                    await self._put(data)
+                else:
+                    buffer.append(data)
+                    ready.set()
+        except websockets.exceptions.ConnectionClosedError as exc:
+            logger.error(f"connection closed: {exc}")
+        finally:
+            if watchdog: watchdog.cancel()
+
+    # idle watchdog, closes the connection if no frames were received
+    # within the idle timeout
+    async def _watch_idle(self, ws):
+        last = self.received
+        while True:
+            await asyncio.sleep(self.idle_timeout)
+            if self.received == last:
+                logger.error(f"no updates within {self.idle_timeout} s, closing connection")
+                await ws.close()
+                return
+            last = self.received
+
+    # entity data query page reply: follows the page count and device
+    # membership, then passes the latest values of each device in the page
+    # data or update to the telemetry callback with the query cmdId as
+    # subscriptionId
+    #
+    # ThingsBoard sends the page data on subscribe and again whenever the
+    # query result changes and sends value updates for the devices in a page,
+    # pages are subscribed while the previous page reports more, extra pages
+    # are unsubscribed when the result shrinks
+    async def _received_query(self, ws, data, query, page):
+        if data.get("errorCode"):
+            logger.error(f"query {query.cmd_id} error {data['errorCode']}: {data.get('errorMsg')}")
+            return
+        entities = data.get("update")
+        page_data = data.get("data")
+        if page_data != None:
+            entities = page_data.get("data", [])
+            devices = {}
+            for entity in entities:
+                device_id = entity["entityId"]["id"]
+                name = entity.get("latest", {}).get("ENTITY_FIELD", {}).get("name", {}).get("value")
+                devices[device_id] = {"id": entity["entityId"], "name": name}
+            query.members[page] = devices
+            cmd = {}
+            if page_data.get("hasNext") and page + 1 == len(query.page_ids):
+                sub = TBReceiver._query_page(query.sub, self.next_cmd_id(), page + 1)
+                query.page_ids.append(sub["cmdId"])
+                self.pages[sub["cmdId"]] = (query, page + 1)
+                cmd[QUERY_CMDS] = [sub]
+            elif not page_data.get("hasNext") and page + 1 < len(query.page_ids):
+                extra = query.page_ids[page + 1:]
+                del query.page_ids[page + 1:]
+                for extra_id in extra:
+                    self.pages.pop(extra_id, None)
+                query.members = {index: members for index, members in query.members.items() if index <= page}
+                cmd[QUERY_UNSUB_CMDS] = [{"cmdId": extra_id} for extra_id in extra]
+            if len(cmd) > 0:
+                try:
+                    await ws.send(json.dumps(cmd))
+                except Exception as exc:
+                    logger.warning(f"updating query {query.cmd_id} pages failed: {exc}")
+            if self.query_callback:
+                self.query_callback(query.cmd_id,
+                    [device for members in query.members.values() for device in members.values()])
+        for entity in entities or []:
+            series = entity.get("latest", {}).get("TIME_SERIES")
+            if not series: continue
+            values = {key: [[value["ts"], value["value"]]] for key, value in series.items()}
+            if self.values_stringified:
+                values = TBReceiver.parse_values(values)
+            await self._put({"subscriptionId": query.cmd_id, "entityId": entity["entityId"]["id"],
+                             "errorCode": 0, "errorMsg": None, "data": values})
+
+    # (re)start tracking the entity data queries in the subscription command
+    # with only their first pages subscribed, previous members are kept until
+    # the first page data arrives
+    def _reset_queries(self):
+        queries = {}
+        self.pages = {}
+        for sub in self.subscription_cmd.get(QUERY_CMDS, []):
+            query = _Query(sub)
+            previous = self.queries.get(query.cmd_id)
+            if previous: query.members = previous.members
+            queries[query.cmd_id] = query
+            self.pages[query.cmd_id] = (query, 0)
+        self.queries = queries
+
+    # track entity data query subscription
+    def _add_query(self, sub):
+        query = _Query(sub)
+        self.queries[query.cmd_id] = query
+        self.pages[query.cmd_id] = (query, 0)
+
+    # stop tracking entity data query, returns its page cmdIds
+    def _remove_query(self, cmd_id):
+        query = self.queries.pop(cmd_id)
+        for page_id in query.page_ids:
+            self.pages.pop(page_id, None)
+        return query.page_ids
+
+    # returns list of all telemetry & attribute subscriptions in command
+    @staticmethod
+    def subscriptions(subscription_cmd):
+        subs = []
+        for name in SUB_CMDS:
+            subs += subscription_cmd.get(name, [])
+        return subs
+
+    # returns entity data query subscription command for the latest
+    # telemetry of the devices matching a device filter, see device_filter(),
+    # as entityDataCmds entry
+    #
+    # the device name entity field is requested along with the telemetry
+    # keys, so query members do not need to be fetched separately
+    @staticmethod
+    def entity_query(cmd_id, entity_filter, keys, page_size=PAGE_SIZE):
+        latest = [{"type": "TIME_SERIES", "key": key} for key in keys]
+        return {
+            "cmdId": cmd_id,
+            "query": {
+                "entityFilter": entity_filter,
+                "pageLink": {
+                    "pageSize": page_size,
+                    "page": 0,
+                    "sortOrder": {"key": {"type": "ENTITY_FIELD", "key": "createdTime"}, "direction": "ASC"}
+                },
+                "entityFields": [{"type": "ENTITY_FIELD", "key": "name"}],
+                "latestValues": latest
+            },
+            "latestCmd": {"keys": latest}
+        }
+
+    # returns entity data query filter for devices by type, entity group id,
+    # or name, name is a name prefix and is combined with type if both
+    # are given, returns None if nothing is given
+    # note: entity group filters require ThingsBoard PE
+    @staticmethod
+    def device_filter(device_type=None, group=None, name=None):
+        if group:
+            return {"type": "entityGroup", "groupType": "DEVICE", "entityGroup": group}
+        if device_type:
+            return {"type": "deviceType", "deviceType": device_type, "deviceNameFilter": name or ""}
+        if name:
+            return {"type": "entityName", "entityType": "DEVICE", "entityNameFilter": name}
+        return None
+
+    # returns copy of entity data query command for another page
+    @staticmethod
+    def _query_page(sub, cmd_id, page):
+        query = dict(sub["query"], pageLink=dict(sub["query"]["pageLink"], page=page))
+        return dict(sub, cmdId=cmd_id, query=query)
+
+    # async thread run helper, runs listen_forever() on a new loop, when
+    # already running a loop, use listen_forever() or async with instead
     # example usage:
     #   thread = threading.Thread(target=TBReceiver.run_receiver, args=(0, receiver), daemon=False)
     #   thread.start()
@@ -135,10 +503,12 @@ class TBReceiver:
     # fetch user JWT tokens from a ThingsBoard host via the REST API
     # returns token tuple (access, refresh) on success or None on failure
     @staticmethod
-    def fetch_tokens(host, user, password):
+    def fetch_tokens(host, user, password, secure=True):
+        import requests
+        scheme = "https://" if secure else "http://"
 
         # exchange login credentials for login tokens
-        url = "https://" + host + "/api/auth/login"
+        url = scheme + host + "/api/auth/login"
         header = {"Content-Type": "application/json", "Accept": "application/json"}
         data = {"username": user, "password": password}
         req = requests.post(url, headers=header, json=data)
@@ -150,7 +520,7 @@ class TBReceiver:
         refresh = resp["refreshToken"]
 
         # exchange login tokens for main tokens
-        url = "https://" + host + "/api/auth/token"
+        url = scheme + host + "/api/auth/token"
         header = {
             "Content-Type": "application/json",
             "Accept": "application/json",
@@ -170,8 +540,9 @@ class TBReceiver:
     # fetch device info from device id(s) via the REST API
     # returns list of device dicts on success or None on failure
     @staticmethod
-    def fetch_devices(host, access, ids):
-        url = "http://" + host + "/api/devices?deviceIds=" + ",".join(ids)
+    def fetch_devices(host, access, ids, secure=True):
+        import requests
+        url = ("https://" if secure else "http://") + host + "/api/devices?deviceIds=" + ",".join(ids)
         header = {
             "Content-Type": "application/json",
             "Accept": "application/json",
@@ -205,13 +576,22 @@ class TBReceiver:
     def set_verbose(verbose):
         logging.basicConfig(level=(logging.DEBUG if verbose else logging.INFO))
 
+# entity data query state: subscribed page cmdIds and matching devices
+class _Query:
+    __slots__ = ("cmd_id", "sub", "page_ids", "members")
+
+    def __init__(self, sub):
+        self.cmd_id = sub["cmdId"] # first page cmdId, identifies the query
+        self.sub = sub # first page subscription command
+        self.page_ids = [self.cmd_id] # cmdIds by page index
+        self.members = {} # page index -> {device id: device dict}
+
 ##### main
 
 # test program to connect & print received telemetry messages
 # example usage: python3 thoscy/TBReceiver.py thingsboard.mydomain.com USERNAME PASSWORD ID
 # note: requires running in venv -> . ./venv/bin/activate
 if __name__ == '__main__':
-    from threading import Thread
     import sys
     import argparse
     
@@ -268,14 +648,14 @@ if __name__ == '__main__':
             }
         ]
     }
-    receiver = TBReceiver(subscription_cmd=subscription_cmd, \
-                          telemetry_callback=received_telemetry, \
-                          device_callback=received_devices, **vars(args))
-    thread = Thread(target=TBReceiver.run_receiver, args=(0, receiver), daemon=False)
-    thread.start()
+    async def main():
+        async with TBReceiver(subscription_cmd=subscription_cmd, telemetry_callback=None, \
+                              device_callback=received_devices, **vars(args)) as receiver:
+            async for data in receiver:
+                received_telemetry(data)
 
-    # wait for receiver to exit
+    # receive until interrupted
     try:
-        thread.join()
+        asyncio.run(main())
     except KeyboardInterrupt:
         pass
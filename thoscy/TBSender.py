@@ -13,44 +13,97 @@
 # References:
 # * https://thingsboard.io/docs/reference/python-client-sdk/
 
+import asyncio
 import time
 import json
 
 # thingsboard comm
-from tb_device_mqtt import TBDeviceMqttClient
-from tb_gateway_mqtt import TBGatewayMqttClient
+# note: the MQTT clients are imported when first used to keep startup fast
 
 import logging
 logger = logging.getLogger(__name__)
 
 # ThingsBoard MQTT sender wrapper
+#
+# for asyncio code, use it as an async context manager and send batches of
+# (device, ts, values) telemetry tuples with send_many():
+#   async with TBSender(host, token) as sender:
+#       results = await sender.send_many(items)
+#       delivered = all(await asyncio.gather(*results))
 class TBSender:
 
+    TELEMETRY_TOPIC = "v1/devices/me/telemetry"
+    GATEWAY_TELEMETRY_TOPIC = "v1/gateway/telemetry"
+
+    # PUBACK reason codes for exceeded server-side limits, published again
+    RETRY_REASONS = (131, 151) # implementation specific error, quota exceeded
+    RETRIES = 5 # max publish retries, waiting 1, 2, 4... s in between
+
     # init with
     # * host: ThingsBoard server hostname, ie. thingsboard.mydomain.com
     # * token: device token
     # additonal options:
+    # * port: int, MQTT port, default: 1883
     # * values_stringified: bool, store complex JSON values as strings?
     # * gateway: bool, device is a gateway
     # * gateway_devices: str array, device names (as displayed in the Thingsboard UI)
+    # * connect_callback: function, called after each (re)connect from the MQTT
+    #   client thread, format: function()
+    # * timeout: float, max seconds send_many() waits for the connection,
+    #   rate limits, or MQTT queue space and the async context manager waits
+    #   for outstanding deliveries before disconnecting, default: 10
     def __init__(self, host, token, **kwargs):
         # optional
         self.gateway = kwargs.get("gateway") or False
         self.values_stringified = kwargs.get("values_stringified") or True
-        # create client
+        port = kwargs.get("port") or 1883
+        self.connect_callback = kwargs.get("connect_callback") or None
+        self.timeout = kwargs.get("timeout") or 10
+        self.loop = None # event loop of send_many() delivery futures
+        self.deliveries = {} # MQTT message id -> unacknowledged _Publish
+        self.retrying = {} # retry task -> _Publish
+        self.closing = False # disconnecting, do not retry
+        # create client, the device token is used as the MQTT user name
         if self.gateway: # multiple device gateway client
-            self.thingsboard = TBGatewayMqttClient(host, token)
+            from tb_gateway_mqtt import TBGatewayMqttClient
+            self.thingsboard = TBGatewayMqttClient(host, port=port, username=token)
             self.gateway_devices = kwargs.get("gateway_devices") or []
             if len(self.gateway_devices) == 0:
                 logger.warning("using gateway, but not gateway devices given")
         else: # single device client
-            self.thingsboard = TBDeviceMqttClient(host, token)
+            from tb_device_mqtt import TBDeviceMqttClient
+            self.thingsboard = TBDeviceMqttClient(host, port=port, username=token)
         #self.thingsboard.max_inflight_messages_set(100) # set this?
+        # chain MQTT client callbacks to resolve delivery futures
+        client = self.thingsboard._client
+        self._on_publish = client.on_publish
+        self._on_disconnect = client.on_disconnect
+        client.on_publish = self._published
+        client.on_disconnect = self._disconnected
+
+    # connect on entering async with block,
+    # raises ConnectionError if connecting fails
+    async def __aenter__(self):
+        self.loop = asyncio.get_running_loop()
+        if not await self.loop.run_in_executor(None, self.connect):
+            raise ConnectionError("could not connect to thingsboard")
+        return self
+
+    # wait for outstanding deliveries, unless exiting due to an exception,
+    # and disconnect on leaving async with block
+    async def __aexit__(self, exc_type, exc, tb):
+        pending = [publish.future for publish in self.deliveries.values()] + \
+                  [publish.future for publish in self.retrying.values()]
+        if exc_type == None and len(pending) > 0:
+            await asyncio.wait(pending, timeout=self.timeout)
+        await self.loop.run_in_executor(None, self.disconnect)
+        self._fail_deliveries()
 
     # connect to server, returns True on success
     def connect(self):
+        self.closing = False
         try:
-            self.thingsboard.connect()
+            self.thingsboard.connect(callback=self._connected)
             if self.gateway:
                 for device in self.gateway_devices:
                     self.thingsboard.gw_connect_device(device)
@@ -61,11 +114,24 @@ class TBSender:
 
     # disconnect from server
     def disconnect(self):
+        self.closing = True
         if self.gateway:
             for device in self.gateway_devices:
                 self.thingsboard.gw_disconnect_device(device)
         self.thingsboard.disconnect()
 
+    # connect gateway device by name on the open connection
+    def add_device(self, name):
+        if not self.gateway or name in self.gateway_devices: return
+        self.gateway_devices.append(name)
+        self.thingsboard.gw_connect_device(name)
+
+    # disconnect gateway device by name on the open connection
+    def remove_device(self, name):
+        if not self.gateway or name not in self.gateway_devices: return
+        self.gateway_devices.remove(name)
+        self.thingsboard.gw_disconnect_device(name)
+
     # send telemetry JSON payload
     # when sending to a gateway, set the device as either:
     # * device_index: int, self.gateway_devices index, or
@@ -98,6 +164,259 @@ class TBSender:
             return False
         return True
 
+    # send client-side attributes JSON payload, only the latest value is
+    # stored by ThingsBoard, see send_telemetry for the device arguments
+    # returns True on success
+    def send_attributes(self, data, device_index=None, device_name=None):
+        if data == None: return False
+        if self.values_stringified:
+           data = TBSender.stringify_values(data)
+        try:
+            if self.gateway:
+                name = device_name
+                if name == None and device_index < len(self.gateway_devices):
+                    name = self.gateway_devices[device_index]
+                if name == None:
+                    logger.warning(f"send failed: gateway device for index {device_index} or name {device_name}")
+                    return False
+                self.thingsboard.gw_send_attributes(name, data)
+                logger.debug(f"sent attributes to \"{name}\": {data}")
+            else:
+                self.thingsboard.send_attributes(data)
+                logger.debug(f"sent attributes: {data}")
+        except Exception as exc:
+            logger.error(f"send failed: {exc}")
+            return False
+        return True
+
+    # send list of (device, ts, values) telemetry tuples in as few MQTT
+    # publishes as possible, returns list of delivery futures, one per
+    # publish, which resolve to True when acknowledged or False on failure
+    # * device: int or str, self.gateway_devices index or device name when
+    #   sending to a gateway, ignored otherwise
+    # * ts: int, timestamp in ms since epoch or None for now
+    # * values: dict, telemetry key/values, not modified
+    #
+    # each item is serialized once and items are grouped by device into
+    # payloads of up to the MQTT client's max_payload_size and telemetry
+    # datapoint rate limit, ie. {"device1": [{"ts": 1, "values": {..}}, ..], ..}
+    # when sending to a gateway or [{"ts": 1, "values": {..}}, ..] otherwise
+    #
+    # the ThingsBoard client's telemetry message & datapoint rate limits are
+    # applied per publish, but waiting for them, the connection, or MQTT
+    # queue space yields to the event loop instead of blocking, publishes
+    # rejected by server-side limits or dropped by a disconnect are retried,
+    # so items may be delivered more than once
+    async def send_many(self, items):
+        self.loop = asyncio.get_running_loop()
+        results = []
+        for topic, payload, datapoints in self._payloads(self._serialize(items)):
+            publish = _Publish(self.loop.create_future(), topic, payload, datapoints)
+            results.append(publish.future)
+            await self._publish(publish)
+        return results
+
+    # MQTT client connect callback
+    def _connected(self, client, userdata, flags, result_code, *extra):
+        if self.connect_callback and result_code == 0:
+            self.connect_callback()
+
+    # MQTT client publish callback, called from the MQTT client thread
+    def _published(self, client, userdata, mid, reason_code=None, *extra):
+        self._on_publish(client, userdata, mid, reason_code, *extra)
+        if self.loop == None: return
+        try:
+            self.loop.call_soon_threadsafe(self._delivered, mid,
+                                           0 if reason_code == None else reason_code.value)
+        except RuntimeError:
+            pass # loop closed
+
+    # MQTT client disconnect callback, called from the MQTT client thread,
+    # the ThingsBoard client drops queued messages so they are published
+    # again after reconnecting
+    def _disconnected(self, *args):
+        self._on_disconnect(*args)
+        if self.loop == None: return
+        try:
+            self.loop.call_soon_threadsafe(self._requeue)
+        except RuntimeError:
+            pass # loop closed
+
+    # publish within the telemetry rate limits, waits for the connection,
+    # rate limits, and MQTT queue space for up to self.timeout or the rate
+    # limit window, the delivery fails if it could not be published
+    async def _publish(self, publish):
+        from paho.mqtt.client import error_string, MQTT_ERR_QUEUE_SIZE
+        messages, datapoints = self._rate_limits()
+        # (limit, datapoints) pairs, a publish over a limit waits for all of it
+        datapoints = [(limit, min(publish.datapoints, limit.get_minimal_limit()) \
+                      if limit.has_limit() else publish.datapoints) for limit in datapoints]
+        timeout = max([self.timeout] + [limit.get_minimal_timeout() for limit in messages] + \
+                      [limit.get_minimal_timeout() for limit, _ in datapoints])
+        deadline = self.loop.time() + timeout
+        while not self.thingsboard.is_connected() or \
+              any(limit.check_limit_reached() for limit in messages) or \
+              any(limit.check_limit_reached(amount) for limit, amount in datapoints):
+            if self.closing or self.loop.time() >= deadline:
+                logger.error("send failed: timeout waiting for connection or rate limits")
+                publish.resolve(False)
+                return
+            await asyncio.sleep(0.01)
+        for limit in messages:
+            limit.increase_rate_limit_counter()
+        for limit, _ in datapoints:
+            limit.increase_rate_limit_counter(publish.datapoints)
+        client = self.thingsboard._client
+        qos = self.thingsboard.quality_of_service
+        info = client.publish(publish.topic, publish.payload, qos)
+        while info.rc == MQTT_ERR_QUEUE_SIZE and self.loop.time() < deadline:
+            await asyncio.sleep(0.01)
+            info = client.publish(publish.topic, publish.payload, qos)
+        if info.rc != 0:
+            logger.error(f"send failed: {error_string(info.rc)}")
+            publish.resolve(False)
+        elif qos == 0 or info.is_published():
+            publish.resolve(True)
+        else:
+            self.deliveries[info.mid] = publish
+        logger.debug(f"sent {publish.topic}: {publish.payload}")
+
+    # returns (message, datapoint) telemetry rate limit lists of the client,
+    # gateway telemetry is limited for both the gateway and its devices
+    # note: reads ThingsBoard client attributes, not part of the public API
+    def _rate_limits(self):
+        messages = [self.thingsboard._telemetry_rate_limit]
+        datapoints = [self.thingsboard._telemetry_dp_rate_limit]
+        if self.gateway:
+            messages.append(self.thingsboard._devices_connected_through_gateway_telemetry_messages_rate_limit)
+            datapoints.append(self.thingsboard._devices_connected_through_gateway_telemetry_datapoints_rate_limit)
+        return messages, datapoints
+
+    # resolve delivery for MQTT message id, if any, or retry it after
+    # exceeding server-side limits
+    def _delivered(self, mid, reason):
+        publish = self.deliveries.pop(mid, None)
+        if publish == None or publish.future.done(): return
+        if reason in TBSender.RETRY_REASONS and self._retry(publish):
+            logger.warning(f"send rejected with reason code {reason}, retrying")
+            return
+        publish.resolve(reason < 128)
+
+    # retry unacknowledged deliveries after a disconnect
+    def _requeue(self):
+        deliveries = self.deliveries
+        self.deliveries = {}
+        for publish in deliveries.values():
+            if not self._retry(publish):
+                publish.resolve(False)
+
+    # publish again after a backoff delay, returns False if closing or out
+    # of retries
+    def _retry(self, publish):
+        if self.closing or publish.attempts >= TBSender.RETRIES: return False
+        delay = 2 ** publish.attempts
+        publish.attempts += 1
+        async def retry():
+            await asyncio.sleep(delay)
+            await self._publish(publish)
+        task = self.loop.create_task(retry())
+        self.retrying[task] = publish
+        task.add_done_callback(lambda task: self.retrying.pop(task, None))
+        return True
+
+    # resolve all outstanding deliveries as failed and cancel retries
+    def _fail_deliveries(self):
+        publishes = list(self.deliveries.values()) + list(self.retrying.values())
+        for task in list(self.retrying):
+            task.cancel()
+        self.deliveries = {}
+        self.retrying = {}
+        failed = sum(publish.resolve(False) for publish in publishes)
+        if failed > 0:
+            logger.warning(f"{failed} sends not delivered")
+
+    # serialize (device, ts, values) items as JSON records grouped by device
+    # name, returns dict of device name -> list of (record string, datapoints)
+    # tuples, the device name is None if not sending to a gateway
+    def _serialize(self, items):
+        groups = {}
+        now = None
+        for device, ts, values in items:
+            if values == None or len(values) == 0: continue
+            name = None
+            if self.gateway:
+                name = device
+                if isinstance(device, int):
+                    name = self.gateway_devices[device] if 0 <= device < len(self.gateway_devices) else None
+                if name == None:
+                    logger.warning(f"send failed: gateway device for {device}")
+                    continue
+            if ts == None:
+                if now == None: now = int(round(time.time() * 1000))
+                ts = now
+            if self.values_stringified:
+                values = TBSender.stringified(values)
+            record = (json.dumps({"ts": ts, "values": values}, separators=(',', ':')), len(values))
+            records = groups.get(name)
+            if records == None:
+                groups[name] = [record]
+            else:
+                records.append(record)
+        return groups
+
+    # pack serialized record groups into as few payloads as fit the max
+    # payload size and datapoint rate limit,
+    # returns list of (topic, payload, datapoints) tuples
+    def _payloads(self, groups):
+        size_limit = self.thingsboard.max_payload_size
+        _, datapoints = self._rate_limits()
+        points_limit = min((limit.get_minimal_limit() for limit in datapoints if limit.has_limit()),
+                           default=float("inf"))
+        payloads = []
+        if not self.gateway:
+            for chunk, points in TBSender._chunks(groups.get(None, []), size_limit, points_limit):
+                payloads.append((TBSender.TELEMETRY_TOPIC, "[" + ",".join(chunk) + "]", points))
+            return payloads
+        entries = [] # "name":[records] entries of the current payload
+        size = 2
+        total = 0 # datapoints of the current payload
+        for name, records in groups.items():
+            key = json.dumps(name) + ":"
+            for chunk, points in TBSender._chunks(records, size_limit - len(key) - 2, points_limit):
+                entry = key + "[" + ",".join(chunk) + "]"
+                if len(entries) > 0 and (size + len(entry) + 1 > size_limit or total + points > points_limit):
+                    payloads.append((TBSender.GATEWAY_TELEMETRY_TOPIC, "{" + ",".join(entries) + "}", total))
+                    entries = []
+                    size = 2
+                    total = 0
+                entries.append(entry)
+                size += len(entry) + 1
+                total += points
+        if len(entries) > 0:
+            payloads.append((TBSender.GATEWAY_TELEMETRY_TOPIC, "{" + ",".join(entries) + "}", total))
+        return payloads
+
+    # generate (record strings, datapoints) chunks of serialized records
+    # which fit size bytes as a JSON array and the max datapoints, a record
+    # exceeding either is a chunk of its own
+    # note: records are ASCII as json.dumps escapes non-ASCII characters
+    @staticmethod
+    def _chunks(records, size, points):
+        chunk = []
+        length = 2
+        total = 0
+        for record, count in records:
+            if len(chunk) > 0 and (length + len(record) + 1 > size or total + count > points):
+                yield chunk, total
+                chunk = []
+                length = 2
+                total = 0
+            chunk.append(record)
+            length += len(record) + 1
+            total += count
+        if len(chunk) > 0:
+            yield chunk, total
+
     # stringify JSON object or array values
     @staticmethod
     def stringify_values(data):
@@ -109,11 +428,39 @@ class TBSender:
                 logger.debug(f"stringified {key}: {value}")
         return data
 
+    # returns JSON object or array values stringified without modifying data,
+    # data is only copied if it has any
+    @staticmethod
+    def stringified(data):
+        for value in data.values():
+            if isinstance(value, dict) or isinstance(value, list):
+                return {key: json.dumps(value, separators=(',', ':'))
+                        if isinstance(value, dict) or isinstance(value, list) else value
+                        for key, value in data.items()}
+        return data
+
     # set log level
     @staticmethod
     def set_verbose(verbose):
         logging.basicConfig(level=(logging.DEBUG if verbose else logging.INFO))
 
+# send_many() publish state, kept until acknowledged to retry it
+class _Publish:
+    __slots__ = ("future", "topic", "payload", "datapoints", "attempts")
+
+    def __init__(self, future, topic, payload, datapoints):
+        self.future = future # delivery result
+        self.topic = topic
+        self.payload = payload # serialized JSON
+        self.datapoints = datapoints
+        self.attempts = 0 # retries so far
+
+    # set delivery result if not done, returns True if set
+    def resolve(self, delivered):
+        if self.future.done(): return False
+        self.future.set_result(delivered)
+        return True
+
 ##### main
 
 # test program to send a telemetry message JSON payload
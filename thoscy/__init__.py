@@ -1,4 +1,48 @@
-from .jsonparser import json_to_osc
-from .oscparser import osc_to_json
-from .TBSender import TBSender
-from .TBReceiver import TBReceiver
\ No newline at end of file
+# package attributes are imported lazily on first access, so a tool only pays
+# for the dependencies it uses, ie. thoscy-send does not import websockets or
+# requests and thoscy-recv does not import the MQTT client
+
+# attribute name -> submodule
+_modules = {
+    "json_to_osc": "jsonparser",
+    "osc_to_json": "oscparser",
+    "telemetry_to_osc": "jsonparser",
+    "encode_osc": "jsonparser",
+    "osc_to_telemetry": "oscparser",
+    "TBSender": "TBSender",
+    "TBReceiver": "TBReceiver",
+    "SendRelay": "SendRelay",
+    "RecvRelay": "RecvRelay",
+    "Metrics": "metrics",
+    "Profiler": "profiler",
+    "Tracer": "trace",
+    "Schema": "schema",
+    "Registry": "registry",
+    "TableWriter": "shmtable",
+    "TableReader": "shmtable",
+}
+
+__all__ = list(_modules)
+
+def __getattr__(name):
+    module = _modules.get(name)
+    if module == None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    import importlib
+    value = getattr(importlib.import_module("." + module, __name__), name)
+    globals()[name] = value # cache, later lookups skip __getattr__
+    _rebind()
+    return value
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
+
+# importing a submodule binds it as a package attribute, which shadows the
+# lazy class of the same name, ie. thoscy.TBReceiver after thoscy.RecvRelay
+# imports .TBReceiver, so classes are bound over their loaded submodules
+def _rebind():
+    import types
+    for name, module in _modules.items():
+        value = globals().get(name)
+        if name == module and isinstance(value, types.ModuleType):
+            globals()[name] = getattr(value, name)
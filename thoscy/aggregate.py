@@ -0,0 +1,198 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2022 ZKM | Hertz-Lab
+# Dan Wilcox <dan.wilcox@zkm.de>
+#
+# BSD Simplified License.
+# For information on usage and redistribution, and for a DISCLAIMER OF ALL
+# WARRANTIES, see the file, "LICENSE.txt," in this distribution.
+#
+# This code has been developed at ZKM | Hertz-Lab as part of „The Intelligent
+# Museum“ generously funded by the German Federal Cultural Foundation.
+
+from array import array
+import fnmatch
+import asyncio
+
+# available statistics, published as key_stat, ie. "accel_mean"
+STATS = ("min", "max", "mean", "last", "count")
+
+# windowed statistical aggregation of telemetry values: numeric values of
+# configured keys are collected per device & key instead of being sent and
+# the selected statistics are sent once per window
+#
+# samples are written to a fixed-size ring buffer per device & key which is
+# folded into running min/max/sum values whenever it is full and when the
+# window ends, so the statistics are exact while memory stays bounded by
+# the buffer size, folding is vectorized if NumPy is available
+#
+# keys are top-level telemetry keys or fnmatch patterns, ie. "accel*",
+# list values are added as multiple samples, non-numeric values are passed
+# through unchanged
+class Aggregator:
+
+    # init with
+    # * keys: str list, key names or patterns to aggregate
+    # * callback: function, called per device once per window with the
+    #   statistics, format: function(data, device_name)
+    # additional options:
+    # * window: float seconds, aggregation window, default: 1
+    # * stats: str list, statistics to send, see STATS, default: all
+    # * size: int, ring buffer size per device & key, default: 256
+    # * max_keys: int, max aggregated device & key pairs, further keys are
+    #   passed through, default: 10000
+    def __init__(self, keys, callback, **kwargs):
+        self.keys = list(keys)
+        self.callback = callback
+        self.window = kwargs.get("window") or 1
+        self.stats = list(kwargs.get("stats") or STATS)
+        self.size = kwargs.get("size") or 256
+        self.max_keys = kwargs.get("max_keys") or 10000
+        self.rings = {} # device name -> key -> _Ring
+        self.count = 0 # number of rings
+        self.matches = {} # key -> aggregate?
+        self.patterns = [key for key in self.keys if any(c in key for c in "*?[")]
+        self.task = None
+        for stat in self.stats:
+            if stat not in STATS:
+                raise ValueError(f"unknown stat: {stat}")
+        try:
+            import numpy
+            self.numpy = numpy
+        except ImportError:
+            self.numpy = None
+
+    # start sending statistics once per window on the running loop
+    async def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    # stop sending and flush the current window
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        self.flush()
+
+    # add telemetry data dict for device name (None if not using a gateway),
+    # returns data with the aggregated keys removed or None if empty
+    def add(self, data, device_name=None):
+        rest = None
+        for key,value in data.items():
+            if not self._match(key) or not self._add(device_name, key, value):
+                if rest == None: rest = {}
+                rest[key] = value
+        return rest
+
+    # send statistics for all devices & keys with samples in the current
+    # window and start a new window
+    def flush(self):
+        for name,rings in self.rings.items():
+            data = {}
+            for ring in rings.values():
+                if ring.count == 0: continue
+                ring.fold()
+                for key,stat in ring.names:
+                    data[key] = ring.stat(stat)
+                ring.reset()
+            if len(data) > 0:
+                self.callback(data, name)
+
+    # add value for device & key, returns False if not aggregated
+    def _add(self, name, key, value):
+        rings = self.rings.get(name)
+        if rings == None:
+            rings = self.rings[name] = {}
+        ring = rings.get(key)
+        if ring == None:
+            if not _numeric(value) or self.count >= self.max_keys:
+                return False
+            ring = rings[key] = _Ring(self.size, self.numpy)
+            ring.names = [(f"{key}_{stat}", stat) for stat in self.stats]
+            self.count += 1
+        if isinstance(value, list):
+            if not all(_number(v) for v in value): return False
+            for v in value: ring.add(v)
+        elif _number(value):
+            ring.add(value)
+        else:
+            return False
+        return True
+
+    # returns True if key is aggregated, cached per key
+    def _match(self, key):
+        match = self.matches.get(key)
+        if match == None:
+            match = key in self.keys or any(fnmatch.fnmatchcase(key, p) for p in self.patterns)
+            if len(self.matches) < self.max_keys: self.matches[key] = match
+        return match
+
+    # flush once per window
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.window)
+            self.flush()
+
+# fixed-size sample buffer with running statistics
+class _Ring:
+    __slots__ = ("names", "data", "numpy", "size", "length", "count", "min", "max", "sum", "last")
+
+    def __init__(self, size, numpy=None):
+        self.names = [] # (published key, stat name) pairs
+        self.size = size
+        self.numpy = numpy
+        if numpy:
+            self.data = numpy.empty(size, dtype=numpy.float64)
+        else:
+            self.data = array("d", bytes(8 * size))
+        self.length = 0 # samples in buffer
+        self.reset()
+
+    # add sample, folds buffer when full
+    def add(self, value):
+        self.data[self.length] = value
+        self.length += 1
+        self.count += 1
+        self.last = value
+        if self.length == self.size: self.fold()
+
+    # fold buffered samples into the running statistics
+    def fold(self):
+        if self.length == 0: return
+        if self.numpy:
+            values = self.data[:self.length]
+            low = float(values.min())
+            high = float(values.max())
+            total = float(values.sum())
+        else:
+            values = memoryview(self.data)[:self.length]
+            low = min(values)
+            high = max(values)
+            total = sum(values)
+        if self.min == None or low < self.min: self.min = low
+        if self.max == None or high > self.max: self.max = high
+        self.sum += total
+        self.length = 0
+
+    # returns statistic by name, see STATS
+    def stat(self, name):
+        if name == "mean": return self.sum / self.count
+        return getattr(self, name)
+
+    # clear statistics for the next window
+    def reset(self):
+        self.length = 0
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.sum = 0.0
+        self.last = None
+
+# returns True if value is a number, bools are not numbers here
+def _number(value):
+    return (type(value) is float or type(value) is int)
+
+# returns True if value is a number or a non-empty list of numbers
+def _numeric(value):
+    if isinstance(value, list):
+        return len(value) > 0 and all(_number(v) for v in value)
+    return _number(value)
@@ -0,0 +1,151 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2022 ZKM | Hertz-Lab
+# Dan Wilcox <dan.wilcox@zkm.de>
+#
+# BSD Simplified License.
+# For information on usage and redistribution, and for a DISCLAIMER OF ALL
+# WARRANTIES, see the file, "LICENSE.txt," in this distribution.
+#
+# This code has been developed at ZKM | Hertz-Lab as part of „The Intelligent
+# Museum“ generously funded by the German Federal Cultural Foundation.
+
+import struct
+import mmap
+import time
+import os
+
+import logging
+logger = logging.getLogger(__name__)
+
+# OSC traffic capture log: raw OSC packets with monotonic receive timestamps
+# written to a directory of fixed-size, memory-mapped segment files
+#
+# segment format, all values little-endian:
+# * header: MAGIC (8 bytes)
+# * records: timestamp (uint64 monotonic ns) + packet length (uint32) + packet
+#
+# segments are preallocated and written through a memory map, so recording a
+# packet is a single header pack and copy without a system call, a segment
+# is truncated to its used size when full or closed, a segment left at full
+# size by a crash ends at the first zero header
+#
+# segments are named by increasing index, ie. 000000.oscap, a new capture in
+# the same directory continues after the existing segments and the oldest
+# segments are deleted when the max segment count is reached
+
+MAGIC = b"OSCAP\x00\x01\x00"
+RECORD = struct.Struct("<QI") # timestamp ns, packet length
+SUFFIX = ".oscap"
+
+SEGMENT_SIZE = 64 # default segment size in MB
+
+# capture log writer
+class CaptureWriter:
+
+    # init with
+    # * path: str, capture directory, created if needed
+    # additional options:
+    # * segment_size: int, segment file size in MB, default: 64
+    # * segments: int, max segments to keep, oldest are deleted, 0 keeps all (default)
+    def __init__(self, path, **kwargs):
+        self.path = path
+        self.segment_size = int((kwargs.get("segment_size") or SEGMENT_SIZE) * 1024 * 1024)
+        self.max_segments = kwargs.get("segments") or 0
+        self.file = None
+        self.map = None
+        self.offset = 0 # write position in the current segment
+        self.packets = 0
+        self.dropped = 0 # packets larger than a segment
+        os.makedirs(path, exist_ok=True)
+        self.segments = segments(path) # existing & written segment paths
+        self.index = _index(self.segments[-1]) + 1 if len(self.segments) > 0 else 0
+        self._open()
+
+    # record packet bytes received at monotonic time in ns, default: now
+    def write(self, packet, now=None):
+        if now == None: now = time.monotonic_ns()
+        size = RECORD.size + len(packet)
+        end = self.offset + size
+        if end > self.segment_size:
+            if size > self.segment_size - len(MAGIC):
+                self.dropped += 1
+                return
+            self._open()
+            end = self.offset + size
+        RECORD.pack_into(self.map, self.offset, now, len(packet))
+        self.map[self.offset + RECORD.size:end] = packet
+        self.offset = end
+        self.packets += 1
+
+    # close the current segment
+    def close(self):
+        if self.map == None: return
+        self.map.flush()
+        self.map.close()
+        self.file.truncate(self.offset)
+        self.file.close()
+        self.map = None
+        self.file = None
+
+    # close the current segment and open the next one, deleting the oldest
+    # segments if there are too many
+    def _open(self):
+        self.close()
+        path = os.path.join(self.path, f"{self.index:06d}{SUFFIX}")
+        self.index += 1
+        self.file = open(path, "w+b")
+        self.file.truncate(self.segment_size)
+        self.map = mmap.mmap(self.file.fileno(), self.segment_size)
+        self.map[:len(MAGIC)] = MAGIC
+        self.offset = len(MAGIC)
+        self.segments.append(path)
+        while self.max_segments > 0 and len(self.segments) > self.max_segments:
+            old = self.segments.pop(0)
+            try:
+                os.remove(old)
+            except OSError as exc:
+                logger.warning(f"could not remove capture segment {old}: {exc}")
+
+# capture log reader, iterates over (timestamp ns, packet bytes) records of
+# a capture directory or a single segment file in order
+class CaptureReader:
+
+    def __init__(self, path):
+        self.paths = segments(path) if os.path.isdir(path) else [path]
+
+    def __iter__(self):
+        for path in self.paths:
+            yield from CaptureReader.read(path)
+
+    # generate records of a single segment file, packets are sliced directly
+    # from the memory-mapped file,
+    # raises ValueError if the file is not a capture segment
+    @staticmethod
+    def read(path):
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size <= len(MAGIC): return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if data[:len(MAGIC)] != MAGIC:
+                    raise ValueError(f"not a capture segment: {path}")
+                offset = len(MAGIC)
+                end = len(data) - RECORD.size
+                unpack = RECORD.unpack_from
+                while offset <= end:
+                    now, length = unpack(data, offset)
+                    if now == 0 and length == 0: break # unused preallocated space
+                    offset += RECORD.size
+                    yield now, data[offset:offset + length]
+                    offset += length
+
+# returns sorted segment paths in capture directory
+def segments(path):
+    names = sorted(name for name in os.listdir(path) if name.endswith(SUFFIX))
+    return [os.path.join(path, name) for name in names]
+
+# returns index of segment path
+def _index(path):
+    try:
+        return int(os.path.basename(path)[:-len(SUFFIX)])
+    except ValueError:
+        return 0
@@ -10,33 +10,572 @@
 # This code has been developed at ZKM | Hertz-Lab as part of „The Intelligent
 # Museum“ generously funded by the German Federal Cultural Foundation.
 
+import asyncio
+import signal
 import json
+import copy
+import os
 
-host = ""
-user = ""
-password = ""
+from .schema import Schema
+from .osctcp import TRANSPORTS
+from .aggregate import STATS
 
-devices = {}
+# ThingsBoard attribute subscription scopes, telemetry uses "LATEST_TELEMETRY"
+ATTRIBUTE_SCOPES = ("CLIENT_SCOPE", "SERVER_SCOPE", "SHARED_SCOPE")
 
-send = {
-	"address": "127.0.0.1",
-	"port": 7777,
-	"devices": [],
-	"telemetry": False
+# JSON config file schema: key -> value type or section schema dict,
+# float values also accept ints, lists are lists of strings
+SCHEMA = {
+    "host": str,
+    "user": str,
+    "password": str,
+    "secure": bool,
+    "verbose": bool,
+    "watch": float,
+    "devices": dict,
+    "hosts": dict,
+    "routes": dict,
+    "types": dict,
+    "array_encoding": str,
+    "send": {
+        "address": str,
+        "port": int,
+        "transport": str,
+        "mqtt_port": int,
+        "token": str,
+        "attributes": list,
+        "devices": list,
+        "names": list
+    },
+    "recv": {
+        "address": str,
+        "port": int,
+        "transport": str,
+        "listen": bool,
+        "telemetry": bool,
+        "prefix": bool,
+        "rate": float,
+        "interpolate": bool,
+        "attributes": list,
+        "devices": list,
+        "ids": list,
+        "groups": dict
+    },
+    "aggregate": {
+        "keys": list,
+        "window": float,
+        "stats": list,
+        "size": int
+    },
+    "table": {
+        "name": str,
+        "slots": int,
+        "address_size": int,
+        "value_size": int
+    },
+    "capture": {
+        "path": str,
+        "segment_size": float,
+        "segments": int
+    },
+    "metrics": {
+        "address": str,
+        "port": int,
+        "stats_address": str,
+        "stats_port": int,
+        "stats_interval": float
+    },
+    "trace": {
+        "enabled": bool,
+        "every": int,
+        "rate": int,
+        "size": int
+    },
+    "profile": {
+        "directory": str,
+        "duration": float,
+        "port": int
+    }
 }
+SCHEMA["receive"] = SCHEMA["recv"] # alias
 
-recv = {
-	"address": "127.0.0.1",
-	"port": 7788,
-	"devices": [],
-	"telemetry": False
+# device info dict schema
+DEVICE_SCHEMA = {"name": str, "id": str}
+
+# additional host dict schema
+HOST_SCHEMA = {
+    "host": str,
+    "user": str,
+    "password": str,
+    "secure": bool,
+    "mqtt_port": int,
+    "token": str,
+    "names": list,
+    "ids": list
+}
+
+# recv device group query dict schema
+GROUP_SCHEMA = {
+    "type": str,
+    "group": str,
+    "name": str,
+    "keys": list,
+    "page_size": int
 }
 
-verbose = False
+# name of the main host given by the top-level keys, ie. in routes
+DEFAULT_HOST = "default"
+
+# keys which can not be applied to running relays when reloading,
+# changes are reported and require a restart
+RESTART_KEYS = ("host", "user", "password", "secure", "verbose", "watch", "hosts",
+                "send.token", "send.mqtt_port", "table", "capture", "metrics", "trace", "profile")
+
+# shared configuration values for both relay directions,
+# see doc/config.json for the JSON file format
+class Config:
+
+    def __init__(self):
+        self.host = ""
+        self.user = ""
+        self.password = ""
+        self.secure = True # use https & wss?
+        self.verbose = False
+        self.watch = 2 # config file change poll interval in seconds, 0 disables
+
+        # device info dicts by keyname, keys are:
+        # * name: device name as shown in ThingsBoard UI
+        # * id: ThingsBoard device id
+        self.devices = {}
+
+        # additional host dicts by name, each with its own credentials and
+        # devices, keys are:
+        # * host: ThingsBoard server host name
+        # * user & password: receive credentials, default: top-level values
+        # * secure: use https & wss when receiving, default: top-level value
+        # * mqtt_port: MQTT port, default: send mqtt_port
+        # * token: send device access token, must be gateway device if using names
+        # * names: send gateway device names
+        # * ids: receive device ids
+        self.hosts = {}
+
+        # send host names by OSC address device prefix, ie. "/dev1", or "*"
+        # for all other prefixes, unrouted messages are sent to all hosts
+        self.routes = {}
+
+        # value types by telemetry key, see schema.py
+        self.types = {}
+        self.array_encoding = "list" # ThingsBoard packed array encoding: list or base64
+
+        # send-specific values, devices by keyname and/or additional names
+        self.send = {
+            "address": "127.0.0.1",
+            "port": 7777,
+            "transport": "udp", # udp or tcp
+            "mqtt_port": 1883,
+            "token": "",
+            "attributes": [], # OSC addresses or patterns sent as attributes
+            "devices": [],
+            "names": []
+        }
+
+        # receive-specific values, devices by keyname and/or additional ids
+        self.recv = {
+            "address": "127.0.0.1",
+            "port": 7788,
+            "transport": "udp", # udp or tcp
+            "listen": False, # tcp: accept connections on address & port instead of connecting
+            "telemetry": False,
+            "prefix": False,
+            "rate": 0, # scheduled output ticks per second, 0 sends immediately
+            "interpolate": False, # interpolate numeric values when scheduled
+            "attributes": [], # attribute scopes to subscribe to
+            "devices": [],
+            "ids": [],
+            "groups": {} # device group query dicts by name, see RecvRelay
+        }
+
+        # send statistics per window for keys instead of every value,
+        # see aggregate.py
+        self.aggregate = {
+            "keys": [], # key names or patterns, empty disables
+            "window": 1,
+            "stats": ["min", "max", "mean", "last", "count"],
+            "size": 256
+        }
+
+        # recv latest-value shared memory table, see shmtable.py
+        self.table = {
+            "name": "", # shared memory block name, empty disables
+            "slots": 4096, # max addresses
+            "address_size": 64, # max address bytes
+            "value_size": 64 # max value bytes
+        }
+
+        # send OSC traffic capture, see capture.py
+        self.capture = {
+            "path": "", # capture directory, empty disables
+            "segment_size": 64, # MB
+            "segments": 0 # max segments to keep, 0 keeps all
+        }
+
+        # metrics endpoint & OSC stats, see metrics.py
+        self.metrics = {
+            "address": "127.0.0.1",
+            "port": 0,
+            "stats_address": "127.0.0.1",
+            "stats_port": 0,
+            "stats_interval": 5
+        }
+
+        # sampled message tracing, see trace.py
+        self.trace = {
+            "enabled": False,
+            "every": 1,
+            "rate": 0,
+            "size": 1000
+        }
+
+        # on-demand profiling, see profiler.py
+        self.profile = {
+            "directory": "",
+            "duration": 10,
+            "port": 0
+        }
+
+        # additional send device names & receive device ids not from the
+        # file, ie. commandline options, merged by send_names() & recv_ids()
+        self.extra_names = []
+        self.extra_ids = []
+
+        self.path = "" # loaded file path
+        self.overrides = {} # values set via set(), re-applied when reloading
+
+    # load env vars
+    def load_env(self):
+        # user credentials
+        if "THOSCY_USER" in os.environ: self.user = os.environ.get("THOSCY_USER")
+        if "THOSCY_PASS" in os.environ: self.password = os.environ.get("THOSCY_PASS")
+
+    # load and validate JSON file, returns True on success
+    def load_file(self, path):
+        try:
+            with open(path) as f:
+                config = json.load(f)
+        except Exception as exc:
+            print(f"could not open or read {path}: {type(exc).__name__} {exc}")
+            return False
+        errors = Config.validate(config)
+        if len(errors) > 0:
+            for error in errors:
+                print(f"invalid config {path}: {error}")
+            return False
+        for key in ["host", "user", "password", "secure", "verbose", "watch", "devices", "hosts", "routes",
+                    "types", "array_encoding"]:
+            if key in config: setattr(self, key, config[key])
+        for key in ["send", "aggregate", "table", "capture", "metrics", "trace", "profile"]:
+            if key in config: getattr(self, key).update(config[key])
+        # "receive" is accepted as an alias for "recv"
+        for key in ["recv", "receive"]:
+            if key in config: self.recv.update(config[key])
+        self.path = path
+        return True
+
+    # set value by key or "section.key" name and remember it as an override,
+    # ie. for commandline options
+    def set(self, key, value):
+        self.overrides[key] = value
+        self._set(key, value)
+
+    # returns a new Config reloaded from the env vars and loaded file with
+    # overrides re-applied or None if loading failed
+    def reload(self):
+        config = Config()
+        config.load_env()
+        if self.path != "" and not config.load_file(self.path):
+            return None
+        for key, value in self.overrides.items():
+            config.set(key, value)
+        return config
+
+    # returns list of changed "key" or "section.key" names compared to other
+    def diff(self, other):
+        changes = []
+        for key in SCHEMA:
+            if key == "receive": continue
+            mine = getattr(self, key)
+            theirs = getattr(other, key)
+            if isinstance(SCHEMA[key], dict):
+                for subkey in sorted(set(mine) | set(theirs)):
+                    if mine.get(subkey) != theirs.get(subkey):
+                        changes.append(f"{key}.{subkey}")
+            elif mine != theirs:
+                changes.append(key)
+        return changes
+
+    # returns device names for the send devices, skips unknown devices
+    def send_names(self):
+        names = []
+        for key in self.send["devices"]:
+            if key not in self.devices:
+                print(f"ignoring unknown send device: {key}")
+                continue
+            device = self.devices[key]
+            if "name" not in device or device["name"] == "":
+                print(f"ignoring send device without name: {key}")
+                continue
+            names.append(device["name"])
+        return list(dict.fromkeys(names + self.send["names"] + self.extra_names))
+
+    # returns device ids for the receive devices, skips unknown devices
+    def recv_ids(self):
+        ids = []
+        for key in self.recv["devices"]:
+            if key not in self.devices:
+                print(f"ignoring unknown recv device: {key}")
+                continue
+            device = self.devices[key]
+            if "id" not in device or device["id"] == "":
+                print(f"ignoring recv device without id: {key}")
+                continue
+            ids.append(device["id"])
+        return list(dict.fromkeys(ids + self.recv["ids"] + self.extra_ids))
+
+    # returns list of additional send host dicts with "name", "host",
+    # "token", "mqtt_port", and "names" keys, skips hosts without token
+    def send_hosts(self):
+        hosts = []
+        for name, info in self.hosts.items():
+            if info.get("token", "") == "": continue
+            hosts.append({"name": name, "host": info.get("host", ""), "token": info["token"],
+                          "mqtt_port": info.get("mqtt_port", self.send["mqtt_port"]),
+                          "names": info.get("names", [])})
+        return hosts
+
+    # returns list of additional receive host dicts with "name", "host",
+    # "user", "password", "secure", and "ids" keys, skips hosts without ids
+    def recv_hosts(self):
+        hosts = []
+        for name, info in self.hosts.items():
+            if len(info.get("ids", [])) == 0: continue
+            hosts.append({"name": name, "host": info.get("host", ""),
+                          "user": info.get("user", self.user),
+                          "password": info.get("password", self.password),
+                          "secure": info.get("secure", self.secure),
+                          "ids": info["ids"]})
+        return hosts
+
+    # print current values
+    def print(self):
+        print(f"host: {self.host}")
+        print(f"user: {self.user}")
+        print(f"send: {self.send['address']}:{self.send['port']} {self.send_names()}")
+        print(f"recv: {self.recv['address']}:{self.recv['port']} {self.recv_ids()}")
+        print(f"verbose: {self.verbose}")
+
+    # validate JSON config dict against the schema,
+    # returns list of error strings, empty if valid
+    @staticmethod
+    def validate(config):
+        if not isinstance(config, dict):
+            return ["top level must be an object"]
+        errors = Config._check(config, SCHEMA, "")
+        devices = config.get("devices")
+        if isinstance(devices, dict):
+            for key, device in devices.items():
+                if not isinstance(device, dict):
+                    errors.append(f"devices.{key}: expected object")
+                    continue
+                errors += Config._check(device, DEVICE_SCHEMA, f"devices.{key}.")
+        hosts = config.get("hosts")
+        if isinstance(hosts, dict):
+            for name, info in hosts.items():
+                if not isinstance(info, dict):
+                    errors.append(f"hosts.{name}: expected object")
+                    continue
+                if name == DEFAULT_HOST:
+                    errors.append(f"hosts.{name}: name is reserved for the top-level host")
+                errors += Config._check(info, HOST_SCHEMA, f"hosts.{name}.")
+                if info.get("host", "") == "":
+                    errors.append(f"hosts.{name}.host: required")
+        routes = config.get("routes")
+        if isinstance(routes, dict):
+            known = [DEFAULT_HOST] + (list(hosts) if isinstance(hosts, dict) else [])
+            for prefix, names in routes.items():
+                if prefix != "*" and not prefix.startswith("/"):
+                    errors.append(f"routes.{prefix}: expected OSC address prefix, ie. /dev1, or *")
+                if not isinstance(names, list) or not all(isinstance(v, str) for v in names):
+                    errors.append(f"routes.{prefix}: expected list of strings")
+                    continue
+                for name in names:
+                    if name not in known:
+                        errors.append(f"routes.{prefix}: unknown host {name!r}")
+        types = config.get("types", {})
+        encoding = config.get("array_encoding", "list")
+        if isinstance(types, dict) and isinstance(encoding, str):
+            errors += Schema.validate(types, encoding)
+        table = config.get("table")
+        if isinstance(table, dict):
+            for key in ["slots", "address_size", "value_size"]:
+                value = table.get(key, 1)
+                if isinstance(value, int) and value < 1:
+                    errors.append(f"table.{key}: must be > 0")
+            if isinstance(table.get("address_size"), int) and table["address_size"] > 255:
+                errors.append("table.address_size: must be <= 255")
+        aggregate = config.get("aggregate")
+        if isinstance(aggregate, dict) and isinstance(aggregate.get("stats"), list):
+            for stat in aggregate["stats"]:
+                if stat not in STATS:
+                    errors.append(f"aggregate.stats: unknown stat {stat!r}, use: {', '.join(STATS)}")
+        for section in ["send", "recv", "receive"]:
+            values = config.get(section)
+            if not isinstance(values, dict): continue
+            if section != "send" and isinstance(values.get("groups"), dict):
+                errors += Config._check_groups(values["groups"], f"{section}.groups")
+            if section != "send" and isinstance(values.get("attributes"), list):
+                for scope in values["attributes"]:
+                    if scope not in ATTRIBUTE_SCOPES:
+                        errors.append(f"{section}.attributes: unknown scope {scope!r}, use: {', '.join(ATTRIBUTE_SCOPES)}")
+            transport = values.get("transport", "udp")
+            if isinstance(transport, str) and transport not in TRANSPORTS:
+                errors.append(f"{section}.transport: unknown transport {transport!r}, use: {', '.join(TRANSPORTS)}")
+        return errors
+
+    # check recv group query dicts, returns list of error strings
+    @staticmethod
+    def _check_groups(groups, prefix):
+        errors = []
+        for name, group in groups.items():
+            if not isinstance(group, dict):
+                errors.append(f"{prefix}.{name}: expected object")
+                continue
+            errors += Config._check(group, GROUP_SCHEMA, f"{prefix}.{name}.")
+            if not any(group.get(key, "") != "" for key in ["type", "group", "name"]):
+                errors.append(f"{prefix}.{name}: type, group, or name required")
+            elif group.get("group", "") != "" and (group.get("type", "") != "" or group.get("name", "") != ""):
+                errors.append(f"{prefix}.{name}: group can not be combined with type or name")
+            if not group.get("keys"):
+                errors.append(f"{prefix}.{name}.keys: required")
+            page_size = group.get("page_size", 1)
+            if isinstance(page_size, int) and page_size < 1:
+                errors.append(f"{prefix}.{name}.page_size: must be > 0")
+        return errors
+
+    # check dict values against schema, returns list of error strings
+    @staticmethod
+    def _check(values, schema, prefix):
+        errors = []
+        for key, value in values.items():
+            if key not in schema:
+                errors.append(f"{prefix}{key}: unknown key")
+                continue
+            kind = schema[key]
+            if isinstance(kind, dict):
+                if not isinstance(value, dict):
+                    errors.append(f"{prefix}{key}: expected object")
+                else:
+                    errors += Config._check(value, kind, prefix + key + ".")
+            elif kind == list:
+                if not isinstance(value, list) or not all(isinstance(v, str) for v in value):
+                    errors.append(f"{prefix}{key}: expected list of strings")
+            elif kind == float:
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    errors.append(f"{prefix}{key}: expected number")
+            elif kind == int:
+                if isinstance(value, bool) or not isinstance(value, int):
+                    errors.append(f"{prefix}{key}: expected integer")
+            elif not isinstance(value, kind):
+                errors.append(f"{prefix}{key}: expected {kind.__name__}")
+        return errors
+
+    def _set(self, key, value):
+        if "." in key:
+            section, key = key.split(".", 1)
+            getattr(self, section)[key] = copy.copy(value)
+        else:
+            setattr(self, key, copy.copy(value))
+
+# reloads a config file on SIGHUP or when the file changes and passes the
+# new config to a callback which applies it to the running relays
+#
+# invalid files are reported and the current config is kept
+class ConfigWatcher:
+
+    # init with
+    # * config: Config, current config loaded from a file
+    # * callback: async function, called with the new config and a list of
+    #   changed keys, format: async function(config, changes)
+    # additional options:
+    # * interval: float seconds, file change poll interval, 0 disables,
+    #   default: config.watch
+    # * signals: bool, reload on SIGHUP (default True)
+    def __init__(self, config, callback, **kwargs):
+        self.config = config
+        self.callback = callback
+        self.interval = kwargs.get("interval", config.watch) or 0
+        self.signals = kwargs.get("signals", True)
+        self.mtime = self._mtime()
+        self.loop = None
+        self.task = None
+        self.lock = asyncio.Lock() # serialize reloads
+
+    # start watching on the running loop
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        if self.signals and hasattr(signal, "SIGHUP"):
+            self.loop.add_signal_handler(signal.SIGHUP, self.request)
+        if self.interval > 0 and self.config.path != "":
+            self.task = asyncio.create_task(self._poll())
+
+    # stop watching
+    def stop(self):
+        if self.loop and self.signals and hasattr(signal, "SIGHUP"):
+            self.loop.remove_signal_handler(signal.SIGHUP)
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    # request reload from a signal handler
+    def request(self):
+        self.loop.create_task(self.reload())
 
-def load_args(config, args):
-	if args["host"] != None: config["host"] = 
-	return config
+    # reload config and apply changes, returns list of changed keys
+    # or None if reloading failed
+    async def reload(self):
+        async with self.lock:
+            self.mtime = self._mtime()
+            config = self.config.reload()
+            if config == None:
+                print("config reload failed, keeping current config")
+                return None
+            changes = self.config.diff(config)
+            if len(changes) == 0:
+                return changes
+            print(f"config reloaded, changed: {' '.join(changes)}")
+            restart = [key for key in changes if key in RESTART_KEYS or key.split(".")[0] in RESTART_KEYS]
+            if len(restart) > 0:
+                print(f"config changes require a restart: {' '.join(restart)}")
+            try:
+                await self.callback(config, changes)
+            except Exception as exc:
+                # ie. socket.gaierror for an unresolvable address
+                print(f"config reload failed: {exc}, keeping current config")
+                return None
+            self.config = config
+            return changes
 
-def load_file(config, path):
+    # poll file modification time
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if self._mtime() != self.mtime:
+                try:
+                    await self.reload()
+                except Exception as exc:
+                    print(f"config reload failed: {exc}")
 
+    def _mtime(self):
+        try:
+            return os.stat(self.config.path).st_mtime_ns
+        except OSError:
+            return None
@@ -11,6 +11,15 @@
 # Museum“ generously funded by the German Federal Cultural Foundation.
 
 import json
+import struct
+
+try:
+    from .schema import Schema
+except ImportError:
+    from schema import Schema # running as commandline test
+
+# default schema for untyped conversion, infers value types per key
+DEFAULT_SCHEMA = Schema()
 
 # parse a ThingsBoard key/value JSON payload into an OSC message
 # json data as a dictionary
@@ -29,8 +38,12 @@ import json
 #   {"foo": {"bar": 123, "baz": 456}} -> /foo/telemetry bar 123 baz 456
 #   {"baz": [1, 2, 3, 4]}             -> /baz 1 2 3 4
 #
+# values are converted per key using schema, see schema.py,
+# values which can not be converted are skipped, array keys are sent as
+# a single blob of packed values
+#
 # returns (address,args) tuple on success or (None,None) on failure
-def json_to_osc(data):
+def json_to_osc(data, schema=DEFAULT_SCHEMA):
     if len(data) == 0:
         print("json empty")
         return (None, None)
@@ -54,30 +67,225 @@ def json_to_osc(data):
     if len(current) == 1: # single pair
         for key,value in current.items():
             components.append(key)
-            if isinstance(value, list): # break up lists
+            if key in schema.arrays: # packed blob
+                _append_array(args, schema, key, value)
+            elif isinstance(value, list): # break up lists
                 for v in value:
-                    args.append(try_float(v))
+                    _append(args, schema, key, v)
             else:
-                args.append(try_float(value))
+                _append(args, schema, key, value)
             break
     else: # multiple k/v pair /telemetry message
         components.append("telemetry")
         for key,value in current.items():
+            if key in schema.arrays: # packed blob
+                args.append(key)
+                if not _append_array(args, schema, key, value):
+                    args.pop()
+                continue
             if isinstance(value, list):
                 print(f"skipping list in multiple key/value pair message: {key} {value}")
                 continue
             args.append(key)
-            args.append(try_float(value))
+            if not _append(args, schema, key, value):
+                args.pop()
     address = "/" + "/".join(components)
     return (address,args)
 
-# try to convert value to a float, otherwise pass unchanged
-def try_float(value):
+# convert value for key and append to args, returns False if skipped
+def _append(args, schema, key, value):
     try:
-        value = float(value)
-    except:
-        pass
-    return value
+        args.append(schema.osc(key, value))
+    except ValueError as exc:
+        print(f"skipping value: {exc}")
+        return False
+    return True
+
+# pack array value for key and append to args as a blob,
+# returns False if skipped
+def _append_array(args, schema, key, value):
+    try:
+        args.append(schema.osc_array(key, value))
+    except ValueError as exc:
+        print(f"skipping value: {exc}")
+        return False
+    return True
+
+# parse a whole ThingsBoard telemetry update data entry into OSC messages
+# in one pass, data_entry is a dict of key: [[ts, value], ...] with the
+# latest value first, empty and "json" keys are ignored
+#
+# single values & lists:   {"value": [[ts, 123]]} -> [("/value", [123])]
+# nested objects follow the json_to_osc semantics:
+#   {"foo": [[ts, {"bar": 1, "baz": 2}]]} -> [("/foo/telemetry", ["bar", 1, "baz", 2])]
+#
+# array keys are sent as a single blob of packed values, see schema.py
+#
+# prefix: str, address prefix, ie. device name "/dev1"
+# telemetry: bool, return a single prefix + "/telemetry" message with
+#            key/value pairs, uses the first value of lists & nested objects
+#
+# address strings are cached per prefix and key
+#
+# returns list of (address,args) tuples
+def telemetry_to_osc(data_entry, schema=DEFAULT_SCHEMA, prefix="", telemetry=False):
+    messages = []
+    if telemetry:
+        args = []
+        for key,entry in data_entry.items():
+            if key == "" or key == "json": continue
+            value = _value(schema, key, entry[0][1])
+            if value is _SKIP: continue
+            args.append(key)
+            args.append(value)
+        if len(args) > 0:
+            messages.append((_address(prefix, "telemetry"), args))
+        return messages
+    for key,entry in data_entry.items():
+        if key == "" or key == "json": continue
+        value = entry[0][1]
+        arrays = schema.arrays
+        if arrays and key in arrays: # packed blob
+            args = []
+            if _append_array(args, schema, key, value):
+                messages.append((_address(prefix, key), args))
+            continue
+        if isinstance(value, dict): # nested object, rare
+            address,args = json_to_osc({key: value}, schema)
+            if address != None and len(args) > 0:
+                messages.append((prefix + address, args))
+            continue
+        args = []
+        if isinstance(value, list):
+            for v in value:
+                _append(args, schema, key, v)
+        else:
+            _append(args, schema, key, value)
+        if len(args) > 0:
+            messages.append((_address(prefix, key), args))
+    return messages
+
+# encode list of (address,args) tuples as OSC bytes: a single message or an
+# immediate bundle for multiple messages, uses the schema's type tags for
+# declared keys and infers the others from the arg values
+# returns packet bytes or None if messages is empty
+def encode_osc(messages, schema=DEFAULT_SCHEMA):
+    if len(messages) == 0: return None
+    tags = schema.tags
+    if len(messages) == 1:
+        return _encode_message(*messages[0], tags)
+    parts = [_BUNDLE_HEADER]
+    for address,args in messages:
+        message = _encode_message(address, args, tags)
+        parts.append(_INT.pack(len(message)))
+        parts.append(message)
+    return b"".join(parts)
+
+# returns cached address for prefix & key
+def _address(prefix, key):
+    addresses = _addresses.get(prefix)
+    if addresses == None:
+        if len(_addresses) >= _CACHE_SIZE: _addresses.clear()
+        addresses = _addresses[prefix] = {}
+    address = addresses.get(key)
+    if address == None:
+        if len(addresses) >= _CACHE_SIZE: addresses.clear()
+        address = addresses[key] = prefix + "/" + key
+    return address
+
+# returns converted single value for key, first value of lists & nested
+# objects, or _SKIP
+def _value(schema, key, value):
+    if key in schema.arrays:
+        args = []
+        return args[0] if _append_array(args, schema, key, value) else _SKIP
+    if isinstance(value, dict):
+        _,args = json_to_osc({key: value}, schema)
+        return args[0] if args else _SKIP
+    if isinstance(value, list):
+        if len(value) == 0: return _SKIP
+        value = value[0]
+    try:
+        return schema.osc(key, value)
+    except ValueError as exc:
+        print(f"skipping value: {exc}")
+        return _SKIP
+
+##### OSC encoding
+
+_SKIP = object() # skipped value marker
+_CACHE_SIZE = 4096 # max cached addresses per prefix & prefixes
+_addresses = {} # prefix -> key -> address
+_encoded = {} # address -> padded address bytes
+
+_INT = struct.Struct(">i")
+_BUNDLE_HEADER = b"#bundle\0" + struct.pack(">Q", 1) # immediately
+
+# encode OSC message, tags is the schema key -> declared type tag dict
+def _encode_message(address, args, tags):
+    encoded = _encoded.get(address)
+    if encoded == None:
+        if len(_encoded) >= _CACHE_SIZE: _encoded.clear()
+        encoded = _encoded[address] = _pad(address.encode())
+    types = [","]
+    data = []
+    if tags:
+        leaf = address[address.rfind("/") + 1:]
+        if leaf == "telemetry": # key/value pairs
+            key = None
+            for i,arg in enumerate(args):
+                if i % 2 == 0:
+                    key = arg
+                    _encode_arg(arg, None, types, data)
+                else:
+                    _encode_arg(arg, tags.get(key), types, data)
+        else:
+            tag = tags.get(leaf)
+            for arg in args:
+                _encode_arg(arg, tag, types, data)
+    else:
+        for arg in args:
+            _encode_arg(arg, None, types, data)
+    return encoded + _pad("".join(types).encode()) + b"".join(data)
+
+# encode arg value with type tag or infer tag if None,
+# appends to types & data lists
+def _encode_arg(value, tag, types, data):
+    if tag == None:
+        if value is True: tag = "T"
+        elif value is False: tag = "F"
+        elif value is None: tag = "N"
+        elif isinstance(value, int): tag = "i" if value.bit_length() <= 31 else "h"
+        elif isinstance(value, float): tag = "f"
+        elif isinstance(value, str): tag = "s"
+        elif isinstance(value, (bytes, bytearray)): tag = "b"
+        elif isinstance(value, list): # array
+            types.append("[")
+            for v in value: _encode_arg(v, None, types, data)
+            types.append("]")
+            return
+        else: # unsupported, send as string
+            tag = "s"
+            value = str(value)
+    types.append(tag)
+    if tag == "f": data.append(_FLOAT.pack(value))
+    elif tag == "s": data.append(_pad(value.encode()))
+    elif tag == "i": data.append(_INT.pack(value))
+    elif tag == "d": data.append(_DOUBLE.pack(value))
+    elif tag == "h": data.append(_INT64.pack(value))
+    elif tag == "b": data.append(_INT.pack(len(value)) + _pad_blob(bytes(value)))
+
+_FLOAT = struct.Struct(">f")
+_DOUBLE = struct.Struct(">d")
+_INT64 = struct.Struct(">q")
+
+# null terminate and pad string bytes to 4 byte boundary
+def _pad(data):
+    return data + b"\0" * (4 - len(data) % 4)
+
+# pad blob bytes to 4 byte boundary
+def _pad_blob(data):
+    return data + b"\0" * (-len(data) % 4)
 
 # commandline test
 # example usage: ./jsonparser.py '{"foo": {"bar": 123}}'
@@ -0,0 +1,255 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2022 ZKM | Hertz-Lab
+# Dan Wilcox <dan.wilcox@zkm.de>
+#
+# BSD Simplified License.
+# For information on usage and redistribution, and for a DISCLAIMER OF ALL
+# WARRANTIES, see the file, "LICENSE.txt," in this distribution.
+#
+# This code has been developed at ZKM | Hertz-Lab as part of „The Intelligent
+# Museum“ generously funded by the German Federal Cultural Foundation.
+#
+# References:
+# * https://prometheus.io/docs/instrumenting/exposition_formats/
+
+import asyncio
+import bisect
+
+import logging
+logger = logging.getLogger(__name__)
+
+# default latency histogram bucket upper bounds in seconds
+BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+           0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+# relay drop reasons
+DROP_REASONS = ("unknown_device", "invalid_address", "send_failed", "backpressure")
+
+# monotonic counter
+class Counter:
+    __slots__ = ("name", "labels", "value")
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+# gauge, either set directly or read from func when rendered
+class Gauge:
+    __slots__ = ("name", "labels", "value", "func")
+
+    def __init__(self, name, labels, func=None):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+        self.func = func
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        if self.func:
+            try:
+                return self.func()
+            except Exception:
+                return 0
+        return self.value
+
+# fixed bucket histogram, buckets are counted individually and
+# accumulated when rendered
+class Histogram:
+    __slots__ = ("name", "labels", "bounds", "counts", "sum", "count")
+
+    def __init__(self, name, labels, bounds=BUCKETS):
+        self.name = name
+        self.labels = labels
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+# metrics registry with Prometheus text exposition over HTTP and
+# optional periodic /thoscy/stats OSC messages
+#
+# relays only hold a registry (or RelayStats) when metrics are enabled,
+# so disabled instrumentation costs a single None check per message
+class Metrics:
+
+    # init with options:
+    # * address: str, HTTP endpoint address, default: 127.0.0.1
+    # * port: int, HTTP endpoint port, 0 disables
+    # * stats_address: str, OSC stats destination address, default: 127.0.0.1
+    # * stats_port: int, OSC stats destination port, 0 disables
+    # * stats_interval: float seconds, OSC stats interval, default: 5
+    def __init__(self, **kwargs):
+        self.address = kwargs.get("address") or "127.0.0.1"
+        self.port = kwargs.get("port") or 0
+        self.stats_address = kwargs.get("stats_address") or "127.0.0.1"
+        self.stats_port = kwargs.get("stats_port") or 0
+        self.stats_interval = kwargs.get("stats_interval") or 5
+        self.metrics = {} # name -> (type, help, list of metrics)
+        self.server = None
+        self.task = None
+
+    # returns True if either output is enabled
+    @staticmethod
+    def enabled(config):
+        return config != None and (config.get("port", 0) > 0 or config.get("stats_port", 0) > 0)
+
+    # create and register a counter
+    def counter(self, name, help, **labels):
+        return self._add(name, "counter", help, Counter(name, labels))
+
+    # create and register a gauge, func is called when rendered if given
+    def gauge(self, name, help, func=None, **labels):
+        return self._add(name, "gauge", help, Gauge(name, labels, func))
+
+    # create and register a histogram
+    def histogram(self, name, help, bounds=BUCKETS, **labels):
+        return self._add(name, "histogram", help, Histogram(name, labels, bounds))
+
+    # start HTTP endpoint and/or OSC stats on the running loop
+    async def start(self):
+        if self.port > 0:
+            self.server = await asyncio.start_server(self._handle, self.address, self.port)
+            logger.info(f"metrics http://{self.address}:{self.port}/metrics")
+        if self.stats_port > 0:
+            self.task = asyncio.create_task(self._send_stats())
+
+    # stop HTTP endpoint and OSC stats
+    def stop(self):
+        if self.server:
+            self.server.close()
+            self.server = None
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    # render all metrics in the Prometheus text format
+    def render(self):
+        lines = []
+        for name, (kind, help, metrics) in self.metrics.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for metric in metrics:
+                if kind == "histogram":
+                    total = 0
+                    for bound, count in zip(metric.bounds, metric.counts):
+                        total += count
+                        le = Metrics._labels(metric.labels, le=repr(bound))
+                        lines.append(f"{name}_bucket{le} {total}")
+                    le = Metrics._labels(metric.labels, le="+Inf")
+                    lines.append(f"{name}_bucket{le} {metric.count}")
+                    labels = Metrics._labels(metric.labels)
+                    lines.append(f"{name}_sum{labels} {metric.sum}")
+                    lines.append(f"{name}_count{labels} {metric.count}")
+                else:
+                    value = metric.get() if kind == "gauge" else metric.value
+                    lines.append(f"{name}{Metrics._labels(metric.labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    # returns flat key/value pairs for OSC stats,
+    # histograms are reported as count & mean
+    def values(self):
+        values = []
+        for name, (kind, _, metrics) in self.metrics.items():
+            short = name[7:] if name.startswith("thoscy_") else name
+            for metric in metrics:
+                key = "_".join([short] + [str(v) for v in metric.labels.values()])
+                if kind == "histogram":
+                    values.append((key + "_count", metric.count))
+                    values.append((key + "_mean", metric.sum / metric.count if metric.count else 0.0))
+                elif kind == "gauge":
+                    values.append((key, metric.get()))
+                else:
+                    values.append((key, metric.value))
+        return values
+
+    def _add(self, name, kind, help, metric):
+        if name not in self.metrics:
+            self.metrics[name] = (kind, help, [])
+        self.metrics[name][2].append(metric)
+        return metric
+
+    # format labels, ie. {direction="send",stage="convert"}
+    @staticmethod
+    def _labels(labels, **extra):
+        labels = dict(labels, **extra)
+        if len(labels) == 0: return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+    # minimal HTTP handler, serves metrics on any GET path
+    async def _handle(self, reader, writer):
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            if request.startswith(b"GET "):
+                body = self.render().encode()
+                writer.write(b"HTTP/1.1 200 OK\r\n"
+                             b"Content-Type: text/plain; version=0.0.4\r\n"
+                             b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                             b"Connection: close\r\n\r\n" + body)
+            else:
+                writer.write(b"HTTP/1.1 405 Method Not Allowed\r\nContent-Length: 0\r\n"
+                             b"Connection: close\r\n\r\n")
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    # send /thoscy/stats key value pairs periodically
+    async def _send_stats(self):
+        from pythonosc.udp_client import SimpleUDPClient
+        client = SimpleUDPClient(self.stats_address, self.stats_port)
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            args = []
+            for key, value in self.values():
+                args.append(key)
+                args.append(float(value))
+            try:
+                client.send_message("/thoscy/stats", args)
+            except OSError as exc:
+                logger.warning(f"sending stats failed: {exc}")
+
+# per relay direction metric handles
+class RelayStats:
+    __slots__ = ("messages_in", "messages_out", "drops", "stages", "reconnects", "metrics", "direction")
+
+    # init with metrics registry, relay direction name, and stage names
+    def __init__(self, metrics, direction, stages):
+        self.metrics = metrics
+        self.direction = direction
+        self.messages_in = metrics.counter("thoscy_messages_in_total",
+            "messages received by the relay", direction=direction)
+        self.messages_out = metrics.counter("thoscy_messages_out_total",
+            "messages sent by the relay", direction=direction)
+        self.drops = {}
+        for reason in DROP_REASONS:
+            self.drops[reason] = metrics.counter("thoscy_drops_total",
+                "messages dropped by the relay", direction=direction, reason=reason)
+        self.stages = {}
+        for stage in stages:
+            self.stages[stage] = metrics.histogram("thoscy_stage_seconds",
+                "relay stage latency in seconds", direction=direction, stage=stage)
+        self.reconnects = metrics.counter("thoscy_reconnects_total",
+            "server reconnection attempts", direction=direction)
+
+    # register a queue depth gauge in messages read from func
+    def queue(self, name, func):
+        return self.metrics.gauge("thoscy_queue_depth", "queued messages",
+            func=func, direction=self.direction, queue=name)
+
+    # register a queue size gauge in bytes read from func
+    def queue_bytes(self, name, func):
+        return self.metrics.gauge("thoscy_queue_bytes", "queued bytes",
+            func=func, direction=self.direction, queue=name)
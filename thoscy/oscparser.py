@@ -10,6 +10,14 @@
 # This code has been developed at ZKM | Hertz-Lab as part of „The Intelligent
 # Museum“ generously funded by the German Federal Cultural Foundation.
 
+try:
+    from .schema import Schema
+except ImportError:
+    from schema import Schema # running as commandline test
+
+# default schema for untyped conversion, infers value types per key
+DEFAULT_SCHEMA = Schema()
+
 # validates osc message, returns address components as a list or None on failure
 # ex: "/foo/bar" -> ["foo", "bar"], "/" -> None, "abc123" -> None
 def osc_validate(address, args):
@@ -55,8 +63,11 @@ def osc_validate(address, args):
 #   /foo/telemetry bar 123 baz 456 -> {"foo": {"bar": 123, "baz": 456}}
 #   /baz 1 2 3 4       -> {"baz": [1, 2, 3, 4]}
 #
+# values are converted per key using schema, see schema.py,
+# values which can not be converted are skipped
+#
 # returns json data on success or None on failure
-def osc_to_json(address, args):
+def osc_to_json(address, args, schema=DEFAULT_SCHEMA):
 
     # parse address components into keys
     keys = osc_validate(address, args)
@@ -69,12 +80,19 @@ def osc_to_json(address, args):
         if key == keys[-1]: # end of message, set value(s)
             if key == "telemetry": # key/value pairs
                 for a in range(0, len(args), 2):
-                    if type(args[0]) != str:
+                    if type(args[a]) != str:
                         print(f"{address}: arg pair key must be a string, skipping {args[a]} {args[a+1]}")
                         continue
-                    current[args[a]] = args[a+1]
+                    try:
+                        current[args[a]] = _convert(schema, args[a], args[a+1:a+2])
+                    except ValueError as exc:
+                        print(f"{address}: skipping value: {exc}")
             else: # single key with value
-                current[key] = args[0] if len(args) == 1 else args
+                try:
+                    current[key] = _convert(schema, key, args)
+                except ValueError as exc:
+                    print(f"{address}: skipping value: {exc}")
+                    return None
         else: # nest json object
             current[key] = {}
             current = current[key]
@@ -82,6 +100,63 @@ def osc_to_json(address, args):
         return None
     return data
 
+# parse a list of OSC (address,args) tuples, ie. from a bundle, into a single
+# ThingsBoard key/value JSON payload, see osc_to_json for the conversion,
+# later values for the same key replace earlier ones
+#
+# example:
+#   [("/foo/bar", [1]), ("/foo/baz", [2]), ("/qux", [3])]
+#       -> {"foo": {"bar": 1, "baz": 2}, "qux": 3}
+#
+# validated address components are cached per address
+#
+# returns json data on success or None if there is nothing to send
+def osc_to_telemetry(messages, schema=DEFAULT_SCHEMA):
+    data = {}
+    for address,args in messages:
+        keys = _keys.get(address)
+        if keys == None:
+            keys = osc_validate(address, args)
+            if keys == None: continue
+            if len(_keys) >= 4096: _keys.clear()
+            _keys[address] = keys
+        elif len(args) < 1 or (keys[-1] == "telemetry" and (len(args) < 2 or len(args) % 2 != 0)):
+            osc_validate(address, args) # print error
+            continue
+        current = data
+        for key in keys[:-1]:
+            value = current.get(key)
+            if not isinstance(value, dict):
+                value = current[key] = {}
+            current = value
+        key = keys[-1]
+        try:
+            if key == "telemetry": # key/value pairs
+                for a in range(0, len(args), 2):
+                    if type(args[a]) != str:
+                        print(f"{address}: arg pair key must be a string, skipping {args[a]} {args[a+1]}")
+                        continue
+                    current[args[a]] = _convert(schema, args[a], args[a+1:a+2])
+            else:
+                current[key] = _convert(schema, key, args)
+        except ValueError as exc:
+            print(f"{address}: skipping value: {exc}")
+    if len(data) == 0: # nothing to send?
+        return None
+    return data
+
+_keys = {} # address -> validated address components
+
+# convert args for key to a single value or list of values,
+# array keys are packed into a single value, see schema.py,
+# raises ValueError if the value can not be converted
+def _convert(schema, key, args):
+    if key in schema.arrays:
+        return schema.json_array(key, args)
+    if len(args) == 1:
+        return schema.json(key, args[0])
+    return [schema.json(key, arg) for arg in args]
+
 # commandline test
 # example usage: ./oscparser.py /foo/bar 123
 if __name__ == '__main__':
@@ -0,0 +1,274 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2022 ZKM | Hertz-Lab
+# Dan Wilcox <dan.wilcox@zkm.de>
+#
+# BSD Simplified License.
+# For information on usage and redistribution, and for a DISCLAIMER OF ALL
+# WARRANTIES, see the file, "LICENSE.txt," in this distribution.
+#
+# This code has been developed at ZKM | Hertz-Lab as part of „The Intelligent
+# Museum“ generously funded by the German Federal Cultural Foundation.
+#
+# References:
+# * https://opensoundcontrol.stanford.edu/spec-1_1.html
+# * https://datatracker.ietf.org/doc/html/rfc1055
+
+import asyncio
+
+import logging
+logger = logging.getLogger(__name__)
+
+# OSC 1.1 stream transport: OSC packets over TCP framed with double-ended SLIP,
+# each packet is sent as END + escaped packet + END
+#
+# every connection has its own frame decoder and write buffer:
+# * reading: received data is scanned for frame ends as it arrives and
+#   only complete frames are copied out of the connection buffer
+# * writing: packets sent within the same loop iteration are coalesced into
+#   a single socket write, while the socket is paused by the event loop
+#   (slow peer), packets are buffered up to a per connection limit and
+#   dropped once it is reached, so one slow peer does not stall the others
+
+END = b"\xc0"
+ESC = b"\xdb"
+ESC_END = b"\xdb\xdc"
+ESC_ESC = b"\xdb\xdd"
+
+MAX_FRAME = 1 << 20 # max decoded frame size in bytes, larger frames close the connection
+LIMIT = 1 << 20 # default per connection write buffer limit in bytes
+
+TRANSPORTS = ("udp", "tcp")
+
+# SLIP encode packet as double-ended frame
+def slip_encode(packet):
+    if ESC in packet: packet = packet.replace(ESC, ESC_ESC)
+    if END in packet: packet = packet.replace(END, ESC_END)
+    return END + packet + END
+
+# SLIP decode frame contents without END bytes
+def slip_decode(frame):
+    if ESC in frame:
+        # ESC_END first: an escape's second byte is never ESC, so this can not
+        # match across escapes
+        frame = frame.replace(ESC_END, END).replace(ESC_ESC, ESC)
+    return frame
+
+# incremental SLIP frame decoder
+class SlipDecoder:
+
+    def __init__(self, max_size=MAX_FRAME):
+        self.buffer = bytearray()
+        self.scan = 0 # buffer position to continue searching for END from
+        self.max_size = max_size
+
+    # append received data and return list of complete decoded frames,
+    # empty frames between END bytes are skipped,
+    # raises ValueError if an incomplete frame exceeds the max size
+    def feed(self, data):
+        buffer = self.buffer
+        buffer += data
+        frames = []
+        start = 0
+        with memoryview(buffer) as view:
+            while True:
+                end = buffer.find(END, self.scan)
+                if end < 0: break
+                if end > start:
+                    frames.append(slip_decode(bytes(view[start:end])))
+                start = end + 1
+                self.scan = start
+        if start > 0:
+            del buffer[:start] # compact once per call
+        self.scan = len(buffer)
+        if self.scan > self.max_size:
+            raise ValueError(f"frame exceeds {self.max_size} bytes")
+        return frames
+
+# asyncio protocol for a single OSC stream connection
+class _Connection(asyncio.Protocol):
+
+    def __init__(self, owner):
+        self.owner = owner
+        self.decoder = SlipDecoder(owner.max_size)
+        self.transport = None
+        self.peer = None
+        self.pending = [] # encoded frames waiting for the next write
+        self.size = 0 # pending bytes
+        self.paused = False # socket write buffer above high water mark?
+        self.scheduled = False # flush scheduled?
+        self.closed = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peer = transport.get_extra_info("peername")
+        self.owner._connected(self)
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self.pending = []
+        self.size = 0
+        self.owner._disconnected(self)
+        if not self.closed.done(): self.closed.set_result(exc)
+
+    def data_received(self, data):
+        try:
+            frames = self.decoder.feed(data)
+        except ValueError as exc:
+            logger.warning(f"osc tcp {self.peer}: {exc}, closing")
+            self.transport.abort()
+            return
+        callback = self.owner.callback
+        if callback:
+            for frame in frames:
+                callback(frame, self.peer)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        if self.size > 0: self._flush()
+
+    # queue packet for the next coalesced write,
+    # returns False if the connection is closed or its write buffer is full
+    def send(self, packet):
+        if self.transport == None: return False
+        frame = slip_encode(packet)
+        if self.size + len(frame) > self.owner.limit:
+            return False
+        self.pending.append(frame)
+        self.size += len(frame)
+        if not self.scheduled and not self.paused:
+            self.scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush)
+        return True
+
+    # write pending frames in a single call, keeps them while paused
+    def _flush(self):
+        self.scheduled = False
+        if self.paused or self.transport == None or self.size == 0: return
+        data = self.pending[0] if len(self.pending) == 1 else b"".join(self.pending)
+        self.pending = []
+        self.size = 0
+        self.transport.write(data)
+
+# OSC stream server: accepts any number of connections, calls callback for
+# each received packet and sends packets to all connected peers
+class OSCStreamServer:
+
+    # init with
+    # * address: str, listen address
+    # * port: int, listen port
+    # additional options:
+    # * callback: function, called for each received OSC packet,
+    #   format: function(packet, peer)
+    # * limit: int, per connection write buffer limit in bytes, default: 1 MB
+    # * max_size: int, max received packet size in bytes, default: 1 MB
+    def __init__(self, address, port, **kwargs):
+        self.address = address
+        self.port = port
+        self.callback = kwargs.get("callback")
+        self.limit = kwargs.get("limit") or LIMIT
+        self.max_size = kwargs.get("max_size") or MAX_FRAME
+        self.connections = set()
+        self.server = None
+
+    # start listening on the running loop
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(lambda: _Connection(self), self.address, self.port)
+
+    # send packet to all connected peers, returns False if any peer dropped it
+    def send(self, packet):
+        sent = True
+        for connection in self.connections:
+            if not connection.send(packet): sent = False
+        return sent
+
+    # returns pending write buffer size in bytes summed over all connections
+    def queued(self):
+        return sum(connection.size for connection in self.connections)
+
+    # stop listening and close all connections
+    def close(self):
+        if self.server:
+            self.server.close()
+            self.server = None
+        for connection in list(self.connections):
+            if connection.transport: connection.transport.close()
+
+    def _connected(self, connection):
+        self.connections.add(connection)
+        logger.info(f"osc tcp {connection.peer} connected")
+
+    def _disconnected(self, connection):
+        self.connections.discard(connection)
+        logger.info(f"osc tcp {connection.peer} disconnected")
+
+# OSC stream client: connects to a server and reconnects when the
+# connection is lost, received packets are passed to the callback
+class OSCStreamClient:
+
+    # init with
+    # * address: str, server address
+    # * port: int, server port
+    # additional options:
+    # * callback: function, called for each received OSC packet,
+    #   format: function(packet, peer)
+    # * limit: int, write buffer limit in bytes, default: 1 MB
+    # * max_size: int, max received packet size in bytes, default: 1 MB
+    # * reconnect: float seconds, delay between connection attempts, default: 1
+    def __init__(self, address, port, **kwargs):
+        self.address = address
+        self.port = port
+        self.callback = kwargs.get("callback")
+        self.limit = kwargs.get("limit") or LIMIT
+        self.max_size = kwargs.get("max_size") or MAX_FRAME
+        self.reconnect = kwargs.get("reconnect") or 1
+        self.connection = None
+        self.task = None
+
+    # start connecting on the running loop
+    async def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    # send packet to the server, returns False if not connected or the
+    # write buffer is full
+    def send(self, packet):
+        if self.connection == None: return False
+        return self.connection.send(packet)
+
+    # returns pending write buffer size in bytes
+    def queued(self):
+        return self.connection.size if self.connection else 0
+
+    # stop reconnecting and close the connection
+    def close(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        if self.connection and self.connection.transport:
+            self.connection.transport.close()
+
+    # (re)connect until cancelled
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        failed = False
+        while True:
+            try:
+                _, connection = await loop.create_connection(lambda: _Connection(self), self.address, self.port)
+                failed = False
+                await connection.closed
+            except OSError as exc:
+                if not failed: logger.warning(f"osc tcp {self.address}:{self.port} connect failed: {exc}")
+                failed = True # only report the first of repeated failures
+            await asyncio.sleep(self.reconnect)
+
+    def _connected(self, connection):
+        self.connection = connection
+        logger.info(f"osc tcp {self.address}:{self.port} connected")
+
+    def _disconnected(self, connection):
+        if self.connection is connection: self.connection = None
+        logger.info(f"osc tcp {self.address}:{self.port} disconnected")
@@ -0,0 +1,218 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2022 ZKM | Hertz-Lab
+# Dan Wilcox <dan.wilcox@zkm.de>
+#
+# BSD Simplified License.
+# For information on usage and redistribution, and for a DISCLAIMER OF ALL
+# WARRANTIES, see the file, "LICENSE.txt," in this distribution.
+#
+# This code has been developed at ZKM | Hertz-Lab as part of „The Intelligent
+# Museum“ generously funded by the German Federal Cultural Foundation.
+#
+# References:
+# * https://docs.python.org/3/library/profile.html
+# * https://docs.python.org/3/library/tracemalloc.html
+
+import asyncio
+import signal
+import traceback
+import threading
+import sys
+import os
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+# on-demand profiling for a running relay, triggered by signals or commands
+# on a local TCP control port:
+#
+# * SIGUSR1 or "profile [SECONDS]": run cProfile on the event loop thread for
+#   the given duration, then write .pstats and sorted .txt summary files
+# * SIGUSR2 or "malloc": take a tracemalloc snapshot and write the top
+#   allocation differences to the previous snapshot, the first request starts
+#   tracing, "malloc stop" stops tracing
+# * SIGQUIT or "stacks": write the stacks of all threads and asyncio tasks
+# * "trace": write the message tracer ring buffer, if a tracer is set
+#
+# output files are written to the output directory and named by tool,
+# process id, and timestamp, ie. thoscy-send-1234-20220728-120000-profile.txt
+#
+# nothing is traced or profiled until requested, so idle overhead is zero
+class Profiler:
+
+    # init with
+    # * directory: str, output directory
+    # additional options:
+    # * name: str, file name prefix, default: thoscy
+    # * duration: float seconds, default profile duration, default: 10
+    # * port: int, TCP control port on localhost, 0 disables (default)
+    # * signals: bool, install signal handlers (default True)
+    # * limit: int, number of entries in text summaries, default: 40
+    # * tracer: Tracer, message tracer to dump on request
+    def __init__(self, directory, **kwargs):
+        self.directory = directory
+        self.name = kwargs.get("name") or "thoscy"
+        self.duration = kwargs.get("duration") or 10
+        self.port = kwargs.get("port") or 0
+        self.signals = kwargs.get("signals", True)
+        self.limit = kwargs.get("limit") or 40
+        self.tracer = kwargs.get("tracer") or None
+        self.profile = None # running cProfile.Profile
+        self.profile_path = None # running profile output path
+        self.profile_timer = None
+        self.snapshot = None # last tracemalloc snapshot
+        self.server = None
+        self.loop = None
+
+    # returns True if profiling is configured
+    @staticmethod
+    def enabled(config):
+        return config != None and (config.get("directory", "") != "" or config.get("port", 0) > 0)
+
+    # install signal handlers and/or start control port on the running loop
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        if self.signals and hasattr(signal, "SIGUSR1"):
+            self.loop.add_signal_handler(signal.SIGUSR1, self.start_profile)
+            self.loop.add_signal_handler(signal.SIGUSR2, self.malloc)
+            self.loop.add_signal_handler(signal.SIGQUIT, self.stacks)
+        if self.port > 0:
+            self.server = await asyncio.start_server(self._handle, "127.0.0.1", self.port)
+
+    # remove signal handlers, stop control port and write any running profile
+    def stop(self):
+        if self.loop and self.signals and hasattr(signal, "SIGUSR1"):
+            for sig in (signal.SIGUSR1, signal.SIGUSR2, signal.SIGQUIT):
+                self.loop.remove_signal_handler(sig)
+        if self.server:
+            self.server.close()
+            self.server = None
+        if self.profile:
+            self._stop_profile(self.profile_path)
+
+    # start cProfile for duration seconds, returns output path or None if
+    # already running
+    def start_profile(self, duration=None):
+        if self.profile:
+            logger.warning("profile already running")
+            return None
+        import cProfile
+        duration = duration or self.duration
+        path = self._path("profile")
+        self.profile = cProfile.Profile()
+        self.profile_path = path
+        self.profile.enable()
+        self.profile_timer = self.loop.call_later(duration, self._stop_profile, path)
+        logger.warning(f"profiling for {duration} s -> {path}.txt")
+        return path + ".txt"
+
+    # take tracemalloc snapshot and write diff to previous snapshot,
+    # starts tracing on first call, returns output path
+    def malloc(self, stop=False):
+        import tracemalloc
+        if stop:
+            tracemalloc.stop()
+            self.snapshot = None
+            logger.warning("tracemalloc stopped")
+            return None
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+            self.snapshot = tracemalloc.take_snapshot()
+            logger.warning("tracemalloc started, request again to write differences")
+            return None
+        snapshot = tracemalloc.take_snapshot()
+        snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+        stats = snapshot.compare_to(self.snapshot, "traceback")
+        self.snapshot = snapshot
+        current, peak = tracemalloc.get_traced_memory()
+        path = self._path("malloc") + ".txt"
+        with open(path, "w") as f:
+            f.write(f"traced memory: current {current} B, peak {peak} B\n\n")
+            for stat in stats[:self.limit]:
+                f.write(f"{stat}\n")
+                for line in stat.traceback.format(limit=10):
+                    f.write(f"  {line}\n")
+                f.write("\n")
+        logger.warning(f"tracemalloc differences -> {path}")
+        return path
+
+    # write stacks of all threads and asyncio tasks, returns output path
+    def stacks(self):
+        path = self._path("stacks") + ".txt"
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        with open(path, "w") as f:
+            for ident, frame in sys._current_frames().items():
+                f.write(f"thread {names.get(ident, '?')} ({ident}):\n")
+                f.write("".join(traceback.format_stack(frame)))
+                f.write("\n")
+            if self.loop:
+                for task in asyncio.all_tasks(self.loop):
+                    f.write(f"task {task.get_name()}: {task.get_coro()}\n")
+                    task.print_stack(file=f)
+                    f.write("\n")
+        logger.warning(f"stacks -> {path}")
+        return path
+
+    # write message tracer ring buffer, returns output path or None if
+    # there is no tracer
+    def trace(self):
+        if not self.tracer: return None
+        path = self._path("trace") + ".txt"
+        count = self.tracer.dump(path)
+        logger.warning(f"{count} trace record(s) -> {path}")
+        return path
+
+    # stop running profile and write stats
+    def _stop_profile(self, path):
+        import pstats
+        profile = self.profile
+        self.profile = None
+        if not profile: return
+        profile.disable()
+        self.profile_timer.cancel()
+        self.profile_timer = None
+        profile.dump_stats(path + ".pstats")
+        with open(path + ".txt", "w") as f:
+            stats = pstats.Stats(profile, stream=f)
+            stats.sort_stats("cumulative").print_stats(self.limit)
+            stats.sort_stats("tottime").print_stats(self.limit)
+        logger.warning(f"profile written -> {path}.txt")
+
+    # returns timestamped output path without extension
+    def _path(self, kind):
+        os.makedirs(self.directory or ".", exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        return os.path.join(self.directory or ".", f"{self.name}-{os.getpid()}-{stamp}-{kind}")
+
+    # control port handler, one command per line, replies with the output path
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line: break
+                words = line.decode().split()
+                if len(words) == 0: continue
+                reply = None
+                try:
+                    if words[0] == "profile":
+                        reply = self.start_profile(float(words[1]) if len(words) > 1 else None)
+                        reply = reply or "profile already running"
+                    elif words[0] == "malloc":
+                        stop = len(words) > 1 and words[1] == "stop"
+                        reply = self.malloc(stop) or ("stopped" if stop else "started")
+                    elif words[0] == "stacks":
+                        reply = self.stacks()
+                    elif words[0] == "trace":
+                        reply = self.trace() or "tracing disabled"
+                    else:
+                        reply = "unknown command, use: profile [SECONDS], malloc [stop], stacks, trace"
+                except (OSError, ValueError) as exc:
+                    reply = f"error: {exc}"
+                writer.write((reply + "\n").encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
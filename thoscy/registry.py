@@ -0,0 +1,135 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2022 ZKM | Hertz-Lab
+# Dan Wilcox <dan.wilcox@zkm.de>
+#
+# BSD Simplified License.
+# For information on usage and redistribution, and for a DISCLAIMER OF ALL
+# WARRANTIES, see the file, "LICENSE.txt," in this distribution.
+#
+# This code has been developed at ZKM | Hertz-Lab as part of „The Intelligent
+# Museum“ generously funded by the German Federal Cultural Foundation.
+
+import re
+
+# non-alphanumeric chars stripped from device names for OSC address keys
+NORMALIZE_RE = re.compile(r"[\W_]+")
+
+# returns OSC address key for device name: stripped of non-alphanumeric
+# chars and made lowercase, ie. "Device 1" -> "device1"
+def normalize(name):
+    return NORMALIZE_RE.sub("", name).lower()
+
+# device record, unknown values are None
+class Device:
+    __slots__ = ("key", "name", "id", "cmd_id", "scopes")
+
+    def __init__(self, key=None, name=None, device_id=None, cmd_id=None):
+        self.key = key # OSC address key prefix
+        self.name = name # device name as shown in ThingsBoard UI
+        self.id = device_id # ThingsBoard device id
+        self.cmd_id = cmd_id # telemetry subscription cmdId
+        self.scopes = None # attribute scope -> subscription cmdId, if any
+
+    def __repr__(self):
+        return f"Device(key={self.key!r}, name={self.name!r}, id={self.id!r}, cmd_id={self.cmd_id!r})"
+
+# device registry shared by both relay directions with constant time lookups
+# by OSC address key, device name, device id, and subscription cmdId
+#
+# devices are kept as slotted records indexed by each known value, so a
+# device costs one small record plus one dict entry per index, which keeps
+# 10k+ devices cheap, keys are unique: adding or naming a device with the
+# key of another device is refused
+#
+# the send direction registers devices by name, the receive direction by id
+# and telemetry cmdId and sets the name & key once the device info has been
+# fetched, attribute subscription cmdIds resolve to the same device
+class Registry:
+
+    def __init__(self):
+        self.devices = {} # Device -> None, ordered set
+        self.keys = {} # OSC address key -> Device
+        self.names = {} # device name -> Device
+        self.ids = {} # device id -> Device
+        self.cmd_ids = {} # telemetry & attribute subscription cmdId -> Device
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __iter__(self):
+        return iter(self.devices)
+
+    # add device, key is normalized from name if not given,
+    # returns new Device or None if the key, id, or cmdId is already registered
+    def add(self, name=None, device_id=None, cmd_id=None, key=None):
+        if key == None and name != None: key = normalize(name)
+        if (key != None and key in self.keys) or \
+           (device_id != None and device_id in self.ids) or \
+           (cmd_id != None and cmd_id in self.cmd_ids):
+            return None
+        device = Device(key, name, device_id, cmd_id)
+        self.devices[device] = None
+        if key != None: self.keys[key] = device
+        if name != None: self.names[name] = device
+        if device_id != None: self.ids[device_id] = device
+        if cmd_id != None: self.cmd_ids[cmd_id] = device
+        return device
+
+    # remove device and all of its indices
+    def remove(self, device):
+        if device not in self.devices: return
+        del self.devices[device]
+        if device.key != None: self.keys.pop(device.key, None)
+        if device.name != None and self.names.get(device.name) is device:
+            del self.names[device.name]
+        if device.id != None: self.ids.pop(device.id, None)
+        if device.cmd_id != None: self.cmd_ids.pop(device.cmd_id, None)
+        if device.scopes:
+            for cmd_id in device.scopes.values():
+                self.cmd_ids.pop(cmd_id, None)
+
+    # set device name and its normalized key,
+    # returns False if the key belongs to another device, the key is then unset
+    def set_name(self, device, name):
+        if device.name != None and self.names.get(device.name) is device:
+            del self.names[device.name]
+        device.name = name
+        self.names[name] = device
+        key = normalize(name)
+        if device.key == key: return True
+        if device.key != None: self.keys.pop(device.key, None)
+        other = self.keys.get(key)
+        if other != None and other is not device:
+            device.key = None
+            return False
+        device.key = key
+        self.keys[key] = device
+        return True
+
+    # register attribute subscription cmdId for device & scope
+    def add_scope(self, device, scope, cmd_id):
+        if device.scopes == None: device.scopes = {}
+        device.scopes[scope] = cmd_id
+        self.cmd_ids[cmd_id] = device
+
+    # unregister attribute subscription for device & scope
+    def remove_scope(self, device, scope):
+        if not device.scopes: return
+        cmd_id = device.scopes.pop(scope, None)
+        if cmd_id != None: self.cmd_ids.pop(cmd_id, None)
+        if len(device.scopes) == 0: device.scopes = None
+
+    # lookups, return Device or None
+
+    def by_key(self, key):
+        return self.keys.get(key)
+
+    def by_name(self, name):
+        return self.names.get(name)
+
+    def by_id(self, device_id):
+        return self.ids.get(device_id)
+
+    def by_cmd_id(self, cmd_id):
+        return self.cmd_ids.get(cmd_id)
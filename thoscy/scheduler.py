@@ -0,0 +1,155 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2022 ZKM | Hertz-Lab
+# Dan Wilcox <dan.wilcox@zkm.de>
+#
+# BSD Simplified License.
+# For information on usage and redistribution, and for a DISCLAIMER OF ALL
+# WARRANTIES, see the file, "LICENSE.txt," in this distribution.
+#
+# This code has been developed at ZKM | Hertz-Lab as part of „The Intelligent
+# Museum“ generously funded by the German Federal Cultural Foundation.
+
+import asyncio
+import time
+
+# frame-clocked OSC output: keeps a latest-value table of received OSC
+# messages and passes the messages which changed since the last tick to a
+# callback once per tick, so the output packet rate is bounded by the tick
+# rate no matter how bursty the input is
+#
+# values are tracked per OSC address, /telemetry key/value pair messages are
+# tracked per key and only the changed pairs are sent
+#
+# with interpolation, numeric values ramp linearly from the current output
+# value to a new value over the time since the key's previous update, ie.
+# a sensor updating at 5 Hz is output as a smooth ramp at 60 Hz, ints stay
+# ints and non-numeric values are sent as is
+class OutputScheduler:
+
+    # init with
+    # * rate: float, ticks per second, ie. 30 or 60
+    # * callback: function, called per tick with the changed messages,
+    #   format: function(messages) with messages as a list of (address,args)
+    # additional options:
+    # * interpolate: bool, interpolate numeric values? (default False)
+    # * max_ramp: float seconds, max interpolation ramp duration, default: 1
+    def __init__(self, rate, callback, **kwargs):
+        self.rate = rate
+        self.period = 1 / rate
+        self.callback = callback
+        self.interpolate = kwargs.get("interpolate") or False
+        self.max_ramp = kwargs.get("max_ramp") or 1
+        self.slots = {} # (address, pair key or None) -> _Slot
+        self.changed = {} # slots to send next tick, ordered set
+        self.task = None
+
+    # start ticking on the running loop
+    async def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    # stop ticking, pending changes are sent immediately if flush is True
+    def stop(self, flush=False):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        if flush:
+            for slot in self.changed: slot.origin = None # skip ramps
+            self.tick()
+
+    # update table with list of (address,args) tuples, sent on the next tick
+    def update(self, messages):
+        now = time.monotonic()
+        for address,args in messages:
+            if address.endswith("/telemetry"): # key/value pairs
+                for i in range(0, len(args) - 1, 2):
+                    self._set((address, args[i]), [args[i + 1]], now)
+            else:
+                self._set((address, None), args, now)
+
+    # send changed and interpolated values, called by the tick loop
+    def tick(self, now=None):
+        if len(self.changed) == 0: return
+        if now == None: now = time.monotonic()
+        messages = []
+        pairs = {} # address -> key/value pair args
+        for slot in list(self.changed):
+            args = slot.output(now)
+            if slot.origin == None: # done
+                del self.changed[slot]
+            if args == slot.sent: continue
+            slot.sent = args
+            address,key = slot.name
+            if key == None:
+                messages.append((address, args))
+            else:
+                pairs.setdefault(address, []).extend((key, args[0]))
+        messages.extend(pairs.items())
+        if len(messages) > 0:
+            self.callback(messages)
+
+    # set latest args for slot name, starts a ramp from the current output
+    # if interpolating numbers
+    def _set(self, name, args, now):
+        slot = self.slots.get(name)
+        if slot == None:
+            slot = self.slots[name] = _Slot(name)
+        elif args == slot.args: # repeated value, keep ramp & update time
+            return
+        elif self.interpolate and slot.sent != None and \
+             len(args) == len(slot.args) and _numeric(args) and _numeric(slot.args):
+            slot.origin = slot.output(now)
+            slot.start = now
+            slot.duration = min(max(now - slot.updated, self.period), self.max_ramp)
+        else:
+            slot.origin = None
+        slot.args = args
+        slot.updated = now
+        self.changed[slot] = None
+
+    # tick at a fixed rate without drift, missed ticks are skipped
+    async def _run(self):
+        deadline = time.monotonic()
+        while True:
+            deadline += self.period
+            delay = deadline - time.monotonic()
+            if delay < 0: # fell behind
+                deadline -= delay
+                delay = 0
+            await asyncio.sleep(delay)
+            self.tick()
+
+# latest value table entry
+class _Slot:
+    __slots__ = ("name", "args", "sent", "updated", "origin", "start", "duration")
+
+    def __init__(self, name):
+        self.name = name # (address, pair key or None)
+        self.args = None # latest args
+        self.sent = None # last sent args
+        self.updated = 0 # last update time
+        self.origin = None # ramp start args or None if not ramping
+        self.start = 0 # ramp start time
+        self.duration = 0 # ramp duration
+
+    # returns output args at time now, ends ramp when done
+    def output(self, now):
+        if self.origin == None:
+            return self.args
+        frac = (now - self.start) / self.duration
+        if frac >= 1:
+            self.origin = None
+            return self.args
+        return [_lerp(a, b, frac) for a,b in zip(self.origin, self.args)]
+
+# returns True if all args are int or float, bools are not numbers here
+def _numeric(args):
+    for arg in args:
+        if type(arg) is not int and type(arg) is not float:
+            return False
+    return True
+
+# linear interpolation from a to b, int targets are rounded
+def _lerp(a, b, frac):
+    value = a + (b - a) * frac
+    return round(value) if type(b) is int else value
@@ -0,0 +1,324 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2022 ZKM | Hertz-Lab
+# Dan Wilcox <dan.wilcox@zkm.de>
+#
+# BSD Simplified License.
+# For information on usage and redistribution, and for a DISCLAIMER OF ALL
+# WARRANTIES, see the file, "LICENSE.txt," in this distribution.
+#
+# This code has been developed at ZKM | Hertz-Lab as part of „The Intelligent
+# Museum“ generously funded by the German Federal Cultural Foundation.
+
+from array import array
+import binascii
+import base64
+import sys
+import re
+
+# value types and their OSC type tags, None uses the value's own type
+TYPES = {
+    "int32": "i",
+    "int64": "h",
+    "float": "f",
+    "double": "d",
+    "bool": None, # T or F
+    "string": "s",
+    "blob": "b",
+    "float32_array": "b",
+    "int16_array": "b"
+}
+
+# packed numeric array types: type name -> array typecode, arrays are sent
+# as OSC blobs with big-endian (network byte order) values
+ARRAYS = {
+    "float32_array": "f",
+    "int16_array": "h"
+}
+
+# array encodings for the ThingsBoard side:
+# * list: JSON array of numbers
+# * base64: compact base64 string of the packed big-endian OSC blob data
+ENCODINGS = ("list", "base64")
+
+INT32_MIN = -2**31
+INT32_MAX = 2**31 - 1
+
+# number patterns used to infer the type of the first string sample
+INT_RE = re.compile(r"[-+]?\d+\Z")
+FLOAT_RE = re.compile(r"[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\Z")
+
+# per-key value type schema for converting telemetry values between
+# ThingsBoard JSON and OSC
+#
+# declared keys are compiled once into converter functions which coerce
+# values to the declared type, ie. "1" -> 1 for int32 or 1 -> 1.0 for float
+#
+# unknown keys use the type inferred from the first sample, the converter is
+# then cached per key and only re-inferred if a later value does not fit,
+# ie. an int key is widened to float when receiving 1.5
+#
+# array keys convert whole values instead of single values: OSC blobs of
+# packed data or multiple number args <-> JSON number arrays or base64 strings,
+# packing and unpacking is done by array buffers and does not create Python
+# objects per element, except for JSON number arrays
+#
+# keys are telemetry key names, nested values use the innermost key
+class Schema:
+
+    # init with types: dict, key -> type name, see TYPES
+    # additional options:
+    # * encoding: str, ThingsBoard array encoding, see ENCODINGS, default: list
+    def __init__(self, types=None, encoding="list"):
+        self.types = dict(types or {})
+        self.encoding = encoding or "list"
+        self.to_osc = {} # key -> converter for OSC values
+        self.to_json = {} # key -> converter for JSON values
+        self.tags = {} # key -> OSC type tag for declared keys
+        self.arrays = {} # key -> array typecode for array keys
+        if self.encoding not in ENCODINGS:
+            raise ValueError(f"unknown array encoding: {self.encoding}")
+        for key, name in self.types.items():
+            if name not in TYPES:
+                raise ValueError(f"unknown type for {key}: {name}")
+            if name in ARRAYS:
+                self.arrays[key] = ARRAYS[name]
+                self.tags[key] = TYPES[name]
+                continue
+            self.to_osc[key] = COERCE[name]
+            self.to_json[key] = COERCE_JSON.get(name, COERCE[name])
+            if TYPES[name]: self.tags[key] = TYPES[name]
+
+    # convert TB JSON value for key to OSC value,
+    # raises ValueError if the value does not fit a declared type
+    def osc(self, key, value):
+        convert = self.to_osc.get(key)
+        if convert == None:
+            convert = self.to_osc[key] = Schema._infer(value, True)
+        try:
+            return convert(value)
+        except (ValueError, TypeError, OverflowError):
+            if key in self.types: raise ValueError(f"{key}: {value!r} is not {self.types[key]}")
+            convert = self.to_osc[key] = Schema._infer(value, True)
+            return convert(value)
+
+    # convert OSC value for key to TB JSON value,
+    # raises ValueError if the value does not fit a declared type
+    def json(self, key, value):
+        convert = self.to_json.get(key)
+        if convert == None:
+            convert = self.to_json[key] = Schema._infer(value, False)
+        try:
+            return convert(value)
+        except (ValueError, TypeError, OverflowError):
+            if key in self.types: raise ValueError(f"{key}: {value!r} is not {self.types[key]}")
+            convert = self.to_json[key] = Schema._infer(value, False)
+            return convert(value)
+
+    # convert TB JSON array value for array key to OSC blob bytes, value is a
+    # list of numbers, base64 string, or packed bytes,
+    # raises ValueError if the value can not be packed
+    def osc_array(self, key, value):
+        try:
+            return pack(value, self.arrays[key])
+        except (ValueError, TypeError, OverflowError, binascii.Error):
+            raise ValueError(f"{key}: invalid {self.types[key]} value")
+
+    # convert OSC args for array key to TB JSON array value using the
+    # encoding, args is either a single blob or buffer or multiple numbers,
+    # raises ValueError if the value can not be packed
+    def json_array(self, key, args):
+        typecode = self.arrays[key]
+        value = args[0] if len(args) == 1 else args
+        try:
+            if self.encoding == "base64":
+                return base64.b64encode(pack(value, typecode)).decode()
+            if isinstance(value, (list, tuple)):
+                return _array(typecode, value).tolist()
+            return unpack(pack(value, typecode), typecode).tolist()
+        except (ValueError, TypeError, OverflowError, binascii.Error):
+            raise ValueError(f"{key}: invalid {self.types[key]} value")
+
+    # returns OSC type tag for key or None to use the value's own type
+    def tag(self, key):
+        return self.tags.get(key)
+
+    # validate types dict, returns list of error strings, empty if valid
+    @staticmethod
+    def validate(types, encoding="list"):
+        errors = []
+        for key, name in types.items():
+            if name not in TYPES:
+                errors.append(f"types.{key}: unknown type {name!r}, use: {', '.join(TYPES)}")
+        if encoding not in ENCODINGS:
+            errors.append(f"array_encoding: unknown encoding {encoding!r}, use: {', '.join(ENCODINGS)}")
+        return errors
+
+    # returns strict converter for the type of value,
+    # parse: try to parse numbers & bools from strings (TB values are strings)
+    @staticmethod
+    def _infer(value, parse):
+        if isinstance(value, bool):
+            return _bool
+        if isinstance(value, int):
+            return _int
+        if isinstance(value, float):
+            return _float
+        if isinstance(value, str):
+            if parse:
+                if value == "true" or value == "false":
+                    return _bool
+                if INT_RE.match(value):
+                    return _int
+                if FLOAT_RE.match(value):
+                    return _float
+            return _string
+        if isinstance(value, (bytes, bytearray)):
+            return _blob if parse else _blob_json
+        return _any
+
+##### inferred converters, raise if the value does not fit
+
+# strings are parsed directly, which only raises if the key's type changed
+def _int(value):
+    if type(value) is str or (isinstance(value, int) and not isinstance(value, bool)):
+        return int(value)
+    raise ValueError()
+
+def _float(value):
+    if type(value) is str or type(value) is float or \
+       (isinstance(value, int) and not isinstance(value, bool)):
+        return float(value)
+    raise ValueError()
+
+def _bool(value):
+    if isinstance(value, bool):
+        return value
+    if value == "true": return True
+    if value == "false": return False
+    raise ValueError()
+
+def _string(value):
+    if isinstance(value, str):
+        return value
+    raise ValueError()
+
+def _blob(value):
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value)
+    raise ValueError()
+
+# JSON has no binary type, blobs are sent as base64 strings
+def _blob_json(value):
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(value).decode()
+    raise ValueError()
+
+def _any(value):
+    return value
+
+##### declared converters, coerce the value to the type
+
+def _to_int32(value):
+    value = _to_int64(value)
+    if value < INT32_MIN or value > INT32_MAX:
+        raise OverflowError()
+    return value
+
+def _to_int64(value):
+    if isinstance(value, str):
+        return int(value) if INT_RE.match(value) else int(float(value))
+    return int(value)
+
+def _to_float(value):
+    return float(value)
+
+def _to_bool(value):
+    if isinstance(value, str):
+        value = value.lower()
+        if value in ("true", "1", "yes", "on"): return True
+        if value in ("false", "0", "no", "off", ""): return False
+        raise ValueError()
+    return bool(value)
+
+def _to_string(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(value).decode()
+    return str(value)
+
+def _to_blob(value):
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value)
+    return base64.b64decode(value)
+
+def _to_blob_json(value):
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(value).decode()
+    return str(value)
+
+# type name -> declared converter
+COERCE = {
+    "int32": _to_int32,
+    "int64": _to_int64,
+    "float": _to_float,
+    "double": _to_float,
+    "bool": _to_bool,
+    "string": _to_string,
+    "blob": _to_blob
+}
+
+# declared converters which differ when converting to JSON
+COERCE_JSON = {
+    "blob": _to_blob_json
+}
+
+##### packed arrays
+
+# pack values as big-endian bytes for array typecode, values is a list of
+# numbers, base64 string, packed bytes, or a buffer like array.array or a
+# NumPy array with a matching item type
+def pack(values, typecode):
+    if isinstance(values, (bytes, bytearray)):
+        if len(values) % _ITEMSIZE[typecode] != 0: raise ValueError()
+        return bytes(values)
+    if isinstance(values, str):
+        data = base64.b64decode(values, validate=True)
+        if len(data) % _ITEMSIZE[typecode] != 0: raise ValueError()
+        return data
+    if isinstance(values, (int, float)):
+        values = [values]
+    if isinstance(values, (list, tuple)):
+        data = _array(typecode, values)
+    else: # buffer
+        view = memoryview(values)
+        data = array(typecode)
+        if view.format.lstrip("@=<>!") == typecode:
+            data.frombytes(view.cast("B") if view.contiguous else view.tobytes())
+            order = view.format[0]
+            if order == "<" or (order not in ">!" and _SWAP):
+                data.byteswap()
+            return data.tobytes()
+        else: # convert item type
+            data.extend(_array(typecode, view.tolist()))
+    if _SWAP: data.byteswap()
+    return data.tobytes()
+
+# unpack big-endian bytes into native array for typecode
+def unpack(data, typecode):
+    values = array(typecode)
+    values.frombytes(data)
+    if _SWAP: values.byteswap()
+    return values
+
+# create array from numbers, ints are truncated from floats for int types
+def _array(typecode, values):
+    try:
+        return array(typecode, values)
+    except TypeError:
+        if typecode == "f": raise
+        return array(typecode, (int(v) for v in values))
+
+_SWAP = sys.byteorder == "little"
+_ITEMSIZE = {typecode: array(typecode).itemsize for typecode in ARRAYS.values()}
@@ -0,0 +1,325 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2022 ZKM | Hertz-Lab
+# Dan Wilcox <dan.wilcox@zkm.de>
+#
+# BSD Simplified License.
+# For information on usage and redistribution, and for a DISCLAIMER OF ALL
+# WARRANTIES, see the file, "LICENSE.txt," in this distribution.
+#
+# This code has been developed at ZKM | Hertz-Lab as part of „The Intelligent
+# Museum“ generously funded by the German Federal Cultural Foundation.
+#
+# References:
+# * https://docs.python.org/3/library/multiprocessing.shared_memory.html
+# * https://en.wikipedia.org/wiki/Seqlock
+
+from multiprocessing import shared_memory
+import struct
+import time
+import sys
+
+# latest-value table: the latest value per OSC address, ie. "/device1/temp",
+# in a fixed-layout shared memory block, written by thoscy-recv and read by
+# any number of local processes without system calls or OSC parsing
+#
+# layout, all values little-endian:
+# * header (64 bytes): MAGIC, version, slot count, address size, value size,
+#   used slot count
+# * slots (slot size each): seq (uint32), type (uint8), address length (uint8),
+#   value length (uint16), update time (int64 ms since epoch), address (utf-8,
+#   address size bytes), value (value size bytes)
+#
+# slots are assigned to addresses in order of arrival and never reassigned,
+# the used count is incremented after a slot's address is written, so readers
+# only need to index slots again when it changes
+#
+# each slot is guarded by a seqlock: the writer makes seq odd before and even
+# after writing a value, readers copy the value and retry if seq was odd or
+# changed meanwhile, so readers never block the writer
+# note: this relies on stores becoming visible in order, as on x86-64, a
+#       reader on weakly-ordered CPUs may rarely miss an in-progress write
+
+MAGIC = b"THOSCYLV"
+VERSION = 1
+HEADER = struct.Struct("<8sIIIII") # magic, version, slots, address size, value size, used
+HEADER_SIZE = 64
+USED_OFFSET = 24 # used slot count offset in the header
+SLOT = struct.Struct("<IBBHq") # seq, type, address length, value length, time ms
+SEQ = struct.Struct("<I")
+
+# value types
+NONE = 0
+INT = 1 # int64, also bools
+FLOAT = 2 # float64
+STRING = 3 # utf-8
+BLOB = 4 # bytes
+FLOATS = 5 # float64 array, multiple number args
+
+_INT = struct.Struct("<q")
+_FLOAT = struct.Struct("<d")
+
+SLOTS = 4096 # default slot count
+ADDRESS_SIZE = 64 # default max address bytes, at most 255
+VALUE_SIZE = 64 # default max value bytes
+
+# returns slot size for address & value size, aligned to 8 bytes
+def slot_size(address_size, value_size):
+    return (SLOT.size + address_size + value_size + 7) & ~7
+
+# latest-value table writer, creates the shared memory block
+class TableWriter:
+
+    # init with
+    # * name: str, shared memory block name, an existing block of the same
+    #   name is replaced
+    # additional options:
+    # * slots: int, max number of addresses, default: 4096
+    # * address_size: int, max address bytes, default: 64
+    # * value_size: int, max value bytes, ie. 64 fits strings of 64 bytes or
+    #   8 numbers, default: 64
+    def __init__(self, name, **kwargs):
+        self.name = name
+        self.slots = kwargs.get("slots") or SLOTS
+        self.address_size = min(kwargs.get("address_size") or ADDRESS_SIZE, 255)
+        self.value_size = kwargs.get("value_size") or VALUE_SIZE
+        self.slot_size = slot_size(self.address_size, self.value_size)
+        size = HEADER_SIZE + self.slots * self.slot_size
+        try:
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            # left over from a previous run
+            _unlink(name)
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        self.buf = self.shm.buf
+        self.index = {} # address -> slot offset
+        self.seqs = {} # slot offset -> current seq
+        self.dropped = 0 # values which did not fit or table full
+        HEADER.pack_into(self.buf, 0, MAGIC, VERSION, self.slots,
+                         self.address_size, self.value_size, 0)
+
+    # write list of (address, args) tuples, ie. from telemetry_to_osc(),
+    # single args are stored as is, multiple number args as a float64 array
+    def update(self, messages):
+        now = time.time_ns() // 1000000
+        for address, args in messages:
+            offset = self.index.get(address)
+            if offset == None:
+                offset = self._add(address)
+                if offset == None:
+                    self.dropped += 1
+                    continue
+            if not self._write(offset, args, now):
+                self.dropped += 1
+
+    # close and remove the shared memory block
+    def close(self):
+        if self.shm == None: return
+        self.buf = None
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
+
+    # assign next free slot to address, returns slot offset or None if full
+    def _add(self, address):
+        encoded = address.encode()
+        used = len(self.index)
+        if used >= self.slots or len(encoded) > self.address_size: return None
+        offset = HEADER_SIZE + used * self.slot_size
+        SLOT.pack_into(self.buf, offset, 0, NONE, len(encoded), 0, 0)
+        start = offset + SLOT.size
+        self.buf[start:start + len(encoded)] = encoded
+        self.index[address] = offset
+        self.seqs[offset] = 0
+        SEQ.pack_into(self.buf, USED_OFFSET, used + 1) # publish slot
+        return offset
+
+    # write value args to slot within the seqlock, returns False if the
+    # value does not fit
+    def _write(self, offset, args, now):
+        if len(args) == 1:
+            value = args[0]
+            if isinstance(value, float):
+                kind, data = FLOAT, _FLOAT.pack(value)
+            elif isinstance(value, int):
+                if not -2**63 <= value < 2**63: return False
+                kind, data = INT, _INT.pack(value)
+            elif isinstance(value, str):
+                kind, data = STRING, value.encode()
+            elif isinstance(value, (bytes, bytearray, memoryview)):
+                kind, data = BLOB, value
+            else:
+                return False
+        elif all(isinstance(value, (int, float)) for value in args):
+            kind, data = FLOATS, struct.pack(f"<{len(args)}d", *args)
+        else:
+            return False
+        if len(data) > self.value_size: return False
+        buf = self.buf
+        seq = self.seqs[offset] + 1
+        SEQ.pack_into(buf, offset, seq) # odd: writing
+        start = offset + SLOT.size + self.address_size
+        buf[start:start + len(data)] = data
+        SLOT.pack_into(buf, offset, seq, kind, buf[offset + 5], len(data), now)
+        seq += 1
+        SEQ.pack_into(buf, offset, seq) # even: done
+        self.seqs[offset] = seq
+        return True
+
+# latest-value table reader, attaches to the shared memory block created by
+# a TableWriter, ie. thoscy-recv with the "table" config key
+#
+# example usage:
+#   table = TableReader("thoscy")
+#   value, ms = table.get("/device1/temperature")
+#   changed = table.poll() # {address: (value, ms)} changed since last poll
+#
+# readers only use the standard library and do not import the rest of thoscy
+class TableReader:
+
+    # init with name: str, shared memory block name,
+    # raises FileNotFoundError if the block does not exist or ValueError if
+    # it is not a latest-value table
+    def __init__(self, name):
+        self.name = name
+        self.shm = _attach(name)
+        self.buf = self.shm.buf
+        magic, version, self.slots, self.address_size, self.value_size, _ = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f"not a latest-value table: {name}")
+        self.slot_size = slot_size(self.address_size, self.value_size)
+        self.index = {} # address -> slot offset
+        self.used = 0 # indexed slots
+        self.seqs = {} # slot offset -> seq at last poll
+        self.retries = 0 # reads retried due to concurrent writes
+
+    # returns (value, update time ms) for address or None if not set,
+    # numbers and strings are returned as such, blobs as bytes, and float
+    # arrays as tuples
+    def get(self, address):
+        offset = self.index.get(address)
+        if offset == None:
+            self._refresh()
+            offset = self.index.get(address)
+            if offset == None: return None
+        _, value, ms = self._read(offset)
+        return None if value is _UNSET else (value, ms)
+
+    # returns list of addresses in the table
+    def addresses(self):
+        self._refresh()
+        return list(self.index)
+
+    # returns dict of address -> (value, update time ms) for all set values
+    def snapshot(self):
+        self._refresh()
+        values = {}
+        for address, offset in self.index.items():
+            _, value, ms = self._read(offset)
+            if value is not _UNSET: values[address] = (value, ms)
+        return values
+
+    # returns dict of address -> (value, update time ms) for values written
+    # since the last poll, only reads each slot's seq if unchanged
+    def poll(self):
+        self._refresh()
+        changed = {}
+        buf = self.buf
+        seqs = self.seqs
+        unpack = SEQ.unpack_from
+        for address, offset in self.index.items():
+            if unpack(buf, offset)[0] == seqs.get(offset): continue
+            seq, value, ms = self._read(offset)
+            seqs[offset] = seq
+            if value is not _UNSET: changed[address] = (value, ms)
+        return changed
+
+    # detach from the shared memory block, it is kept until the writer closes
+    def close(self):
+        if self.shm == None: return
+        self.buf = None
+        self.shm.close()
+        self.shm = None
+
+    # index slots added since the last refresh
+    def _refresh(self):
+        used = SEQ.unpack_from(self.buf, USED_OFFSET)[0]
+        while self.used < used:
+            offset = HEADER_SIZE + self.used * self.slot_size
+            length = self.buf[offset + 5]
+            start = offset + SLOT.size
+            self.index[bytes(self.buf[start:start + length]).decode()] = offset
+            self.used += 1
+
+    # read slot consistently, returns (seq, value, update time ms)
+    def _read(self, offset):
+        buf = self.buf
+        start = offset + SLOT.size + self.address_size
+        while True:
+            seq, kind, _, length, ms = SLOT.unpack_from(buf, offset)
+            if seq & 1 == 0:
+                data = bytes(buf[start:start + length])
+                if SEQ.unpack_from(buf, offset)[0] == seq: break
+            self.retries += 1
+        if kind == FLOAT: value = _FLOAT.unpack(data)[0]
+        elif kind == INT: value = _INT.unpack(data)[0]
+        elif kind == STRING: value = data.decode(errors="replace")
+        elif kind == BLOB: value = data
+        elif kind == FLOATS: value = struct.unpack(f"<{length // 8}d", data)
+        else: value = _UNSET
+        return seq, value, ms
+
+_UNSET = object() # slot without value marker
+
+# attach to existing shared memory block without registering it with the
+# resource tracker, which would otherwise remove it when a reader exits
+def _attach(name):
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, track=False)
+    from multiprocessing import resource_tracker
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None if rtype == "shared_memory" else register(name, rtype)
+    try:
+        return shared_memory.SharedMemory(name)
+    finally:
+        resource_tracker.register = register
+
+# remove shared memory block by name, if it exists
+def _unlink(name):
+    try:
+        shm = shared_memory.SharedMemory(name) # tracked, so unlink untracks it
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+##### main
+
+# test program to print table values as they change
+# example usage: python3 -m thoscy.shmtable thoscy
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="latest-value table reader test")
+    parser.add_argument(
+        "name", type=str, metavar="NAME",
+        help="shared memory block name")
+    parser.add_argument(
+        "-i", "--interval", action="store", dest="interval",
+        default=0.1, type=float, help="poll interval in seconds, default: 0.1")
+    args = parser.parse_args()
+    try:
+        table = TableReader(args.name)
+    except (FileNotFoundError, ValueError) as exc:
+        print(f"could not open table: {exc}")
+        sys.exit(1)
+    print(f"table {args.name}: {table.slots} slots")
+    try:
+        while True:
+            for address, (value, ms) in table.poll().items():
+                print(f"{ms} {address} {value!r}")
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    table.close()
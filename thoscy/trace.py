@@ -0,0 +1,123 @@
+#! /usr/bin/env python3
+#
+# Copyright (c) 2022 ZKM | Hertz-Lab
+# Dan Wilcox <dan.wilcox@zkm.de>
+#
+# BSD Simplified License.
+# For information on usage and redistribution, and for a DISCLAIMER OF ALL
+# WARRANTIES, see the file, "LICENSE.txt," in this distribution.
+#
+# This code has been developed at ZKM | Hertz-Lab as part of „The Intelligent
+# Museum“ generously funded by the German Federal Cultural Foundation.
+
+import collections
+import threading
+import queue
+import time
+import sys
+
+# sampled hot path message tracer
+#
+# records are stored unformatted as (time, tag, address, args) tuples in a
+# ring buffer, which can be dumped on demand, and are optionally written to
+# an output stream by a background thread, so formatting and printing never
+# happen on the relay's thread
+#
+# sampling is per address: keep 1 in every N messages and/or at most N
+# messages per second
+class Tracer:
+
+    # init with options:
+    # * every: int, keep 1 in every N messages per address, default: 1 (all)
+    # * rate: int, max messages per second per address, 0 disables (default)
+    # * size: int, ring buffer size, default: 1000
+    # * output: stream, write sampled records to stream, ie. sys.stdout,
+    #   None only records to the ring buffer (default)
+    # * backlog: int, max records waiting for the writer before dropping,
+    #   default: 10000
+    # * addresses: int, max addresses with sampling counts, the counts are
+    #   reset when exceeded, ie. by many distinct unknown addresses,
+    #   default: 4096
+    def __init__(self, **kwargs):
+        self.every = kwargs.get("every") or 1
+        self.rate = kwargs.get("rate") or 0
+        self.ring = collections.deque(maxlen=kwargs.get("size") or 1000)
+        self.output = kwargs.get("output") or None
+        self.counts = {} # address -> [total, window start, window count]
+        self.max_addresses = kwargs.get("addresses") or 4096
+        self.dropped = 0 # records dropped by a full writer backlog
+        self.queue = None
+        self.thread = None
+        if self.output:
+            self.queue = queue.Queue(kwargs.get("backlog") or 10000)
+            self.thread = threading.Thread(target=self._write, name="thoscy-trace", daemon=True)
+            self.thread.start()
+
+    # create tracer from config dict, returns None if disabled,
+    # verbose enables writing to stdout
+    @staticmethod
+    def create(config, verbose=False):
+        config = config or {}
+        if not verbose and not config.get("enabled"):
+            return None
+        return Tracer(every=config.get("every"), rate=config.get("rate"),
+                      size=config.get("size"), output=(sys.stdout if verbose else None))
+
+    # trace a message, args are stored as given and formatted later
+    def trace(self, address, args, tag=""):
+        counts = self.counts.get(address)
+        if counts == None:
+            if len(self.counts) >= self.max_addresses: self.counts.clear()
+            counts = self.counts[address] = [0, 0.0, 0]
+        counts[0] += 1
+        if self.every > 1 and (counts[0] - 1) % self.every != 0:
+            return
+        if self.rate > 0:
+            now = time.monotonic()
+            if now - counts[1] >= 1.0:
+                counts[1] = now
+                counts[2] = 0
+            if counts[2] >= self.rate:
+                return
+            counts[2] += 1
+        record = (time.time(), tag, address, args)
+        self.ring.append(record)
+        if self.queue:
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.dropped += 1
+
+    # write ring buffer contents to path, returns number of written records
+    def dump(self, path):
+        records = list(self.ring)
+        with open(path, "w") as f:
+            for record in records:
+                f.write(Tracer.format(record, True) + "\n")
+        return len(records)
+
+    # stop background writer after writing pending records
+    def stop(self):
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join(1)
+            self.thread = None
+
+    # format record as "address args" or, with details,
+    # "timestamp tag address args"
+    @staticmethod
+    def format(record, details=False):
+        stamp, tag, address, args = record
+        if details:
+            stamp = time.strftime("%H:%M:%S", time.localtime(stamp)) + f".{int(stamp % 1 * 1000):03d}"
+            return f"{stamp} {tag} {address} {list(args)}"
+        return f"{address} {list(args)}"
+
+    # background writer
+    def _write(self):
+        while True:
+            record = self.queue.get()
+            if record == None: break
+            self.output.write(Tracer.format(record) + "\n")
+            if self.queue.empty():
+                self.output.flush()